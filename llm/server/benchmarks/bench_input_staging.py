@@ -0,0 +1,134 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+ModelRunner.dy_input_preprocess中host端参数组装的CPU基准，不依赖GPU与模型
+
+在llm/server目录下执行：
+    python benchmarks/bench_input_staging.py --batch-sizes 1,4,16,64
+对比两种写法组装一批新任务参数的耗时：
+1. staging：按列从TaskBatch取出整批参数，每个Tensor只写入一次（当前实现）
+2. row-wise：逐个任务、逐个参数写入切片（原实现），在GPU上每次写入都是一次host到device的拷贝
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.engine.task_batch import TaskBatch  # noqa: E402
+
+# 与dy_input_preprocess中按列写入的每任务参数一致
+COLUMNS = ("topp", "temperature", "penalty_score", "frequency_score", "presence_score",
+           "token_num", "token_num", "token_num", "prefill_start", "min_dec_len", "max_dec_len",
+           "infer_seed", "block_num")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-sizes", type=str, default="1,4,16,64")
+    parser.add_argument("--max-seq-len", type=int, default=8192)
+    parser.add_argument("--max-dec-len", type=int, default=1024)
+    parser.add_argument("--block-size", type=int, default=64)
+    parser.add_argument("--min-prompt-len", type=int, default=100)
+    parser.add_argument("--max-prompt-len", type=int, default=4000)
+    parser.add_argument("--iters", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def make_batch(args, task_num, rng):
+    tasks = list()
+    for i in range(task_num):
+        prompt_len = rng.randint(args.min_prompt_len, args.max_prompt_len)
+        tasks.append({"idx": i, "input_ids": list(range(prompt_len)), "eos_token_ids": [2],
+                      "block_tables": list(range((prompt_len + args.block_size - 1) // args.block_size + 2)),
+                      "max_dec_len": 100, "infer_seed": i})
+    return tasks, TaskBatch.decode(TaskBatch.from_tasks(tasks, task_num).encode())
+
+
+def stage(batch, args, block_width):
+    """
+    当前实现：整批参数组装为数组，返回写入各Tensor的数组，每个数组对应一次拷贝
+    """
+    task_num = len(batch)
+    staged = [batch.padded_token_ids(args.max_seq_len, 0),
+              np.full([task_num, args.max_dec_len], -1, dtype="int64"),
+              batch.padded_block_tables(block_width)]
+    for name in COLUMNS:
+        staged.append(np.ascontiguousarray(batch.column(name)).reshape([task_num, 1]))
+    staged.append(np.zeros([task_num, 1], dtype="int64"))
+    staged.append(np.zeros([task_num, 1], dtype="bool"))
+    return staged
+
+
+def write_rows(batch, buffers, block_width):
+    """
+    原实现：逐个任务逐个参数写入，返回写入次数
+    """
+    copy_num = 0
+    for i in range(len(batch)):
+        token_ids = batch.get_token_ids(i)
+        buffers["input_ids"][i, :len(token_ids)] = token_ids
+        buffers["pre_ids"][i:i + 1] = -1
+        block_tables = batch.get_block_tables(i)
+        buffers["block_tables"][i:i + 1] = -1
+        buffers["block_tables"][i, :len(block_tables)] = block_tables
+        copy_num += 4
+        for name in COLUMNS:
+            buffers[name][i:i + 1] = batch.column(name)[i]
+            copy_num += 1
+        buffers["step_idx"][i:i + 1] = 0
+        buffers["stop_flags"][i:i + 1] = False
+        copy_num += 2
+    return copy_num
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    block_width = (args.max_seq_len + args.max_dec_len + args.block_size - 1) // args.block_size
+    for task_num in [int(n) for n in args.batch_sizes.split(",")]:
+        tasks, batch = make_batch(args, task_num, rng)
+        staged = stage(batch, args, block_width)
+        # 补齐后的矩阵与逐个任务的切片一致
+        for i, task in enumerate(tasks):
+            token_num, block_num = len(task["input_ids"]), len(task["block_tables"])
+            assert staged[0][i, :token_num].tolist() == task["input_ids"] and not staged[0][i, token_num:].any()
+            assert staged[2][i, :block_num].tolist() == task["block_tables"] and (staged[2][i, block_num:] == -1).all()
+
+        start = time.perf_counter()
+        for _ in range(args.iters):
+            stage(batch, args, block_width)
+        staging_cost = (time.perf_counter() - start) / args.iters
+
+        buffers = {name: np.zeros([task_num, 1]) for name in COLUMNS + ("step_idx", "stop_flags")}
+        buffers["input_ids"] = np.zeros([task_num, args.max_seq_len], dtype="int64")
+        buffers["pre_ids"] = np.zeros([task_num, args.max_dec_len], dtype="int64")
+        buffers["block_tables"] = np.full([task_num, block_width], -1, dtype="int32")
+        start = time.perf_counter()
+        for _ in range(args.iters):
+            copy_num = write_rows(batch, buffers, block_width)
+        row_cost = (time.perf_counter() - start) / args.iters
+        print(f"batch size {task_num}: staging {1e3 * staging_cost:.3f}ms/batch ({len(staged)} copies), "
+              f"row-wise {1e3 * row_cost:.3f}ms/batch ({copy_num} copies)")
+
+
+if __name__ == "__main__":
+    main()
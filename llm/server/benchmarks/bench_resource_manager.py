@@ -0,0 +1,81 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+ResourceManager位置与block分配的CPU微基准，不依赖GPU与模型
+
+在llm/server目录下执行：
+    python benchmarks/bench_resource_manager.py --max-batch-size 256 --ops 20000
+每次操作插入一个新任务，batch已满或按概率先结束一个正在推理的任务，输出每秒插入的任务数
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("FD_LOG_DIR", tempfile.mkdtemp(prefix="fd_bench_log_"))
+
+import logging  # noqa: E402
+
+from server.engine.resource_manager import ResourceManager  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-batch-size", type=int, default=256)
+    parser.add_argument("--max-block-num", type=int, default=100000)
+    parser.add_argument("--block-size", type=int, default=64)
+    parser.add_argument("--prompt-len", type=int, default=100)
+    parser.add_argument("--ops", type=int, default=20000)
+    parser.add_argument("--release-prob", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # 只统计分配本身的耗时，不写日志
+    logging.getLogger("model_server").setLevel(logging.ERROR)
+    cfg = SimpleNamespace(max_batch_size=args.max_batch_size, max_block_num=args.max_block_num,
+                          block_size=args.block_size, dec_token_num=128, max_seq_len=8192,
+                          max_query_block_num=200, enable_chunked_prefill=False,
+                          enable_prefix_cache=False, enable_admission_control=False, enable_lora=False)
+    rm = ResourceManager(cfg)
+    rng = random.Random(args.seed)
+    running = list()
+    start = time.perf_counter()
+    for i in range(args.ops):
+        if running and (rm.available_batch() == 0 or rng.random() < args.release_prob):
+            task = running.pop(rng.randrange(len(running)))
+            rm.release_slot(task["idx"])
+            rm._recycle_block_tables(task["block_tables"])
+        running.extend(rm.allocate_resources_for_new_tasks(
+            [{"req_id": str(i), "input_ids": [1] * args.prompt_len, "eos_token_ids": [2]}]))
+        # 插入线程每次轮询都会查询可用位置数
+        rm.available_batch()
+    cost = time.perf_counter() - start
+
+    assert rm.real_bsz == max([task["idx"] for task in running], default=-1) + 1
+    assert rm.available_batch() == args.max_batch_size - len(running)
+    print(f"max_batch_size: {args.max_batch_size}, ops: {args.ops}, cost: {cost:.3f}s, "
+          f"{args.ops / cost:.0f} inserts/s, real_bsz: {rm.real_bsz}")
+
+
+if __name__ == "__main__":
+    main()
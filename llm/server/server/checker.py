@@ -13,6 +13,10 @@
 # limitations under the License.
 
 
+# 单个请求的停止字符串数上限
+MAX_STOP_STRING_NUM = 16
+
+
 def check_basic_params(req_dict):
     """
     对单个输入请求进行基础的校验检查，适用于推拉模式。
@@ -42,11 +46,14 @@ def check_basic_params(req_dict):
         if "input_ids" in req_dict and not isinstance(req_dict["input_ids"], list):
             error_msg.append("The `input_ids` in input parameters must be a list")
         if "messages" in req_dict:
-            msg_len = len(req_dict["messages"])
-            if msg_len % 2 == 0:
-                error_msg.append(f"The number of the message {msg_len} must be odd")
-            if not all("content" in item for item in req_dict["messages"]):
+            if not isinstance(req_dict["messages"], list) or \
+                    not all(isinstance(item, dict) and "content" in item for item in req_dict["messages"]):
                 error_msg.append("The item in messages must include `content`")
+            else:
+                # system消息不计入对话轮次
+                msg_len = len([item for item in req_dict["messages"] if item.get("role") != "system"])
+                if msg_len % 2 == 0:
+                    error_msg.append(f"The number of the message {msg_len} must be odd")
 
     if "req_id" not in req_dict:
         error_msg.append("The input parameters should contain `req_id`.")
@@ -97,6 +104,70 @@ def check_basic_params(req_dict):
         if "seed" in req_dict and "infer_seed" not in req_dict:
             req_dict["infer_seed"] = req_dict["seed"]
 
+    if "n" in req_dict and (not isinstance(req_dict["n"], int) or req_dict["n"] < 1):
+        error_msg.append("The `n` must be an integer and greater than 0")
+
+    if "priority" in req_dict and not isinstance(req_dict["priority"], int):
+        error_msg.append("The `priority` must be an integer")
+
+    # 流式返回时合并发送的token数及时间间隔(毫秒)
+    if "coalesce_tokens" in req_dict and \
+        (not isinstance(req_dict["coalesce_tokens"], int) or req_dict["coalesce_tokens"] < 1):
+        error_msg.append("The `coalesce_tokens` must be an integer and greater than 0")
+    if "coalesce_ms" in req_dict and \
+        (not isinstance(req_dict["coalesce_ms"], (int, float)) or req_dict["coalesce_ms"] < 0):
+        error_msg.append("The `coalesce_ms` must be a number and >= 0")
+
+    # 停止字符串，统一转换为列表
+    if req_dict.get("stop") is not None:
+        if isinstance(req_dict["stop"], str):
+            req_dict["stop"] = [req_dict["stop"]]
+        if not isinstance(req_dict["stop"], list) or \
+                not all(isinstance(item, str) and item for item in req_dict["stop"]):
+            error_msg.append("The `stop` must be a non-empty string or a list of non-empty strings")
+        elif len(req_dict["stop"]) > MAX_STOP_STRING_NUM:
+            error_msg.append(f"The number of `stop` strings must be <= {MAX_STOP_STRING_NUM}")
+
+    # OpenAI格式的response_format，json_schema类型转换为guided_json
+    if req_dict.get("response_format") is not None:
+        response_format = req_dict["response_format"]
+        format_type = response_format.get("type") if isinstance(response_format, dict) else None
+        if format_type == "json_schema":
+            json_schema = response_format.get("json_schema")
+            if not isinstance(json_schema, dict) or not isinstance(json_schema.get("schema"), dict):
+                error_msg.append("The `response_format.json_schema.schema` must be a dict")
+            elif req_dict.get("guided_json") is None:
+                req_dict["guided_json"] = json_schema["schema"]
+        elif format_type != "text":
+            error_msg.append("The type of `response_format` must be either `text` or `json_schema`")
+
+    # 约束解码参数只允许设置一个，具体的语法在编译时检查
+    keys = ("guided_json", "guided_regex", "guided_choice")
+    if sum([req_dict.get(key) is not None for key in keys]) > 1:
+        error_msg.append(f"Only one of {keys} should be set")
+    if req_dict.get("guided_json") is not None and not isinstance(req_dict["guided_json"], (dict, str)):
+        error_msg.append("The `guided_json` must be a dict or a json string")
+    if req_dict.get("guided_regex") is not None and \
+        (not isinstance(req_dict["guided_regex"], str) or req_dict["guided_regex"] == ""):
+        error_msg.append("The `guided_regex` must be a non-empty string")
+    if req_dict.get("guided_choice") is not None and \
+        (not isinstance(req_dict["guided_choice"], list) or len(req_dict["guided_choice"]) == 0 or
+         not all(isinstance(item, str) and item for item in req_dict["guided_choice"])):
+        error_msg.append("The `guided_choice` must be a non-empty list of non-empty strings")
+
+    # adapter是否存在在预处理时检查
+    if req_dict.get("adapter_id") is not None and \
+        (not isinstance(req_dict["adapter_id"], str) or req_dict["adapter_id"] == ""):
+        error_msg.append("The `adapter_id` must be a non-empty string")
+
+    # prefill与decode分离时decode实例的请求参数
+    if req_dict.get("prefill_req_id") is not None and not isinstance(req_dict["prefill_req_id"], str):
+        error_msg.append("The `prefill_req_id` must be a string")
+    if req_dict.get("prefill_token_ids") is not None and \
+        (not isinstance(req_dict["prefill_token_ids"], list) or
+         not all(isinstance(item, int) and item >= 0 for item in req_dict["prefill_token_ids"])):
+        error_msg.append("The `prefill_token_ids` must be a list of non-negative integers")
+
     if "stream" in req_dict and not isinstance(req_dict["stream"], bool):
         error_msg.append("The `stream` must be a boolean")
 
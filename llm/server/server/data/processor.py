@@ -13,7 +13,9 @@
 # limitations under the License.
 
 import os
+import threading
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from paddlenlp.utils.llm_utils import get_eos_token_id
 from paddlenlp.transformers import (
     LlamaTokenizer,
@@ -121,16 +123,58 @@ class BaseDataProcessor(ABC):
         raise NotImplementedError
 
 
+class TokenizeCache(object):
+    """
+    tokenize结果的LRU缓存，按拼接对话模板后的完整文本缓存，
+    相同system prompt与模板的重复输入只tokenize一次，可由多个DataProcessor共用
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.query_num = 0
+        self.hit_num = 0
+
+    def get(self, key):
+        """
+        查询缓存，命中时返回token ids，否则返回None
+        """
+        with self.lock:
+            self.query_num += 1
+            input_ids = self.cache.get(key)
+            if input_ids is not None:
+                self.cache.move_to_end(key)
+                self.hit_num += 1
+            return input_ids
+
+    def put(self, key, input_ids):
+        """
+        加入缓存，超出容量时淘汰最久未使用的条目
+        """
+        with self.lock:
+            self.cache[key] = input_ids
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+    def hit_rate(self):
+        return self.hit_num / self.query_num if self.query_num > 0 else 0.0
+
+
 class DataProcessor(BaseDataProcessor):
     """继承自Data processor的基类"""
 
-    def __init__(self):
+    def __init__(self, tokenize_cache=None):
         """
         初始化函数。
+
+        Args:
+            tokenize_cache (TokenizeCache): tokenize结果的缓存，为None时不缓存
         """
         self.config = Config()
         max_length = self.config.get_model_config().get('max_length', 1024)
         self.src_length = max_length - self.config.seq_len_limit
+        self.tokenize_cache = tokenize_cache
 
         self.decode_status = dict()
         self.tokenizer = self._load_tokenizer()
@@ -154,6 +198,8 @@ class DataProcessor(BaseDataProcessor):
 
         if "input_ids" in request:
             input_ids = request["input_ids"]
+        elif "messages" in request:
+            input_ids = self.messages2ids(request["messages"])
         else:
             input_ids = self.text2ids(request['text'])
 
@@ -187,6 +233,28 @@ class DataProcessor(BaseDataProcessor):
             response_dict["tokens_all"] = self.clear_request_status(req_id)
         return response_dict
 
+    def batch_process_response(self, response_dicts):
+        """
+        批量处理同一推理步中多个请求的返回结果，所有请求的token在一次batch解码中完成
+
+        Args:
+            response_dicts (List[Dict]): response for engine, contain ids fields
+
+        Returns:
+            List[Dict]: response contain text fields
+        """
+        stream_responses = [response for response in response_dicts if "choices" not in response]
+        tokens = self.batch_ids2tokens([response.get("token_ids", []) for response in stream_responses],
+                                       [response["req_id"] for response in stream_responses])
+        for response, token in zip(stream_responses, tokens):
+            response["token"] = token
+            if response.get("is_end", 0):
+                response["tokens_all"] = self.clear_request_status(response["req_id"])
+        for response in response_dicts:
+            if "choices" in response:
+                self.process_response(response)
+        return response_dicts
+
     def text2ids(self, text):
         """
         text to ids
@@ -194,49 +262,101 @@ class DataProcessor(BaseDataProcessor):
         if self.tokenizer.chat_template is not None:
             text = [text] if isinstance(text, str) else text
             text = [self.tokenizer.apply_chat_template(sentence, tokenize=False) for sentence in text]
-
+        return self._tokenize(text, add_special_tokens=self.tokenizer.chat_template is None)
+
+    def _tokenize(self, text, add_special_tokens):
+        key = (text if isinstance(text, str) else tuple(text), add_special_tokens)
+        if self.tokenize_cache is not None:
+            input_ids = self.tokenize_cache.get(key)
+            if input_ids is not None:
+                return input_ids.copy()
         tokens = self.tokenizer(
             text,
             return_tensors="np",
             padding=True,
             truncation=True,
             max_length=self.src_length,
-            add_special_tokens=self.tokenizer.chat_template is None,
+            add_special_tokens=add_special_tokens,
         )
-        return tokens["input_ids"][0]
+        input_ids = tokens["input_ids"][0]
+        if self.tokenize_cache is not None:
+            self.tokenize_cache.put(key, input_ids.copy())
+        return input_ids
 
     def messages2ids(self, messages):
         """
         将多轮对话转换为对话ID序列。
+        messages为user与assistant交替的消息，以user结尾，开头可以有system消息；
+        按[[user, assistant], ..., [user]]的轮次应用tokenizer的对话模板，没有对话模板时直接拼接各消息的内容
 
         Args:
-            messages (List[List[Dict[str, Any]]]): 对话列表，每个对话是一个字典。
+            messages (List[Dict[str, Any]]): 对话列表，每个对话是一个字典。
 
         Returns:
             List[int]: 对话ID序列，每个ID是一个整数。
 
         """
-        return
+        system = "\n".join(self._message_content(item) for item in messages if item.get("role") == "system")
+        contents = [self._message_content(item) for item in messages if item.get("role") != "system"]
+        if self.tokenizer.chat_template is None:
+            return self._tokenize("\n".join(([system] if system else []) + contents), add_special_tokens=True)
+
+        conversation = [contents[i:i + 2] for i in range(0, len(contents), 2)]
+        context_data = {"system": system} if system else {}
+        text = self.tokenizer.apply_chat_template(conversation, tokenize=False, context_data=context_data)
+        return self._tokenize(text, add_special_tokens=False)
+
+    @staticmethod
+    def _message_content(message):
+        """
+        消息的文本内容，content为多段内容的列表时拼接其中的文本
+        """
+        content = message["content"]
+        if isinstance(content, list):
+            return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        return content
 
     def ids2tokens(self, token_id, task_id):
         """
         ids to tokens
         """
-        if task_id not in self.decode_status:
-            # 记录deocde的prefix offset & read offset & history token ids & history token strings
-            self.decode_status[task_id] = [0, 0, [], []]
-
-        prefix_offset = self.decode_status[task_id][0]
-        read_offset = self.decode_status[task_id][1]
-        previous_token_ids = self.decode_status[task_id][2]
-        decode_str, prefix_offset, read_offset = self.tokenizer.decode_token(
-            previous_token_ids + token_id, prefix_offset, read_offset)
-        self.decode_status[task_id][0] = prefix_offset
-        self.decode_status[task_id][1] = read_offset
-        self.decode_status[task_id][2] += token_id
-        self.decode_status[task_id][3].append(decode_str)
-        # 此处为流式返回中的每个token字符串结果,可自行添加处理
-        return decode_str
+        return self.batch_ids2tokens([token_id], [task_id])[0]
+
+    def batch_ids2tokens(self, token_ids_list, task_ids):
+        """
+        增量解码多个请求的新token，与tokenizer.decode_token的逻辑一致：
+        分别解码[prefix_offset, read_offset)与[prefix_offset, 结尾)的token，新增的文本即为本次的解码结果
+        1. 每个请求只保留prefix_offset之后的token，解码开销与生成长度无关
+        2. 所有请求的前缀文本与新文本在一次batch_decode中完成
+        """
+        statuses = list()
+        for token_ids, task_id in zip(token_ids_list, task_ids):
+            if task_id not in self.decode_status:
+                # 记录deocde的prefix offset & read offset & prefix offset之后的token ids & history token strings
+                self.decode_status[task_id] = [0, 0, [], []]
+            status = self.decode_status[task_id]
+            status[2].extend(token_ids)
+            statuses.append(status)
+        if not statuses:
+            return []
+
+        texts = self.tokenizer.batch_decode(
+            [status[2][status[0]:status[1]] for status in statuses] + [status[2][status[0]:] for status in statuses],
+            skip_special_tokens=False,
+            clean_up_tokenization_spaces=False)
+        decode_strs = list()
+        for i, status in enumerate(statuses):
+            prefix_text, new_text = texts[i], texts[len(statuses) + i]
+            decode_str = ""
+            if len(new_text) > len(prefix_text) and not prefix_text.endswith("�") and not new_text.endswith("�"):
+                decode_str = new_text[len(prefix_text):]
+                # 新的prefix_offset为原read_offset，丢弃其之前的token
+                del status[2][:status[1]]
+                status[0], status[1] = 0, len(status[2])
+            status[3].append(decode_str)
+            # 此处为流式返回中的每个token字符串结果,可自行添加处理
+            decode_strs.append(decode_str)
+        return decode_strs
 
     def _load_tokenizer(self):
         """
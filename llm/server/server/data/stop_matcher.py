@@ -0,0 +1,139 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from collections import OrderedDict
+
+# 缓存的自动机数，通常大量请求使用相同的停止字符串
+AUTOMATON_CACHE_SIZE = 256
+
+
+class AhoCorasick(object):
+    """
+    多个停止字符串的Aho-Corasick自动机，按字符转移，文本中每个字符只需一次均摊O(1)的转移
+
+    Attributes:
+        depth (list[int]): 各节点对应的字符串长度，即已匹配的停止字符串前缀长度
+        match_len (list[int]): 到达各节点时匹配结束的最长停止字符串长度，0表示没有匹配
+    """
+    def __init__(self, patterns):
+        self.goto = [dict()]
+        self.fail = [0]
+        self.depth = [0]
+        self.match_len = [0]
+        for pattern in patterns:
+            node = 0
+            for char in pattern:
+                if char not in self.goto[node]:
+                    self.goto.append(dict())
+                    self.fail.append(0)
+                    self.depth.append(self.depth[node] + 1)
+                    self.match_len.append(0)
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.match_len[node] = len(pattern)
+
+        # 按深度顺序计算失配指针，节点的匹配结果包含其失配指针链上的匹配
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.match_len[child] = max(self.match_len[child], self.match_len[self.fail[child]])
+                queue.append(child)
+
+    def step(self, node, char):
+        """
+        从节点node读入一个字符后到达的节点
+        """
+        while node and char not in self.goto[node]:
+            node = self.fail[node]
+        return self.goto[node].get(char, 0)
+
+
+_automata = OrderedDict()
+_automata_lock = threading.Lock()
+
+
+def get_automaton(stop):
+    """
+    获取停止字符串的自动机，相同的停止字符串共用一个自动机
+    """
+    key = tuple(sorted(set(stop)))
+    with _automata_lock:
+        automaton = _automata.get(key)
+        if automaton is not None:
+            _automata.move_to_end(key)
+            return automaton
+    automaton = AhoCorasick(key)
+    with _automata_lock:
+        _automata[key] = automaton
+        while len(_automata) > AUTOMATON_CACHE_SIZE:
+            _automata.popitem(last=False)
+    return automaton
+
+
+class StopStringMatcher(object):
+    """
+    在单个请求的流式解码文本中增量匹配停止字符串，匹配状态跨token保留
+    末尾可能是停止字符串前缀的文本暂不返回，长度即自动机当前节点的深度，待后续文本到达后再判断
+    """
+    def __init__(self, stop):
+        self.automaton = get_automaton(stop)
+        self.node = 0
+        self.held = ""
+        # 已确定返回的文本片段
+        self.pieces = []
+
+    @property
+    def text(self):
+        """
+        已确定返回的全部文本
+        """
+        return "".join(self.pieces)
+
+    def feed(self, text):
+        """
+        追加新解码的文本
+
+        Returns:
+            str: 可以返回的文本，匹配到停止字符串时为停止字符串之前的文本
+            bool: 是否匹配到停止字符串
+        """
+        automaton = self.automaton
+        node = self.node
+        for i, char in enumerate(text):
+            node = automaton.step(node, char)
+            if automaton.match_len[node]:
+                end = len(self.held) + i + 1
+                visible = (self.held + text)[:end - automaton.match_len[node]]
+                self.held = ""
+                self.pieces.append(visible)
+                return visible, True
+        self.node = node
+        combined = self.held + text
+        send_len = len(combined) - automaton.depth[node]
+        visible, self.held = combined[:send_len], combined[send_len:]
+        self.pieces.append(visible)
+        return visible, False
+
+    def flush(self):
+        """
+        生成结束，返回暂存的文本
+        """
+        visible, self.held = self.held, ""
+        self.pieces.append(visible)
+        return visible
@@ -18,6 +18,8 @@ import sys
 from datetime import datetime
 from paddlenlp.generation import GenerationConfig
 
+from server.engine.lora import SUPPORTED_TARGET_MODULES
+from server.engine.speculate import SPECULATE_MAX_TOKENS_PER_STEP
 from server.utils import model_server_logger
 
 
@@ -66,6 +68,13 @@ class Config:
 
         # 最大支持缓存的task数
         self.max_cached_task_num = int(os.getenv("MAX_CACHED_TASK_NUM", "128"))
+        # 缓存task的调度策略，可选 fifo、skip_ahead、spf(shortest prompt first)、priority
+        self.schedule_policy = os.getenv("SCHEDULE_POLICY", "fifo").lower()
+        # skip_ahead策略下，队首请求资源不足时向后查找的窗口大小，以及队首请求最多被跳过的次数
+        self.schedule_window = int(os.getenv("SCHEDULE_WINDOW", "8"))
+        self.schedule_max_skip_times = int(os.getenv("SCHEDULE_MAX_SKIP_TIMES", "32"))
+        # spf策略下，请求每等待1秒相当于输入减少的token数，避免长请求饿死，为0时不老化
+        self.schedule_spf_aging_rate = float(os.getenv("SCHEDULE_SPF_AGING_RATE", "500"))
         # 如果没有配置PUSH_MODE_HTTP_PORT, 则只支持 GRPC 服务模式
         self.push_mode_http_port = int(os.getenv("PUSH_MODE_HTTP_PORT", "-1"))
         if self.push_mode_http_port > 0:
@@ -79,6 +88,18 @@ class Config:
         if self.push_mode_http_workers < 1:
             raise Exception(f"PUSH_MODE_HTTP_WORKERS ({self.push_mode_http_workers}) must be positive")
 
+        # 推模式下结果发送线程数，请求按req_id固定分配到其中一个线程，同一请求的结果按顺序发送
+        self.push_mode_sender_threads = int(os.getenv("PUSH_MODE_SENDER_THREADS", "4"))
+        if self.push_mode_sender_threads < 1:
+            raise Exception(f"PUSH_MODE_SENDER_THREADS ({self.push_mode_sender_threads}) must be positive")
+        # 推模式下请求预处理（拼接对话模板、tokenize）的线程数，以及等待预处理的请求数上限
+        self.push_mode_preprocess_threads = int(os.getenv("PUSH_MODE_PREPROCESS_THREADS", "4"))
+        if self.push_mode_preprocess_threads < 1:
+            raise Exception(f"PUSH_MODE_PREPROCESS_THREADS ({self.push_mode_preprocess_threads}) must be positive")
+        self.max_preprocess_task_num = int(os.getenv("MAX_PREPROCESS_TASK_NUM", "128"))
+        # tokenize结果的LRU缓存条目数，为0时不缓存
+        self.tokenize_cache_size = int(os.getenv("TOKENIZE_CACHE_SIZE", "256"))
+
         # 导出Paddle代码版本，便于对比版本号
         import paddle
         self.paddle_commit_id = paddle.version.commit
@@ -101,6 +122,57 @@ class Config:
         self.block_ratio = float(os.getenv("BLOCK_RATIO", 0.75))
         self.bad_tokens = str(env.get("BAD_TOKENS", "-1"))
         self.first_token_id = int(os.getenv("FIRST_TOKEN_ID", 1))
+        # 是否开启前缀缓存，相同前缀的请求复用已计算的KV Cache block，跳过这部分prefill计算
+        # 需要推理模型的block attention支持seq_lens_decoder非0时的prefill
+        self.enable_prefix_cache = int(os.getenv("ENABLE_PREFIX_CACHE", 0)) == 1
+        # 是否开启分块prefill，长prompt按固定长度分块，与其他请求的decode交替执行，降低decode的token间延迟
+        # 与前缀缓存相同，需要推理模型的block attention支持seq_lens_decoder非0时的prefill
+        self.enable_chunked_prefill = int(os.getenv("ENABLE_CHUNKED_PREFILL", 0)) == 1
+        self.prefill_chunk_size = int(os.getenv("PREFILL_CHUNK_SIZE", 512))
+        # 是否开启抢占，资源不足时按优先级从低到高、插入时间从晚到早选择正在推理的任务，
+        # 释放其block并重新放入调度队列，恢复时以prompt和已生成的token重新计算
+        self.enable_preemption = int(os.getenv("ENABLE_PREEMPTION", 0)) == 1
+        # 是否开启准入控制，按prompt长度与预估生成长度计算每个任务最终占用的block，
+        # 所有任务的预估占用不超过总block数 * ADMISSION_OVERCOMMIT_RATIO 时才插入新任务
+        self.enable_admission_control = int(os.getenv("ENABLE_ADMISSION_CONTROL", 0)) == 1
+        self.admission_overcommit_ratio = float(os.getenv("ADMISSION_OVERCOMMIT_RATIO", 1.0))
+        # 投机解码方式，none为不开启，ngram为以请求自身上下文的n-gram匹配生成草稿token，
+        # 需要推理模型支持草稿token的验证，并以speculate_save_output输出每步接受的token
+        self.speculate_method = os.getenv("SPECULATE_METHOD", "none").lower()
+        self.speculate_max_draft_tokens = int(os.getenv("SPECULATE_MAX_DRAFT_TOKENS", 5))
+        self.speculate_max_ngram_size = int(os.getenv("SPECULATE_MAX_NGRAM_SIZE", 3))
+        # 是否开启约束解码，请求可通过guided_json、guided_regex或guided_choice限制输出格式，
+        # 需要推理模型在采样前按allowed_token_mask屏蔽不允许的token
+        self.enable_guided_decoding = int(os.getenv("ENABLE_GUIDED_DECODING", 0)) == 1
+        # 编译结果的磁盘缓存目录，服务进程与推理进程通过该目录共享编译结果
+        self.guided_decoding_cache_dir = os.path.abspath(
+            os.getenv("GUIDED_DECODING_CACHE_DIR", "./guided_decoding_cache"))
+        # 内存中缓存的编译结果数
+        self.guided_decoding_cache_size = int(os.getenv("GUIDED_DECODING_CACHE_SIZE", 32))
+        # 单个请求的正则表达式编译为DFA后的最大状态数，超出时返回错误
+        self.guided_decoding_max_states = int(os.getenv("GUIDED_DECODING_MAX_STATES", 2000))
+        # LoRA adapter目录，每个子目录为一个adapter，请求通过adapter_id指定，为空时不开启；
+        # 需要推理模型按lora_slots对各位置的目标层叠加lora_a_*与lora_b_*中对应adapter的输出
+        self.lora_adapter_dir = os.getenv("LORA_ADAPTER_DIR", "")
+        self.enable_lora = self.lora_adapter_dir != ""
+        if self.enable_lora:
+            self.lora_adapter_dir = os.path.abspath(self.lora_adapter_dir)
+        # 显存中的adapter数，即同一batch中最多的不同adapter数
+        self.max_loras = int(os.getenv("MAX_LORAS", 4))
+        # 推理进程内存中缓存的adapter数
+        self.max_cpu_loras = int(os.getenv("MAX_CPU_LORAS", 16))
+        # adapter的最大rank，rank较小的adapter补0
+        self.lora_max_rank = int(os.getenv("LORA_MAX_RANK", 16))
+        self.lora_target_modules = [module.strip() for module in os.getenv(
+            "LORA_TARGET_MODULES", "q_proj,k_proj,v_proj,o_proj,gate_proj,up_proj,down_proj").split(",") if module.strip()]
+        # 实例角色，mixed为同时做prefill与decode；prefill实例只计算prompt与首个token，并通过KV传输发送prompt的KV，
+        # decode实例接收请求的KV后从首个token开始生成，两类实例可以分别扩缩容，由router为请求分配实例
+        self.engine_role = os.getenv("ENGINE_ROLE", "mixed").lower()
+        # KV传输方式，shm为同一机器上基于共享内存文件系统的传输
+        self.kv_transport = os.getenv("KV_TRANSPORT", "shm").lower()
+        self.kv_transport_dir = os.getenv("KV_TRANSPORT_DIR", "/dev/shm/fastdeploy_kv")
+        # decode实例等待prefill实例发送KV的超时时间，单位秒
+        self.kv_transfer_timeout = float(os.getenv("KV_TRANSFER_TIMEOUT", 30))
 
         # 引擎输入队列端口号
         self.infer_port = int(os.getenv("INFER_QUEUE_PORT", 56666))
@@ -150,6 +222,70 @@ class Config:
         """
         检查参数配置合法性
         """
+        assert self.schedule_policy in ("fifo", "skip_ahead", "spf", "priority"), (
+            f"The parameter `SCHEDULE_POLICY` should be one of fifo, skip_ahead, spf and priority, "
+            f"but now it's {self.schedule_policy}."
+        )
+        assert self.schedule_spf_aging_rate >= 0, (
+            f"The parameter `SCHEDULE_SPF_AGING_RATE` should be no less than 0, "
+            f"but now it's {self.schedule_spf_aging_rate}."
+        )
+        if self.enable_chunked_prefill:
+            assert self.prefill_chunk_size > 0 and self.prefill_chunk_size % self.block_size == 0, (
+                f"The parameter `PREFILL_CHUNK_SIZE` should be a positive multiple of block_size "
+                f"{self.block_size}, but now it's {self.prefill_chunk_size}."
+            )
+        assert self.speculate_method in ("none", "ngram"), (
+            f"The parameter `SPECULATE_METHOD` should be one of none and ngram, "
+            f"but now it's {self.speculate_method}."
+        )
+        if self.speculate_method != "none":
+            assert 0 < self.speculate_max_draft_tokens < SPECULATE_MAX_TOKENS_PER_STEP, (
+                f"The parameter `SPECULATE_MAX_DRAFT_TOKENS` should be in [1, {SPECULATE_MAX_TOKENS_PER_STEP - 1}], "
+                f"but now it's {self.speculate_max_draft_tokens}."
+            )
+            assert self.speculate_max_ngram_size > 0, (
+                f"The parameter `SPECULATE_MAX_NGRAM_SIZE` should be greater than 0, "
+                f"but now it's {self.speculate_max_ngram_size}."
+            )
+        if self.enable_guided_decoding:
+            assert self.speculate_method == "none", (
+                "The parameter `ENABLE_GUIDED_DECODING` can not be used with `SPECULATE_METHOD` "
+                f"{self.speculate_method}, draft tokens are not checked by the guided decoding mask."
+            )
+            assert self.guided_decoding_cache_size > 0 and self.guided_decoding_max_states > 0, (
+                f"The parameters `GUIDED_DECODING_CACHE_SIZE` and `GUIDED_DECODING_MAX_STATES` should be "
+                f"greater than 0, but now they're {self.guided_decoding_cache_size} and "
+                f"{self.guided_decoding_max_states}."
+            )
+        if self.enable_lora:
+            assert os.path.isdir(self.lora_adapter_dir), (
+                f"The parameter `LORA_ADAPTER_DIR` should be a directory, but now it's {self.lora_adapter_dir}."
+            )
+            assert self.max_loras > 0 and self.max_cpu_loras >= self.max_loras and self.lora_max_rank > 0, (
+                f"The parameters `MAX_LORAS` and `LORA_MAX_RANK` should be greater than 0 and `MAX_CPU_LORAS` "
+                f"should be no less than `MAX_LORAS`, but now they're {self.max_loras}, {self.lora_max_rank} "
+                f"and {self.max_cpu_loras}."
+            )
+            unsupported_modules = set(self.lora_target_modules) - set(SUPPORTED_TARGET_MODULES)
+            assert self.lora_target_modules and not unsupported_modules, (
+                f"The parameter `LORA_TARGET_MODULES` should be a subset of {list(SUPPORTED_TARGET_MODULES)}, "
+                f"but now it's {self.lora_target_modules}."
+            )
+        assert self.engine_role in ("mixed", "prefill", "decode"), (
+            f"The parameter `ENGINE_ROLE` should be one of mixed, prefill and decode, but now it's {self.engine_role}."
+        )
+        if self.engine_role != "mixed":
+            assert self.kv_transport == "shm", (
+                f"The parameter `KV_TRANSPORT` should be shm, but now it's {self.kv_transport}."
+            )
+            assert self.kv_transfer_timeout > 0, (
+                f"The parameter `KV_TRANSFER_TIMEOUT` should be greater than 0, but now it's {self.kv_transfer_timeout}."
+            )
+        assert self.admission_overcommit_ratio > 0, (
+            f"The parameter `ADMISSION_OVERCOMMIT_RATIO` should be greater than 0, "
+            f"but now it's {self.admission_overcommit_ratio}."
+        )
         assert self.max_batch_size <= 256, (
             "The parameter `max_batch_size` is not allowed to exceed 256, "
             "but now it's {}.".format(self.max_batch_size)
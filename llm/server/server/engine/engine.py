@@ -18,16 +18,13 @@ import subprocess
 import time
 import uuid
 import weakref
-import multiprocessing
 import numpy as np
 from datetime import datetime
 from multiprocessing import shared_memory
 
-from server.engine.task_queue_manager import (
-    TaskQueueManager,
-    launch_queue_service,
-)
+from server.engine.task_queue_manager import TaskQueueManager
 from server.engine.resource_manager import ResourceManager
+from server.engine.task_batch import TaskBatch
 from server.engine.token_processor import TokenProcessor, WarmUpTokenProcessor
 from server.utils import model_server_logger
 
@@ -54,9 +51,8 @@ class Engine(object):
         """
         assert not self.is_started, "The engine is already started.!"
         start_time = time.time()
-        # 启动队列进程（服务层与引擎层通信）服务
-        self.queue_service = self._start_tasks_queue_service()
-        self.tasks_queue = TaskQueueManager(mp_num=self.cfg.mp_num, port=self.cfg.infer_port)
+        # 创建服务层与引擎层通信的共享内存队列
+        self.tasks_queue = TaskQueueManager(mp_num=self.cfg.mp_num, port=self.cfg.infer_port, create=True)
 
         # 由于BeamSearch在后处理时依赖queue与infer.py进行通信
         # 此处将tasks_queue共享给TokenProcessor
@@ -112,12 +108,14 @@ class Engine(object):
         # 插入任务
         for x in res_task:
             while self.available_batch() == 0 or not self.insert_tasks([x]):
-                time.sleep(0.0002)
+                self.insert_prefill_chunks()
+                self.wait_for_update(timeout=0.01)
 
         self.token_processor._is_blocking = False
         # 等待所有数据推理结束
         while not self.all_tasks_finished():
-            time.sleep(1)
+            self.insert_prefill_chunks()
+            self.wait_for_update(timeout=1)
 
     def insert_tasks(self, tasks):
         """
@@ -129,7 +127,7 @@ class Engine(object):
         for item in tasks:
             item["schedule_start_time"] = datetime.now()
 
-        available_batch = np.sum(self.resource_manager.stop_flags)
+        available_batch = self.resource_manager.available_batch()
         if len(tasks) > available_batch:
             model_server_logger.error("Inserting batch:{} exceeds the available batch:{}.".format(
                 len(tasks), available_batch))
@@ -165,9 +163,76 @@ class Engine(object):
 
         req_ids = [t["req_id"] for t in tasks]
         model_server_logger.info(f"Tasks are sent to engine, req_ids={req_ids}")
-        self.tasks_queue.put((tasks, self.resource_manager.real_bsz))
+        self.tasks_queue.put(self._encode_tasks(tasks))
+        return True
+
+    def _encode_tasks(self, tasks):
+        """
+        按列编码新插入的任务，开启投机解码时随首个分块发送prefill_start之前的token
+        """
+        with_context = self.cfg.speculate_method != "none"
+        return TaskBatch.from_tasks(tasks, self.resource_manager.real_bsz, with_context=with_context).encode()
+
+    def insert_prefill_chunks(self):
+        """
+        下发上一分块已计算完成的分块prefill任务的下一个分块，返回是否有分块下发
+        """
+        tasks = self.resource_manager.allocate_resources_for_next_chunks()
+        if not tasks:
+            return False
+        self.tasks_queue.put(self._encode_tasks(tasks))
+        return True
+
+    def preempt_task(self, task=None):
+        """
+        抢占一个正在推理的任务，通知推理进程停止该位置，任务结束后由TokenProcessor回收资源并等待重新调度
+
+        Args:
+            task (dict): 等待插入的任务，不为None时只抢占优先级低于该任务的任务
+
+        Returns:
+            bool: 是否有任务被抢占
+        """
+        index = self.resource_manager.preempt(task)
+        if index is None:
+            return False
+        self.tasks_queue.put(TaskBatch.from_tasks([], self.resource_manager.real_bsz, stop_slots=[index]).encode())
         return True
 
+    def abort_tasks(self, req_ids):
+        """
+        取消正在推理的任务，通知推理进程停止对应位置，任务停止后由TokenProcessor回收资源并返回结束结果
+
+        Args:
+            req_ids (set): 需要取消的req_id
+
+        Returns:
+            list[dict]: 已回收资源、需要由调用方直接结束的任务
+        """
+        stop_slots, finished_tasks = self.resource_manager.abort(req_ids)
+        if stop_slots:
+            self.tasks_queue.put(
+                TaskBatch.from_tasks([], self.resource_manager.real_bsz, stop_slots=stop_slots).encode())
+        return finished_tasks + self.resource_manager.remove_pending_tasks(req_ids)
+
+    def pop_preempted_tasks(self):
+        """
+        取出等待重新调度的被抢占任务
+        """
+        return self.resource_manager.pop_preempted_tasks()
+
+    def pop_forked_tasks(self):
+        """
+        取出首个采样已完成prefill、可以调度的同一请求的其余采样
+        """
+        return self.resource_manager.pop_forked_tasks()
+
+    def has_block_step(self):
+        """
+        推理进程中是否有任务因解码block不足而暂停
+        """
+        return self.flag_has_block_step_array[0] > 0
+
     def task_is_finished(self, index):
         """
         判断相应位置的任务是否完成
@@ -181,17 +246,35 @@ class Engine(object):
         """
         return self.tasks_queue.empty()
 
-    def is_resource_sufficient(self, input_token_num):
+    def wait_for_queue_consumed(self, timeout):
         """
-        根据输入的token id长度，判断引擎资源是否充足
+        等待引擎队列中的任务被所有推理进程读取
         """
-        return self.resource_manager.is_resource_sufficient(input_token_num)
+        return self.tasks_queue.wait_for_consumed(timeout)
+
+    def notify_update(self):
+        """
+        通知插入线程有新的请求或资源变化
+        """
+        self.resource_manager.notify_update()
+
+    def wait_for_update(self, timeout):
+        """
+        等待新的请求或资源变化，替代sleep轮询
+        """
+        self.resource_manager.wait_for_update(timeout)
+
+    def is_resource_sufficient(self, input_token_num, max_dec_len=None, lora_key=0):
+        """
+        根据输入的token id长度、最大生成长度及使用的LoRA adapter，判断引擎资源是否充足
+        """
+        return self.resource_manager.is_resource_sufficient(input_token_num, max_dec_len, lora_key)
 
     def all_tasks_finished(self):
         """
         判断是否所有的引擎正在计算的任务已完成
         """
-        return np.sum(self.resource_manager.stop_flags) == len(self.resource_manager.stop_flags)
+        return self.resource_manager.available_batch() == len(self.resource_manager.stop_flags)
 
     def available_batch(self):
         """
@@ -245,6 +328,8 @@ class Engine(object):
             self.shm_flag_ready.unlink()
             self.shm_flag_has_block_step.close()
             self.shm_flag_has_block_step.unlink()
+            self.shm_flag_slot_error.close()
+            self.shm_flag_slot_error.unlink()
         except:
             pass
 
@@ -313,26 +398,34 @@ class Engine(object):
             buffer=self.shm_flag_has_block_step.buf)
         self.flag_has_block_step_array[:] = 0
 
+        # 推理进程插入任务失败的位置，由TokenProcessor回收资源并结束任务
+        slot_error_array = np.zeros([self.cfg.max_batch_size], dtype=np.int32)
+        try:
+            tmp = shared_memory.SharedMemory(
+                create=False,
+                size=slot_error_array.nbytes,
+                name=self.cfg.get_unique_name("shm_flag_slot_error"))
+            tmp.close()
+            tmp.unlink()
+        except:
+            pass
+        self.shm_flag_slot_error = shared_memory.SharedMemory(
+            create=True,
+            size=slot_error_array.nbytes,
+            name=self.cfg.get_unique_name("shm_flag_slot_error"))
+        self.flag_slot_error_array = np.ndarray(
+            slot_error_array.shape,
+            dtype=slot_error_array.dtype,
+            buffer=self.shm_flag_slot_error.buf)
+        self.flag_slot_error_array[:] = 0
+        self.resource_manager.slot_errors = self.flag_slot_error_array
+
     def _exit_sub_services(self):
-        if hasattr(self, "queue_service") and self.queue_service is not None:
-            self.queue_service.terminate()
-            self.queue_service.join()
+        if hasattr(self, "tasks_queue") and self.tasks_queue is not None:
+            self.tasks_queue.close()
         if hasattr(self, "infer_proc") and self.infer_proc is not None:
             os.killpg(self.infer_proc.pid, signal.SIGTERM)
 
-    def _start_tasks_queue_service(self):
-        p = multiprocessing.Process(target=launch_queue_service, args=(self.cfg.infer_port, self.cfg.mp_num))
-        p.start()
-        time.sleep(0.3)
-        if p.is_alive():
-            model_server_logger.info("start tasks queue service successfully")
-        else:
-            error_msg = "Failed to start tasks queue service, please check " \
-                        "the log/task_queue_manager.log for details"
-            model_server_logger.info(error_msg)
-            raise Exception(error_msg)
-        return p
-
     def _start_gpu_infer_service(self):
         """
         GPU模型推理进程启动
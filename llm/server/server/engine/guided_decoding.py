@@ -0,0 +1,839 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# 约束解码：将请求的正则表达式、JSON Schema或候选项编译为词表上的有限状态机，
+# 每个推理步按各位置的状态生成允许token的位掩码，由推理模型在采样前屏蔽其余token的logits
+# 1. 正则表达式按字节编译为DFA，非ASCII字符按UTF-8编码的字节序列匹配，JSON Schema与候选项先转换为正则表达式
+# 2. 以词表中每个token的字节序列在DFA上转移，得到每个状态允许的token、转移后的状态及打包的位掩码，
+#    所有状态与所有token的转移以numpy向量化计算
+# 3. 编译结果以请求参数与词表的哈希为key缓存在内存及磁盘中，推理进程按key从磁盘加载，不重复编译
+
+# 请求中约束解码的参数，只允许设置一个
+GUIDED_PARAMS = ("guided_json", "guided_regex", "guided_choice")
+# JSON中各元素之间允许的空白字符，限制长度避免模型持续生成空白
+JSON_WHITESPACE = r"[ ]?"
+JSON_STRING = r'"([^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*"'
+JSON_INTEGER = r"-?(0|[1-9][0-9]*)"
+JSON_NUMBER = r"-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?"
+JSON_MAX_REF_DEPTH = 8
+
+_ASCII_ALL = (1 << 128) - 1
+_DIGITS = sum(1 << c for c in range(ord("0"), ord("9") + 1))
+_WORDS = _DIGITS | (1 << ord("_")) | sum(1 << c for c in range(ord("a"), ord("z") + 1)) | \
+    sum(1 << c for c in range(ord("A"), ord("Z") + 1))
+_SPACES = sum(1 << ord(c) for c in " \t\n\r\f\v")
+_CLASS_ESCAPES = {"d": _DIGITS, "w": _WORDS, "s": _SPACES}
+_CHAR_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0"}
+# 非ASCII字符的UTF-8编码：首字节范围及后续字节数
+_UTF8_LEADS = ((0xC2, 0xDF, 1), (0xE0, 0xEF, 2), (0xF0, 0xF4, 3))
+_UTF8_CONTINUATION = sum(1 << b for b in range(0x80, 0xC0))
+
+
+def _byte_range(start, end):
+    return sum(1 << b for b in range(start, end + 1))
+
+
+class _RegexParser(object):
+    """
+    将正则表达式解析为语法树，支持字面量、字符类、`.`、分组、`|`及`* + ? {m,n}`量词，
+    不支持反向引用、零宽断言等无法由有限状态机表示的语法
+    语法树节点：("bytes", b"..."), ("char", ascii_mask, 是否匹配非ASCII字符), ("cat", [...]),
+    ("alt", [...]), ("repeat", node, min, max)，max为None表示不限
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.pos = 0
+
+    def parse(self):
+        # 约束解码总是匹配完整的输出，首尾的锚点可以忽略
+        if self.pattern.startswith("^"):
+            self.pos = 1
+        node = self._alternation()
+        if self.pos < len(self.pattern) and self.pattern[self.pos:] != "$":
+            raise ValueError(f"unexpected `{self.pattern[self.pos]}` at position {self.pos} of regex")
+        return node
+
+    def _peek(self):
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def _next(self):
+        if self.pos >= len(self.pattern):
+            raise ValueError("unexpected end of regex")
+        char = self.pattern[self.pos]
+        self.pos += 1
+        return char
+
+    def _alternation(self):
+        branches = [self._concat()]
+        while self._peek() == "|":
+            self.pos += 1
+            branches.append(self._concat())
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+    def _concat(self):
+        items = []
+        while True:
+            char = self._peek()
+            if char is None or char in "|)":
+                break
+            if char == "$" and self.pos == len(self.pattern) - 1:
+                break
+            items.append(self._quantified(self._atom()))
+        return items[0] if len(items) == 1 else ("cat", items)
+
+    def _quantified(self, node):
+        while True:
+            char = self._peek()
+            if char == "*":
+                node, self.pos = ("repeat", node, 0, None), self.pos + 1
+            elif char == "+":
+                node, self.pos = ("repeat", node, 1, None), self.pos + 1
+            elif char == "?":
+                node, self.pos = ("repeat", node, 0, 1), self.pos + 1
+            elif char == "{":
+                match = re.match(r"\{(\d*)(,?)(\d*)\}", self.pattern[self.pos:])
+                if match is None or match.group(0) == "{,}" or (match.group(1) == "" and match.group(2) == ""):
+                    return node
+                min_num = int(match.group(1) or 0)
+                max_num = min_num if not match.group(2) else (int(match.group(3)) if match.group(3) else None)
+                if max_num is not None and max_num < min_num:
+                    raise ValueError(f"invalid repeat range in regex: {match.group(0)}")
+                node, self.pos = ("repeat", node, min_num, max_num), self.pos + len(match.group(0))
+            else:
+                return node
+            # 非贪婪及占有量词不影响匹配的字符串集合
+            if self._peek() in ("?", "+"):
+                self.pos += 1
+
+    def _atom(self):
+        char = self._next()
+        if char == "(":
+            if self.pattern.startswith("?:", self.pos):
+                self.pos += 2
+            elif self.pattern.startswith("?P<", self.pos) or self.pattern.startswith("?<", self.pos):
+                if self.pattern.startswith("?<=", self.pos) or self.pattern.startswith("?<!", self.pos):
+                    raise ValueError("lookbehind is not supported in guided regex")
+                self.pos = self.pattern.index(">", self.pos) + 1
+            elif self._peek() == "?":
+                raise ValueError(f"group `(?{self.pattern[self.pos + 1:self.pos + 2]}` "
+                                 f"is not supported in guided regex")
+            node = self._alternation()
+            if self._next() != ")":
+                raise ValueError("missing `)` in regex")
+            return node
+        if char == "[":
+            return self._char_class()
+        if char == ".":
+            return ("char", _ASCII_ALL & ~(1 << ord("\n")), True)
+        if char == "\\":
+            return self._escape(in_class=False)
+        if char in "*+?":
+            raise ValueError(f"nothing to repeat at position {self.pos - 1} of regex")
+        return ("bytes", char.encode("utf-8"))
+
+    def _escape(self, in_class):
+        char = self._next()
+        if char in _CLASS_ESCAPES:
+            return ("char", _CLASS_ESCAPES[char], False)
+        if char.lower() in _CLASS_ESCAPES:
+            return ("char", _ASCII_ALL & ~_CLASS_ESCAPES[char.lower()], True)
+        if char in _CHAR_ESCAPES:
+            return ("bytes", _CHAR_ESCAPES[char].encode("utf-8"))
+        if char in "xu":
+            width = 2 if char == "x" else 4
+            digits = self.pattern[self.pos:self.pos + width]
+            if not re.fullmatch(r"[0-9a-fA-F]{%d}" % width, digits):
+                raise ValueError(f"invalid escape \\{char}{digits} in regex")
+            self.pos += width
+            return ("bytes", chr(int(digits, 16)).encode("utf-8"))
+        if char.isdigit() or (char in "bBAZzGkpP" and not in_class):
+            raise ValueError(f"escape \\{char} is not supported in guided regex")
+        return ("bytes", char.encode("utf-8"))
+
+    def _class_char(self):
+        """
+        字符类中的单个字符，返回其编码，或者\\d等转义对应的节点
+        """
+        char = self._next()
+        if char == "\\":
+            node = self._escape(in_class=True)
+            if node[0] == "char":
+                return node
+            char = node[1].decode("utf-8")
+        if ord(char) >= 128:
+            raise ValueError("only ASCII characters are supported in character class of guided regex")
+        return ord(char)
+
+    def _char_class(self):
+        negative = self._peek() == "^"
+        if negative:
+            self.pos += 1
+        mask, non_ascii = 0, False
+        first = True
+        while True:
+            if self._peek() == "]" and not first:
+                self.pos += 1
+                break
+            first = False
+            start = self._class_char()
+            if isinstance(start, tuple):
+                mask |= start[1]
+                non_ascii = non_ascii or start[2]
+                continue
+            if self._peek() == "-" and self.pos + 1 < len(self.pattern) and self.pattern[self.pos + 1] != "]":
+                self.pos += 1
+                end = self._class_char()
+                if isinstance(end, tuple) or end < start:
+                    raise ValueError("invalid range in character class of regex")
+                mask |= sum(1 << c for c in range(start, end + 1))
+            else:
+                mask |= 1 << start
+        if negative:
+            return ("char", _ASCII_ALL & ~mask, not non_ascii)
+        return ("char", mask, non_ascii)
+
+
+class _NFA(object):
+    """
+    Thompson构造的字节NFA，edges[s]为(字节集合的256位掩码, 目标状态)列表
+    """
+    def __init__(self):
+        self.eps = []
+        self.edges = []
+
+    def new_state(self):
+        self.eps.append([])
+        self.edges.append([])
+        return len(self.eps) - 1
+
+    def build(self, node):
+        """
+        构造语法树节点对应的片段，返回片段的起始与结束状态
+        """
+        kind = node[0]
+        start = self.new_state()
+        if kind == "bytes":
+            end = start
+            for byte in node[1]:
+                state = self.new_state()
+                self.edges[end].append((1 << byte, state))
+                end = state
+            return start, end
+        if kind == "char":
+            end = self.new_state()
+            if node[1]:
+                self.edges[start].append((node[1], end))
+            if node[2]:
+                for lead_start, lead_end, follow_num in _UTF8_LEADS:
+                    state = self.new_state()
+                    self.edges[start].append((_byte_range(lead_start, lead_end), state))
+                    for i in range(follow_num):
+                        target = end if i == follow_num - 1 else self.new_state()
+                        self.edges[state].append((_UTF8_CONTINUATION, target))
+                        state = target
+            return start, end
+        if kind == "cat":
+            end = start
+            for item in node[1]:
+                item_start, item_end = self.build(item)
+                self.eps[end].append(item_start)
+                end = item_end
+            return start, end
+        if kind == "alt":
+            end = self.new_state()
+            for item in node[1]:
+                item_start, item_end = self.build(item)
+                self.eps[start].append(item_start)
+                self.eps[item_end].append(end)
+            return start, end
+        # repeat：必需的部分逐个展开，可选部分不限次数时为循环，否则逐个展开为可跳过的片段
+        _, item, min_num, max_num = node
+        end = start
+        for _ in range(min_num):
+            item_start, item_end = self.build(item)
+            self.eps[end].append(item_start)
+            end = item_end
+        if max_num is None:
+            item_start, item_end = self.build(item)
+            loop_end = self.new_state()
+            self.eps[end].extend([item_start, loop_end])
+            self.eps[item_end].extend([item_start, loop_end])
+            return start, loop_end
+        final = self.new_state()
+        for _ in range(max_num - min_num):
+            item_start, item_end = self.build(item)
+            self.eps[end].extend([item_start, final])
+            end = item_end
+        self.eps[end].append(final)
+        return start, final
+
+
+class ByteDFA(object):
+    """
+    由正则表达式编译的字节DFA，只保留能到达接受状态的状态，状态0为初始状态
+
+    Attributes:
+        byte_classes (np.ndarray): 每个字节所属的等价类，shape为[256]
+        transitions (np.ndarray): 各状态在各等价类上转移到的状态，-1表示无法继续匹配，shape为[状态数, 等价类数]
+        accepting (np.ndarray): 各状态是否为接受状态
+    """
+    def __init__(self, byte_classes, transitions, accepting):
+        self.byte_classes = byte_classes
+        self.transitions = transitions
+        self.accepting = accepting
+
+    @property
+    def state_num(self):
+        return len(self.accepting)
+
+    @classmethod
+    def from_regex(cls, pattern, max_states=2000):
+        nfa = _NFA()
+        start, final = nfa.build(_RegexParser(pattern).parse())
+
+        # 按NFA中出现的字节集合将256个字节划分为等价类，同一类的字节转移完全相同
+        masks = sorted(set(mask for edges in nfa.edges for mask, _ in edges))
+        signatures = {}
+        byte_classes = np.zeros([256], dtype=np.int32)
+        for byte in range(256):
+            signature = tuple((mask >> byte) & 1 for mask in masks)
+            byte_classes[byte] = signatures.setdefault(signature, len(signatures))
+        class_bytes = [0] * len(signatures)
+        for byte in range(255, -1, -1):
+            class_bytes[byte_classes[byte]] = byte
+
+        closures = {}
+
+        def _closure(states):
+            key = frozenset(states)
+            if key not in closures:
+                result, stack = set(key), list(key)
+                while stack:
+                    for target in nfa.eps[stack.pop()]:
+                        if target not in result:
+                            result.add(target)
+                            stack.append(target)
+                closures[key] = frozenset(result)
+            return closures[key]
+
+        # 子集构造
+        initial = _closure([start])
+        state_ids = {initial: 0}
+        state_sets = [initial]
+        transitions = []
+        while len(transitions) < len(state_sets):
+            current = state_sets[len(transitions)]
+            edges = [edge for state in current for edge in nfa.edges[state]]
+            row = []
+            for byte in class_bytes:
+                targets = [target for mask, target in edges if (mask >> byte) & 1]
+                if not targets:
+                    row.append(-1)
+                    continue
+                target_set = _closure(targets)
+                if target_set not in state_ids:
+                    if len(state_sets) >= max_states:
+                        raise ValueError(f"guided regex is too complex, the number of DFA states "
+                                         f"exceeds {max_states}")
+                    state_ids[target_set] = len(state_sets)
+                    state_sets.append(target_set)
+                row.append(state_ids[target_set])
+            transitions.append(row)
+        transitions = np.asarray(transitions, dtype=np.int32).reshape([len(state_sets), len(class_bytes)])
+        accepting = np.asarray([final in state_set for state_set in state_sets], dtype=bool)
+
+        # 去掉无法到达接受状态的状态，匹配进入这些状态时即可判定失败
+        live = accepting.copy()
+        while True:
+            reach = live | np.any((transitions >= 0) & live[np.maximum(transitions, 0)], axis=1)
+            if np.array_equal(reach, live):
+                break
+            live = reach
+        if not live[0]:
+            raise ValueError("guided regex can not match any string")
+        new_ids = np.full([len(live) + 1], -1, dtype=np.int32)
+        new_ids[:-1][live] = np.arange(int(live.sum()), dtype=np.int32)
+        transitions = new_ids[transitions[live]]
+        return cls(byte_classes, transitions, accepting[live])
+
+
+def regex_escape(text):
+    """
+    转义字符串，使其在正则表达式中按字面匹配
+    """
+    return "".join("\\" + char if char in r"\.^$|?*+()[]{}-" else char for char in text)
+
+
+def choice_to_regex(choices):
+    """
+    候选项转换为正则表达式，输出必须为其中之一
+    """
+    return "(" + "|".join(regex_escape(str(choice)) for choice in choices) + ")"
+
+
+def json_schema_to_regex(schema, root=None, depth=0):
+    """
+    将JSON Schema转换为匹配其紧凑序列化结果的正则表达式，对象的属性按Schema中的顺序输出
+    支持type、properties、required、items、minItems、maxItems、enum、const、anyOf、oneOf、
+    字符串的minLength、maxLength、pattern，以及#/$defs和#/definitions中的非递归引用
+    """
+    root = schema if root is None else root
+    if not isinstance(schema, dict):
+        raise ValueError(f"invalid json schema: {schema}")
+    if "$ref" in schema:
+        ref = schema["$ref"]
+        match = re.fullmatch(r"#/(\$defs|definitions)/(.+)", ref)
+        if match is None or match.group(2) not in root.get(match.group(1), {}):
+            raise ValueError(f"unsupported $ref in json schema: {ref}")
+        if depth >= JSON_MAX_REF_DEPTH:
+            raise ValueError(f"recursive $ref in json schema is not supported: {ref}")
+        return json_schema_to_regex(root[match.group(1)][match.group(2)], root, depth + 1)
+    if "const" in schema:
+        return regex_escape(json.dumps(schema["const"], ensure_ascii=False, separators=(",", ":")))
+    if "enum" in schema:
+        return "(" + "|".join(regex_escape(json.dumps(value, ensure_ascii=False, separators=(",", ":")))
+                              for value in schema["enum"]) + ")"
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            return "(" + "|".join(json_schema_to_regex(item, root, depth) for item in schema[key]) + ")"
+
+    schema_type = schema.get("type")
+    if isinstance(schema_type, list):
+        return "(" + "|".join(json_schema_to_regex(dict(schema, type=item), root, depth)
+                              for item in schema_type) + ")"
+    if schema_type is None and "properties" in schema:
+        schema_type = "object"
+    if schema_type == "object":
+        return _json_object_regex(schema, root, depth)
+    if schema_type == "array":
+        item = json_schema_to_regex(schema.get("items", {"type": "string"}), root, depth)
+        min_items = int(schema.get("minItems", 0))
+        max_items = schema.get("maxItems")
+        if max_items is not None and int(max_items) == 0:
+            return rf"\[{JSON_WHITESPACE}\]"
+        rest_max = "" if max_items is None else str(int(max_items) - 1)
+        items = f"{item}({JSON_WHITESPACE},{JSON_WHITESPACE}{item}){{{max(min_items - 1, 0)},{rest_max}}}"
+        if min_items == 0:
+            items = f"({items})?"
+        return rf"\[{JSON_WHITESPACE}{items}{JSON_WHITESPACE}\]"
+    if schema_type == "string":
+        if "pattern" in schema:
+            pattern = schema["pattern"]
+            pattern = pattern[1:] if pattern.startswith("^") else pattern
+            pattern = pattern[:-1] if pattern.endswith("$") and not pattern.endswith("\\$") else pattern
+            return f'"({pattern})"'
+        if "minLength" in schema or "maxLength" in schema:
+            max_length = schema.get("maxLength")
+            char = JSON_STRING[1:-2]
+            return f'"{char}{{{int(schema.get("minLength", 0))},{"" if max_length is None else int(max_length)}}}"'
+        return JSON_STRING
+    if schema_type == "integer":
+        return JSON_INTEGER
+    if schema_type == "number":
+        return JSON_NUMBER
+    if schema_type == "boolean":
+        return "(true|false)"
+    if schema_type == "null":
+        return "null"
+    raise ValueError(f"unsupported json schema: {json.dumps(schema, ensure_ascii=False)}")
+
+
+def _json_object_regex(schema, root, depth):
+    properties = schema.get("properties", {})
+    required = set(schema.get("required", []))
+    items = []
+    for name, sub_schema in properties.items():
+        key = regex_escape(json.dumps(name, ensure_ascii=False))
+        value = json_schema_to_regex(sub_schema, root, depth)
+        items.append((f"{key}{JSON_WHITESPACE}:{JSON_WHITESPACE}{value}", name in required))
+
+    separator = f"{JSON_WHITESPACE},{JSON_WHITESPACE}"
+
+    def _rest(index):
+        # 已经输出了至少一个属性，其后的属性均以逗号开头
+        return "".join(f"{separator}{item}" if is_required else f"({separator}{item})?"
+                       for item, is_required in items[index:])
+
+    def _first(index):
+        # 尚未输出任何属性，第index个属性可能是第一个输出的属性
+        if index == len(items):
+            return ""
+        item, is_required = items[index]
+        if is_required:
+            return item + _rest(index + 1)
+        rest = _first(index + 1)
+        return f"({item}{_rest(index + 1)}|{rest})" if rest else f"({item})?"
+
+    body = _first(0)
+    if body and all(not is_required for _, is_required in items):
+        body = f"({body})?"
+    return rf"\{{{JSON_WHITESPACE}{body}{JSON_WHITESPACE}\}}"
+
+
+def get_guided_spec(req_dict):
+    """
+    取出请求中的约束解码参数
+
+    Returns:
+        tuple: (类型, 参数)，类型为json、regex或choice，请求不使用约束解码时返回None
+    """
+    for key in GUIDED_PARAMS:
+        value = req_dict.get(key)
+        if value is None:
+            continue
+        if key == "guided_json" and isinstance(value, str):
+            value = json.loads(value)
+        return key[len("guided_"):], value
+    return None
+
+
+def spec_to_regex(spec):
+    """
+    约束解码参数转换为正则表达式
+    """
+    kind, value = spec
+    if kind == "json":
+        return json_schema_to_regex(value)
+    if kind == "choice":
+        return choice_to_regex(value)
+    return value
+
+
+def _bytes_to_unicode():
+    """
+    byte-level BPE词表中字节与可见字符的对应关系
+    """
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + \
+        list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return dict(zip(bs, [chr(c) for c in cs]))
+
+
+def get_token_bytes(tokenizer):
+    """
+    获取词表中每个token解码后的字节，特殊token为None，不参与约束解码
+
+    Returns:
+        list[bytes]: 按token id索引
+    """
+    vocab = tokenizer.get_vocab()
+    special_ids = set(getattr(tokenizer, "all_special_ids", []) or [])
+    byte_decoder = getattr(tokenizer, "byte_decoder", None)
+    if byte_decoder is None and any(token.startswith("Ġ") for token in vocab):
+        byte_decoder = {char: byte for byte, char in _bytes_to_unicode().items()}
+    token_bytes = [None] * (max(vocab.values()) + 1 if vocab else 0)
+    for token, token_id in vocab.items():
+        if token_id in special_ids:
+            continue
+        match = re.fullmatch(r"<0x([0-9A-Fa-f]{2})>", token)
+        if match is not None:
+            token_bytes[token_id] = bytes([int(match.group(1), 16)])
+        elif byte_decoder is not None and all(char in byte_decoder for char in token):
+            token_bytes[token_id] = bytes(byte_decoder[char] for char in token)
+        else:
+            token_bytes[token_id] = token.replace("▁", " ").encode("utf-8")
+    return token_bytes
+
+
+class TokenVocab(object):
+    """
+    词表中各token的字节矩阵，按token长度从长到短排列，
+    在DFA上转移时第j个字节只需计算前active_nums[j]个token
+    """
+    def __init__(self, token_bytes, vocab_size):
+        self.vocab_size = vocab_size
+        # 模型的词表大小可能大于tokenizer的词表，多出的token长度为0，不允许生成
+        lens = np.zeros([vocab_size], dtype=np.int64)
+        lens[:min(len(token_bytes), vocab_size)] = [len(b) if b else 0 for b in token_bytes[:vocab_size]]
+        self.lens_by_id = lens
+        self.order = np.argsort(-lens, kind="stable")
+        self.lens = lens[self.order]
+        max_len = int(self.lens[0]) if len(self.lens) else 0
+        self.byte_matrix = np.zeros([len(self.lens), max_len], dtype=np.uint8)
+        for row, token_id in enumerate(self.order[:int(np.count_nonzero(self.lens))]):
+            self.byte_matrix[row, :self.lens[row]] = np.frombuffer(token_bytes[token_id], dtype=np.uint8)
+        self.active_nums = [int(np.count_nonzero(self.lens > j)) for j in range(max_len)]
+        self.digest = hashlib.sha256(b"\xff".join(b or b"" for b in token_bytes[:vocab_size])).hexdigest()
+
+
+class TokenFSM(object):
+    """
+    词表上的有限状态机
+
+    Attributes:
+        masks (np.ndarray): 各状态允许的token位掩码，第t个token对应第t//32个int32的第t%32位，shape为[状态数, 字数]
+        offsets (np.ndarray): 各状态允许的token在tokens中的起止位置，shape为[状态数+1]
+        tokens (np.ndarray): 各状态允许的token，按id从小到大排列
+        next_states (np.ndarray): 生成对应token后转移到的状态
+        eos_token_ids (np.ndarray): 结束符，生成结束符后状态不变
+    """
+    def __init__(self, masks, offsets, tokens, next_states, eos_token_ids):
+        self.masks = masks
+        self.offsets = offsets
+        self.tokens = tokens
+        self.next_states = next_states
+        self.eos_token_ids = eos_token_ids
+
+    @classmethod
+    def compile(cls, dfa, vocab, eos_token_ids):
+        state_num = dfa.state_num
+        dead = state_num
+        transitions = np.full([state_num + 1, dfa.transitions.shape[1]], dead, dtype=np.int32)
+        transitions[:state_num] = np.where(dfa.transitions >= 0, dfa.transitions, dead)
+        eos_token_ids = np.asarray(eos_token_ids, dtype=np.int64)
+        eos_token_ids = eos_token_ids[(eos_token_ids >= 0) & (eos_token_ids < vocab.vocab_size)]
+
+        # 所有状态同时以所有token的字节序列转移，按状态分块限制中间结果的内存
+        chunk = max(1, (1 << 22) // vocab.vocab_size)
+        masks, counts, tokens, next_states = [], [], [], []
+        for chunk_start in range(0, state_num, chunk):
+            states = np.arange(chunk_start, min(chunk_start + chunk, state_num), dtype=np.int32)
+            current = np.repeat(states[:, None], vocab.vocab_size, axis=1)
+            for j, active_num in enumerate(vocab.active_nums):
+                classes = dfa.byte_classes[vocab.byte_matrix[:active_num, j]]
+                current[:, :active_num] = transitions[current[:, :active_num], classes]
+            # 从按长度排列恢复为按token id排列
+            chunk_next_states = np.empty_like(current)
+            chunk_next_states[:, vocab.order] = current
+            allowed = (chunk_next_states != dead) & (vocab.lens_by_id > 0)
+            allowed[:, eos_token_ids] = False
+            state_ids, token_ids = np.nonzero(allowed)
+            counts.append(np.bincount(state_ids, minlength=len(states)))
+            tokens.append(token_ids.astype(np.int32))
+            next_states.append(chunk_next_states[state_ids, token_ids])
+            # 接受状态允许结束，无法继续生成任何token的状态也只能结束
+            eos_allowed = dfa.accepting[states] | ~allowed.any(axis=1)
+            allowed[np.ix_(np.flatnonzero(eos_allowed), eos_token_ids)] = True
+            masks.append(pack_token_mask(allowed))
+        offsets = np.zeros([state_num + 1], dtype=np.int64)
+        offsets[1:] = np.cumsum(np.concatenate(counts))
+        return cls(np.concatenate(masks), offsets, np.concatenate(tokens), np.concatenate(next_states),
+                   eos_token_ids)
+
+    @property
+    def state_num(self):
+        return len(self.offsets) - 1
+
+    def next_state(self, state, token_id):
+        """
+        生成token后的状态，生成结束符或不允许的token时状态不变
+        """
+        start, end = self.offsets[state], self.offsets[state + 1]
+        index = start + np.searchsorted(self.tokens[start:end], token_id)
+        if index < end and self.tokens[index] == token_id:
+            return int(self.next_states[index])
+        return state
+
+    def is_allowed(self, state, token_id):
+        return bool((self.masks[state, token_id // 32] >> (token_id % 32)) & 1)
+
+    def save(self, path):
+        # 先写入临时文件再重命名，多个进程同时写入或读取时不会读到不完整的文件
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, masks=self.masks, offsets=self.offsets, tokens=self.tokens,
+                     next_states=self.next_states, eos_token_ids=self.eos_token_ids)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["masks"], data["offsets"], data["tokens"], data["next_states"], data["eos_token_ids"])
+
+
+def pack_token_mask(allowed):
+    """
+    将bool掩码按每32个token打包为一个int32，第t个token对应第t//32个int32的第t%32位
+    """
+    state_num, vocab_size = allowed.shape
+    word_num = (vocab_size + 31) // 32
+    padded = np.zeros([state_num, word_num * 32], dtype=bool)
+    padded[:, :vocab_size] = allowed
+    packed = np.packbits(padded, axis=1, bitorder="little")
+    return packed.view("<i4").astype(np.int32).reshape([state_num, word_num])
+
+
+class TokenFSMCache(object):
+    """
+    编译结果的LRU缓存，不在内存中时从磁盘加载，编译进程与推理进程通过磁盘上的文件共享编译结果
+    """
+    def __init__(self, cache_dir, capacity):
+        self.cache_dir = cache_dir
+        self.capacity = capacity
+        self.fsms = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key:016x}.npz")
+
+    def get(self, key):
+        with self.lock:
+            fsm = self.fsms.get(key)
+            if fsm is not None:
+                self.fsms.move_to_end(key)
+                return fsm
+        if not os.path.exists(self.path(key)):
+            return None
+        fsm = TokenFSM.load(self.path(key))
+        self._put_memory(key, fsm)
+        return fsm
+
+    def put(self, key, fsm):
+        if not os.path.exists(self.path(key)):
+            fsm.save(self.path(key))
+        self._put_memory(key, fsm)
+
+    def ensure_saved(self, key):
+        """
+        确认编译结果在磁盘上，供推理进程加载，文件被删除而内存中仍有时重新保存
+
+        Returns:
+            bool: 编译结果是否可用
+        """
+        if os.path.exists(self.path(key)):
+            return True
+        with self.lock:
+            fsm = self.fsms.get(key)
+        if fsm is None:
+            return False
+        fsm.save(self.path(key))
+        return True
+
+    def _put_memory(self, key, fsm):
+        with self.lock:
+            self.fsms[key] = fsm
+            self.fsms.move_to_end(key)
+            while len(self.fsms) > self.capacity:
+                self.fsms.popitem(last=False)
+
+
+class GuidedDecodingCompiler(object):
+    """
+    在请求预处理线程中编译约束解码参数，返回编译结果的key，由推理进程按key加载
+    """
+    def __init__(self, cache_dir, cache_size, vocab_size, max_states):
+        self.cache = TokenFSMCache(cache_dir, cache_size)
+        self.vocab_size = vocab_size
+        self.max_states = max_states
+        self.vocab = None
+        self.lock = threading.Lock()
+
+    def _get_vocab(self, tokenizer):
+        with self.lock:
+            if self.vocab is None:
+                self.vocab = TokenVocab(get_token_bytes(tokenizer), self.vocab_size)
+            return self.vocab
+
+    def compile(self, spec, tokenizer, eos_token_ids):
+        """
+        编译约束解码参数，已编译过的参数直接返回缓存的key
+
+        Args:
+            spec (tuple): get_guided_spec返回的(类型, 参数)
+            tokenizer: 用于获取词表中各token的字节
+            eos_token_ids (list[int]): 结束符
+
+        Returns:
+            int: 编译结果的key，为正的int64
+        """
+        vocab = self._get_vocab(tokenizer)
+        content = json.dumps([spec[0], spec[1], sorted(eos_token_ids), vocab.digest],
+                             ensure_ascii=False, sort_keys=True)
+        key = int(hashlib.sha256(content.encode("utf-8")).hexdigest()[:15], 16) + 1
+        if self.cache.get(key) is None:
+            dfa = ByteDFA.from_regex(spec_to_regex(spec), self.max_states)
+            self.cache.put(key, TokenFSM.compile(dfa, vocab, eos_token_ids))
+        return key
+
+    def get_state(self, key, token_ids):
+        """
+        从初始状态依次生成token_ids后的状态，用于被抢占的任务恢复时重建状态
+        """
+        fsm = self.cache.get(key)
+        if fsm is None:
+            raise ValueError(f"guided decoding fsm {key:016x} is not found in {self.cache.cache_dir}")
+        state = 0
+        for token_id in token_ids:
+            state = fsm.next_state(state, int(token_id))
+        return state
+
+
+class GuidedDecodingMasker(object):
+    """
+    推理进程中维护各位置的状态机及当前状态，每个推理步后以生成的token更新状态，并生成整批的token位掩码
+    """
+    def __init__(self, cache, max_batch_size, vocab_size):
+        self.cache = cache
+        self.word_num = (vocab_size + 31) // 32
+        self.fsms = [None] * max_batch_size
+        self.states = np.zeros([max_batch_size], dtype=np.int64)
+
+    def reset(self, slot, key, state=0):
+        """
+        插入任务时设置位置的状态机，key为0表示不使用约束解码
+        """
+        fsm = None
+        if key > 0:
+            fsm = self.cache.get(key)
+            if fsm is None:
+                raise ValueError(f"guided decoding fsm {key:016x} is not found in {self.cache.cache_dir}")
+            if fsm.masks.shape[1] != self.word_num:
+                raise ValueError(f"vocab size of guided decoding fsm {key:016x} does not match the model")
+        self.fsms[slot] = fsm
+        self.states[slot] = state
+
+    def guided_slots(self, real_bsz):
+        return np.asarray([i for i in range(real_bsz) if self.fsms[i] is not None], dtype=np.int64)
+
+    def advance(self, slots, token_ids):
+        """
+        各位置生成token后更新状态
+        """
+        for slot, token_id in zip(slots, token_ids):
+            self.states[slot] = self.fsms[slot].next_state(self.states[slot], int(token_id))
+
+    def get_masks(self, slots):
+        """
+        获取位置的token位掩码，同一状态机的位置一次取出，不使用约束解码的位置允许所有token
+
+        Returns:
+            np.ndarray: shape为[len(slots), 字数]的int32
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        masks = np.full([len(slots), self.word_num], -1, dtype=np.int32)
+        groups = {}
+        for row, slot in enumerate(slots):
+            if self.fsms[slot] is not None:
+                groups.setdefault(id(self.fsms[slot]), []).append(row)
+        for rows in groups.values():
+            rows = np.asarray(rows, dtype=np.int64)
+            fsm = self.fsms[slots[rows[0]]]
+            masks[rows] = fsm.masks[self.states[slots[rows]]]
+        return masks
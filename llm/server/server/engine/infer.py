@@ -30,6 +30,11 @@ from paddlenlp.utils.llm_utils import get_rotary_position_embedding
 
 from server.utils import get_logger
 from server.engine.config import Config
+from server.engine.guided_decoding import GuidedDecodingMasker, TokenFSMCache
+from server.engine.kv_transport import create_kv_transport
+from server.engine.lora import LoraWeightCache, get_target_module_shapes
+from server.engine.speculate import SpeculateDrafter, create_proposer
+from server.engine.task_batch import SLOT_ERROR_GUIDED_FSM, SLOT_ERROR_KV_TRANSFER, SLOT_ERROR_LORA, TaskBatch
 from task_queue_manager import TaskQueueManager
 from server.data.processor import DataProcessor
 
@@ -62,6 +67,33 @@ class ModelRunner:
         self.cache_kvs = {}
         self.init_inputs()
 
+        # 投机解码时在host端为各位置维护上下文，每个推理步后生成下一步的草稿token
+        proposer = create_proposer(self.config)
+        self.drafter = None
+        if proposer is not None:
+            self.drafter = SpeculateDrafter(proposer, self.args.max_batch_size,
+                                            self.args.max_seq_len + self.args.max_dec_len)
+        # 约束解码时在host端维护各位置的状态机状态，每个推理步后生成下一步允许token的位掩码
+        self.guided_masker = None
+        if self.config.enable_guided_decoding:
+            self.guided_masker = GuidedDecodingMasker(
+                TokenFSMCache(self.config.guided_decoding_cache_dir, self.config.guided_decoding_cache_size),
+                self.args.max_batch_size, self.model_cfg["vocab_size"])
+            # 各位置已更新状态的step_idx，未增加的位置本步没有生成token
+            self.guided_steps = np.zeros([self.args.max_batch_size], dtype=np.int64)
+        # 开启LoRA时在内存中缓存adapter权重，任务插入时将其adapter拷贝到引擎分配的显存位置
+        self.lora_weight_cache = None
+        if self.config.enable_lora:
+            self.lora_weight_cache = LoraWeightCache(
+                self.config.lora_adapter_dir, self.config.max_cpu_loras, self.args.num_layers,
+                self.lora_module_shapes, self.config.lora_max_rank, self.rank, self.nranks)
+            # 各显存位置当前存放的adapter的key
+            self.lora_slot_keys = [0] * self.config.max_loras
+        # prefill与decode分离时，prefill实例在prompt计算完成后发送KV，decode实例在插入任务时接收KV
+        self.kv_transport = create_kv_transport(self.config)
+        # 本步prefill完成后待发送的KV：(key, block id, token数)
+        self.pending_kv_exports = []
+
         self.infer_queue = TaskQueueManager(rank=self.rank, mp_num=self.nranks, port=self.config.infer_port)
 
         model_rank_path = os.path.join(self.args.model_dir, f"rank_{self.rank}")
@@ -264,48 +296,259 @@ class ModelRunner:
         self.share_inputs['free_list_len'] = paddle.full(shape=[1],
                                                     fill_value=self.free_list_len,
                                                     dtype="int32")
+        if self.config.speculate_method != "none":
+            # 每个位置一步输入上一个token及草稿token，输出本步接受的token
+            max_tokens_per_step = self.config.speculate_max_draft_tokens + 1
+            self.share_inputs['draft_tokens'] = paddle.full(shape=[self.args.max_batch_size, max_tokens_per_step],
+                                                            fill_value=-1,
+                                                            dtype="int64")
+            self.share_inputs['accept_tokens'] = paddle.full(shape=[self.args.max_batch_size, max_tokens_per_step],
+                                                             fill_value=-1,
+                                                             dtype="int64")
+            self.share_inputs['accept_num'] = paddle.full(shape=[self.args.max_batch_size],
+                                                          fill_value=0,
+                                                          dtype="int32")
+            self.share_inputs['actual_draft_token_num'] = paddle.full(shape=[self.args.max_batch_size],
+                                                                      fill_value=self.config.speculate_max_draft_tokens,
+                                                                      dtype="int32")
+        if self.config.enable_guided_decoding:
+            # 约束解码的token位掩码，第t个token对应第t//32个int32的第t%32位，为0的token在采样前被屏蔽
+            self.share_inputs['allowed_token_mask'] = paddle.full(
+                shape=[self.args.max_batch_size, (self.model_cfg["vocab_size"] + 31) // 32],
+                fill_value=-1,
+                dtype="int32")
+        if self.config.enable_lora:
+            # 各目标层每个显存位置的adapter权重，目标层的输出叠加x·A·B，B已合入缩放系数，
+            # lora_slots为各位置使用的adapter位置，-1表示不使用adapter
+            self.lora_module_shapes = get_target_module_shapes(
+                self.model_cfg, self.config.lora_target_modules, self.nranks)
+            for module, (in_dim, out_dim) in self.lora_module_shapes.items():
+                self.share_inputs[f'lora_a_{module}'] = paddle.full(
+                    shape=[self.config.max_loras, self.args.num_layers, in_dim, self.config.lora_max_rank],
+                    fill_value=0,
+                    dtype=self.args.dtype)
+                self.share_inputs[f'lora_b_{module}'] = paddle.full(
+                    shape=[self.config.max_loras, self.args.num_layers, self.config.lora_max_rank, out_dim],
+                    fill_value=0,
+                    dtype=self.args.dtype)
+            self.share_inputs['lora_slots'] = paddle.full(shape=[self.args.max_batch_size],
+                                                          fill_value=-1,
+                                                          dtype="int32")
+
+    def dy_input_preprocess(self, task_batch):
+        """
+        动态插入部分额外处理，在host端按列组装整批任务的参数，每个Tensor只做一次拷贝
+        """
+        if len(task_batch.stop_slots) > 0:
+            # 将最大生成长度置0，推理时按达到最大长度停止，并输出结束符通知引擎
+            self._scatter_rows('max_length', task_batch.stop_slots,
+                               np.zeros([len(task_batch.stop_slots)], dtype="int64"))
+        task_num = len(task_batch)
+        if task_num == 0:
+            return
+        slots = task_batch.column('idx')
+        # prefill_start之前的token（命中前缀缓存或已完成的prefill分块）KV Cache已在block中，无需重复计算
+        token_num = task_batch.column('token_num')
+        max_dec_len = task_batch.column('max_dec_len')
+        max_dec_len = np.where(max_dec_len < 0, self.args.max_dec_len, max_dec_len)
+
+        # eos token为所有位置共享，与逐个写入时一致，以最后一个任务为准
+        eos_token_ids = task_batch.get_eos_token_ids(task_num - 1)
+        if len(eos_token_ids) < self.eos_tokens_lens:
+            eos_token_ids = np.append(eos_token_ids, eos_token_ids[0])
+        self.share_inputs['eos_token_id'][:] = eos_token_ids.reshape(-1, 1)
+
+        self._scatter_rows('input_ids', slots,
+                           task_batch.padded_token_ids(self.args.max_seq_len, self.pad_token_id))
+        self._scatter_rows('pre_ids', slots, np.full([task_num, self.args.max_dec_len], -1, dtype="int64"))
+        self._scatter_rows('top_p', slots, task_batch.column('topp'))
+        self._scatter_rows('temperature', slots, task_batch.column('temperature'))
+        self._scatter_rows('penalty_score', slots, task_batch.column('penalty_score'))
+        self._scatter_rows('frequency_score', slots, task_batch.column('frequency_score'))
+        self._scatter_rows('presence_score', slots, task_batch.column('presence_score'))
+        self._scatter_rows('seq_lens_this_time', slots, token_num)
+        self._scatter_rows('step_seq_lens_encoder', slots, token_num)
+        self._scatter_rows('seq_lens_encoder', slots, token_num)
+        self._scatter_rows('seq_lens_decoder', slots, task_batch.column('prefill_start'))
+        self._scatter_rows('step_idx', slots, np.zeros([task_num], dtype="int64"))
+        self._scatter_rows('min_length', slots, task_batch.column('min_dec_len'))
+        self._scatter_rows('max_length', slots, max_dec_len)
+        self._scatter_rows('stop_flags', slots, np.zeros([task_num], dtype="bool"))
+        self._scatter_rows('infer_seed', slots, task_batch.column('infer_seed'))
+        self._scatter_rows('encoder_block_lens', slots, task_batch.column('block_num'))
+        self._scatter_rows('block_tables', slots,
+                           task_batch.padded_block_tables(self.share_inputs['block_tables'].shape[1]))
+        if self.drafter is not None:
+            # 首个分块以完整的输入初始化上下文，后续分块接在之前的分块之后
+            context_start = task_batch.column('prefill_start') - task_batch.column('context_num')
+            for i, slot in enumerate(slots):
+                token_ids = np.concatenate([task_batch.get_context_token_ids(i), task_batch.get_token_ids(i)])
+                self.drafter.reset(int(slot), token_ids, int(context_start[i]))
+        if self.guided_masker is not None:
+            guided_fsm = task_batch.column('guided_fsm')
+            guided_state = task_batch.column('guided_state')
+            for i, slot in enumerate(slots):
+                try:
+                    self.guided_masker.reset(int(slot), int(guided_fsm[i]), int(guided_state[i]))
+                except Exception as e:
+                    # 状态机文件被删除等原因加载失败时不使用约束解码，并停止该位置
+                    logger.error(f"rank: {self.rank} failed to load guided decoding fsm of slot {slot}: {e}")
+                    self.guided_masker.reset(int(slot), 0)
+                    self.slot_errors[slot] = SLOT_ERROR_GUIDED_FSM
+                self.guided_steps[slot] = 0
+            self._scatter_rows('allowed_token_mask', slots, self.guided_masker.get_masks(slots))
+        if self.lora_weight_cache is not None:
+            self.load_lora_adapters(slots, task_batch.column('lora_key'), task_batch.column('lora_slot'))
+            self._scatter_rows('lora_slots', slots, task_batch.column('lora_slot'))
+        if self.kv_transport is not None:
+            kv_transfer_key = task_batch.column('kv_transfer_key')
+            prefill_start = task_batch.column('prefill_start')
+            for i in np.flatnonzero(kv_transfer_key):
+                block_tables = task_batch.get_block_tables(i)
+                if self.config.engine_role == "prefill":
+                    prompt_token_num = int(prefill_start[i] + token_num[i])
+                    block_num = (prompt_token_num + self.args.block_size - 1) // self.args.block_size
+                    self.pending_kv_exports.append((int(kv_transfer_key[i]), block_tables[:block_num], prompt_token_num))
+                else:
+                    try:
+                        self.import_kv(int(kv_transfer_key[i]), block_tables, int(prefill_start[i]))
+                    except Exception as e:
+                        # 停止该位置，由引擎重新计算prompt
+                        logger.error(f"rank: {self.rank} failed to import kv of slot {slots[i]}: {e}")
+                        self.slot_errors[slots[i]] = SLOT_ERROR_KV_TRANSFER
+
+    def stop_failed_slots(self):
+        """
+        停止插入失败的位置，各rank在barrier后按共享内存中的错误码一致地停止，
+        推理时按达到最大长度停止并输出结束符，由引擎回收资源并结束任务
+        """
+        failed_slots = np.flatnonzero(self.slot_errors)
+        if len(failed_slots) == 0:
+            return
+        self._scatter_rows('max_length', failed_slots, np.zeros([len(failed_slots)], dtype="int64"))
+        if self.guided_masker is not None:
+            for slot in failed_slots:
+                self.guided_masker.reset(int(slot), 0)
+            self._scatter_rows('allowed_token_mask', failed_slots, self.guided_masker.get_masks(failed_slots))
+        if self.lora_weight_cache is not None:
+            self._scatter_rows('lora_slots', failed_slots, np.full([len(failed_slots)], -1, dtype="int32"))
+        logger.info(f"rank: {self.rank} stop failed slots: {failed_slots.tolist()}")
+
+    def load_lora_adapters(self, slots, lora_keys, lora_slots):
+        """
+        将新任务使用的adapter拷贝到引擎分配的显存位置，位置上已是该adapter时无需拷贝；
+        引擎只会换出没有任务使用的adapter，拷贝不影响正在推理的任务；
+        adapter被删除等原因加载失败时，停止使用该adapter的任务
+        """
+        for key, slot in set(zip(lora_keys.tolist(), lora_slots.tolist())):
+            if slot < 0 or self.lora_slot_keys[slot] == key:
+                continue
+            try:
+                weights = self.lora_weight_cache.get(key)
+            except Exception as e:
+                logger.error(f"rank: {self.rank} failed to load lora adapter {key:016x}: {e}")
+                self.slot_errors[slots[lora_keys == key]] = SLOT_ERROR_LORA
+                continue
+            for module, (lora_a, lora_b) in weights.items():
+                self.share_inputs[f'lora_a_{module}'][slot] = paddle.to_tensor(lora_a, dtype=self.args.dtype)
+                self.share_inputs[f'lora_b_{module}'][slot] = paddle.to_tensor(lora_b, dtype=self.args.dtype)
+            self.lora_slot_keys[slot] = key
+            logger.info(f"load lora adapter {key:016x} to slot {slot}")
 
-    def dy_input_preprocess(self, tasks):
-        """
-        动态插入部分额外处理
-        """
-        for i in range(len(tasks)):
-            task = tasks[i]
-            idx = task['idx']
-            length = len(task['input_ids'])
-            self.share_inputs['input_ids'][idx:idx + 1, :length] = np.array(task['input_ids'])
-            if len(task['eos_token_ids']) < self.eos_tokens_lens:
-                task['eos_token_ids'].append(task['eos_token_ids'][0])
-            self.share_inputs['eos_token_id'][:] = np.array(task['eos_token_ids'], dtype="int64").reshape(-1, 1)
-            self.share_inputs['pre_ids'][idx:idx + 1] = -1
-            self.share_inputs['top_p'][idx:idx + 1] = task.get('topp', 0.7)
-            self.share_inputs['temperature'][idx:idx + 1] = task.get('temperature', 0.95)
-            self.share_inputs['penalty_score'][idx:idx + 1] = task.get('penalty_score', 1.0)
-            self.share_inputs['frequency_score'][idx:idx + 1] = task.get('frequency_score', 0.0)
-            self.share_inputs['presence_score'][idx:idx + 1] = task.get('presence_score', 0.0)
-            self.share_inputs['seq_lens_this_time'][idx:idx + 1] = length
-            self.share_inputs['step_seq_lens_encoder'][idx:idx + 1] = length
-            self.share_inputs['seq_lens_encoder'][idx:idx + 1] = length
-            self.share_inputs['seq_lens_decoder'][idx:idx + 1] = 0
-            self.share_inputs['step_idx'][idx:idx + 1] = 0
-            self.share_inputs['min_length'][idx:idx + 1] = task.get('min_dec_len', 1)
-            if "max_dec_len" in task:
-                max_dec_len = task['max_dec_len']
-            elif "seq_len" in task:
-                max_dec_len = task['seq_len']
-            else:
-                max_dec_len = self.args.max_dec_len
-            self.share_inputs['max_length'][idx:idx + 1] = max_dec_len
-            self.share_inputs['stop_flags'][idx:idx + 1] = False
+    def export_kv(self):
+        """
+        prefill实例：发送本步完成prefill的任务的prompt KV，在推理后、block被回收复用前调用
+        """
+        for key, block_ids, token_num in self.pending_kv_exports:
+            index = paddle.to_tensor(block_ids, dtype="int32")
+            kv_blocks = np.stack([paddle.gather(cache, index).numpy() for cache in self.cache_kvs.values()])
+            self.kv_transport.send(key, self.rank, token_num, kv_blocks)
+        logger.info(f"export kv of {len(self.pending_kv_exports)} tasks")
+        self.pending_kv_exports = []
+
+    def import_kv(self, key, block_tables, kv_token_num):
+        """
+        decode实例：将prefill实例发送的prompt KV拷贝到任务的block中
+        """
+        token_num, kv_blocks = self.kv_transport.recv(key, self.rank)
+        caches = list(self.cache_kvs.values())
+        if token_num != kv_token_num or kv_blocks.shape[0] != len(caches) or \
+                list(kv_blocks.shape[2:]) != list(caches[0].shape[1:]):
+            raise ValueError(f"the kv of {key:016x} with {token_num} tokens and shape {kv_blocks.shape} "
+                             f"does not match {kv_token_num} tokens and cache shape {caches[0].shape}, "
+                             f"prefill and decode instances should use the same model and BLOCK_SIZE")
+        index = paddle.to_tensor(block_tables[:kv_blocks.shape[1]], dtype="int32")
+        for cache, values in zip(caches, kv_blocks):
+            cache.scatter_(index, paddle.to_tensor(values, dtype=cache.dtype), overwrite=True)
+
+    def _scatter_rows(self, name, slots, values):
+        """
+        将values的第i行写入share_inputs[name]的第slots[i]行
+        """
+        tensor = self.share_inputs[name]
+        values = np.ascontiguousarray(values).reshape([len(slots)] + tensor.shape[1:])
+        # 整批数据只做一次host到device的拷贝
+        values = paddle.to_tensor(values, dtype=tensor.dtype)
+        start = int(slots[0])
+        if np.array_equal(slots, np.arange(start, start + len(slots))):
+            # 空闲位置按编号从小到大分配，同一批任务的位置通常连续，直接按切片写入
+            tensor[start:start + len(slots)] = values
+        elif tensor.dtype == paddle.bool:
+            # scatter不支持bool类型，逐行写入
+            for i, slot in enumerate(slots):
+                tensor[int(slot):int(slot) + 1] = values[i:i + 1]
+        else:
+            tensor.scatter_(paddle.to_tensor(slots), values, overwrite=True)
 
-            if "infer_seed" in task:
-                self.share_inputs['infer_seed'][idx:idx + 1] = task['infer_seed']
+    def propose_draft_tokens(self, seq_lens_this_time, real_bsz):
+        """
+        投机解码：将本步接受的token追加到各位置的上下文，并为处于解码阶段的位置生成下一步的草稿token
+        草稿token的KV写入当前block的剩余位置，不跨越尚未分配的block，也不超过剩余的生成长度
+        """
+        accept_num = self.share_inputs['accept_num'][:real_bsz].numpy()
+        accept_tokens = self.share_inputs['accept_tokens'][:real_bsz].numpy()
+        stop_flags = self.share_inputs['stop_flags'][:real_bsz].numpy().reshape([-1])
+        seq_lens_encoder = self.share_inputs['seq_lens_encoder'][:real_bsz].numpy().reshape([-1])
+        seq_lens_decoder = self.share_inputs['seq_lens_decoder'][:real_bsz].numpy().reshape([-1])
+        remaining_len = (self.share_inputs['max_length'][:real_bsz] -
+                         self.share_inputs['step_idx'][:real_bsz]).numpy().reshape([-1])
+        this_time = seq_lens_this_time.numpy().reshape([-1])
+        draft_tokens = np.full([real_bsz, self.config.speculate_max_draft_tokens + 1], -1, dtype="int64")
+        for i in range(real_bsz):
+            if accept_num[i] > 0:
+                self.drafter.append(i, accept_tokens[i, :accept_num[i]])
+            if stop_flags[i] or seq_lens_encoder[i] > 0:
+                continue
+            block_remaining = self.args.block_size - seq_lens_decoder[i] % self.args.block_size - 1
+            max_draft_tokens = int(min(self.config.speculate_max_draft_tokens, block_remaining, remaining_len[i] - 1))
+            last_token, drafts = self.drafter.propose(i, max_draft_tokens)
+            if last_token is None:
+                continue
+            draft_tokens[i, 0] = last_token
+            draft_tokens[i, 1:1 + len(drafts)] = drafts
+            this_time[i] = 1 + len(drafts)
+        self.share_inputs['draft_tokens'][:real_bsz] = paddle.to_tensor(draft_tokens)
+        seq_lens_this_time[:] = paddle.to_tensor(this_time.reshape([-1, 1]), dtype=seq_lens_this_time.dtype)
 
-            encoder_block_num = len(task['block_tables'])
-            self.share_inputs['encoder_block_lens'][idx:idx + 1] = encoder_block_num
-            self.share_inputs["block_tables"][idx:idx + 1, :] = -1
-            self.share_inputs["block_tables"][idx:idx + 1, :encoder_block_num] = np.array(
-                                            task['block_tables'], dtype="int32")
+    def update_guided_masks(self, real_bsz):
+        """
+        约束解码：以各位置本步生成的token更新状态，并写入下一步的token位掩码
+        模型将生成的token写入pre_ids的step_idx位置，只取约束解码位置的最新token拷贝到host
+        """
+        slots = self.guided_masker.guided_slots(real_bsz)
+        if len(slots) == 0:
+            return
+        step_idx = self.share_inputs['step_idx'][:real_bsz]
+        last_tokens = paddle.take_along_axis(self.share_inputs['pre_ids'][:real_bsz], step_idx, axis=1)
+        step_idx = step_idx.numpy().reshape([-1])[slots]
+        last_tokens = last_tokens.numpy().reshape([-1])[slots]
+        generated = step_idx > self.guided_steps[slots]
+        slots = slots[generated]
+        if len(slots) == 0:
+            return
+        self.guided_steps[slots] = step_idx[generated]
+        self.guided_masker.advance(slots, last_tokens[generated])
+        self._scatter_rows('allowed_token_mask', slots, self.guided_masker.get_masks(slots))
 
     def step_cuda(self, seq_lens_this_time):
         """
@@ -380,6 +623,12 @@ class ModelRunner:
                                            dtype=flag_array.dtype,
                                            buffer=shm_flag_has_block_step.buf)
 
+        flag_array = np.zeros([self.args.max_batch_size], dtype=np.int32)
+        shm_flag_slot_error = shared_memory.SharedMemory(name=self.config.get_unique_name("shm_flag_slot_error"))
+        self.slot_errors = np.ndarray(flag_array.shape,
+                                      dtype=flag_array.dtype,
+                                      buffer=shm_flag_slot_error.buf)
+
         use_custom_health_checker = self.config.use_custom_health_checker
         if use_custom_health_checker:
             shm_engine_ready_check_flag_array, engine_ready_check_flag_array = self.initialize_engine_ready_check_flag()
@@ -403,7 +652,7 @@ class ModelRunner:
 
             if self.rank == 0:
                 # 队列不为空, 可取出数据
-                if not self.infer_queue.empty():
+                if self.infer_queue.poll():
                     flag_broadcast_array[0] = 1
 
             if self.nranks > 1:
@@ -418,15 +667,17 @@ class ModelRunner:
                 if read_finish:
                     flag_broadcast_array[0] = 0
 
-                req_dicts = []
-                for req_dict, bsz in tasks:
-                    real_bsz = int(bsz)
-                    req_dicts.extend(req_dict)
+                for payload in tasks:
+                    task_batch = TaskBatch.decode(payload)
+                    real_bsz = task_batch.real_bsz
                     logger.info(
-                        f'rank: {self.rank}, real_bsz: {real_bsz}, query_num: {len(req_dicts)}'
+                        f'rank: {self.rank}, real_bsz: {real_bsz}, query_num: {len(task_batch)}'
                     )
-
-                self.dy_input_preprocess(req_dicts)
+                    self.dy_input_preprocess(task_batch)
+                # 各rank插入失败的位置可能不同，均写入共享内存后再一致地停止
+                if self.nranks > 1:
+                    paddle.distributed.barrier()
+                self.stop_failed_slots()
                 # 特殊处理seq_lens
                 seq_lens_this_time = copy.deepcopy(
                     self.share_inputs['seq_lens_this_time'][:real_bsz])
@@ -438,9 +689,13 @@ class ModelRunner:
                 if self.nranks > 1:
                     paddle.distributed.barrier()
 
-                time.sleep(0.001)
+                # 引擎空闲时由rank 0阻塞等待新任务写入，其余rank在下一轮barrier处等待
+                if self.rank == 0:
+                    self.infer_queue.wait_for_put(timeout=0.5)
                 continue
             self.infer_engine.predictor.run()
+            if self.pending_kv_exports:
+                self.export_kv()
 
             # 自增随机种子，让每次计算的种子不一样
             self.share_inputs['infer_seed'].add_(infer_seed_increment)
@@ -448,6 +703,13 @@ class ModelRunner:
 
             if self.free_list_len > 0:
                 self.step_cuda(seq_lens_this_time)
+                if self.config.enable_preemption and self.rank == 0:
+                    # 通知引擎是否有任务因解码block不足而暂停，由引擎选择被抢占的任务
+                    flag_has_block_step_array[0] = int(self.share_inputs['step_lens'][0])
+            if self.drafter is not None:
+                self.propose_draft_tokens(seq_lens_this_time, real_bsz)
+            if self.guided_masker is not None:
+                self.update_guided_masks(real_bsz)
 
 
 class InferenceEngine(object):
@@ -0,0 +1,180 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import time
+
+import numpy as np
+
+
+def get_kv_transfer_key(req_id):
+    """
+    prefill实例上请求的req_id对应的KV传输key，prefill与decode实例以此标识同一份KV，为正的int64
+    """
+    return int(hashlib.sha256(str(req_id).encode("utf-8")).hexdigest()[:15], 16) + 1
+
+
+class KVTransport(object):
+    """
+    prefill实例与decode实例之间传输KV Cache的抽象
+    每个张量并行rank独立发送、接收自己的KV分片，一份KV由key与rank标识，被接收后即删除
+    """
+    def send(self, key, rank, token_num, kv_blocks):
+        """
+        发送一个请求的prompt KV
+
+        Args:
+            key (int): KV传输key
+            rank (int): 张量并行rank
+            token_num (int): KV包含的token数
+            kv_blocks (np.ndarray): 各层key、value cache中该请求的block，
+                shape为[层数 * 2, block数, kv head数, block_size, head_dim]
+        """
+        raise NotImplementedError
+
+    def recv(self, key, rank):
+        """
+        接收一个已认领的请求的prompt KV，接收后删除
+
+        Returns:
+            int: KV包含的token数
+            np.ndarray: 与send的kv_blocks格式相同
+        """
+        raise NotImplementedError
+
+    def wait(self, key, nranks, timeout):
+        """
+        等待所有rank的KV发送完成
+
+        Returns:
+            int: KV包含的token数，超时时返回None
+        """
+        raise NotImplementedError
+
+    def claim(self, key, nranks):
+        """
+        decode实例认领所有rank已发送完成的KV，认领后不再被过期清理，直到被接收或丢弃
+
+        Returns:
+            bool: 是否认领成功，KV已被清理时返回False
+        """
+        raise NotImplementedError
+
+    def discard(self, key, nranks):
+        """
+        删除不再需要的KV，包括已认领的KV，如decode实例拒绝了请求
+        """
+        raise NotImplementedError
+
+
+class SharedMemoryKVTransport(KVTransport):
+    """
+    同一机器上基于共享内存文件系统的KV传输，用于单机部署prefill与decode实例及测试
+    每份KV为目录下的一个npy文件，写入临时文件后原子重命名，文件存在即表示发送完成，
+    decode实例认领时将文件移入claimed子目录，不再被过期清理
+    """
+    def __init__(self, transport_dir, ttl):
+        self.transport_dir = transport_dir
+        self.claimed_dir = os.path.join(transport_dir, "claimed")
+        # 超过ttl秒未被认领的KV视为已被放弃，发送时清理
+        self.ttl = ttl
+        self.last_cleanup_time = 0.0
+        os.makedirs(self.claimed_dir, exist_ok=True)
+
+    def _path(self, key, rank, token_num):
+        return os.path.join(self.transport_dir, f"{key:016x}_{rank}_{token_num}.npy")
+
+    def _find(self, key, rank, directory=None):
+        directory = directory or self.transport_dir
+        prefix = f"{key:016x}_{rank}_"
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name.endswith(".npy"):
+                return os.path.join(directory, name), int(name[len(prefix):-len(".npy")])
+        return None, None
+
+    def send(self, key, rank, token_num, kv_blocks):
+        self._cleanup()
+        path = self._path(key, rank, token_num)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, kv_blocks)
+        os.replace(tmp_path, path)
+
+    def recv(self, key, rank):
+        path, token_num = self._find(key, rank, self.claimed_dir)
+        if path is None:
+            raise ValueError(f"kv of {key:016x} rank {rank} is not found in {self.claimed_dir}")
+        kv_blocks = np.load(path)
+        os.remove(path)
+        return token_num, kv_blocks
+
+    def wait(self, key, nranks, timeout):
+        deadline = time.time() + timeout
+        while True:
+            token_nums = set(self._find(key, rank)[1] for rank in range(nranks))
+            if None not in token_nums and len(token_nums) == 1:
+                return token_nums.pop()
+            if time.time() > deadline:
+                return None
+            time.sleep(0.005)
+
+    def claim(self, key, nranks):
+        for rank in range(nranks):
+            path, _ = self._find(key, rank)
+            try:
+                if path is None:
+                    raise FileNotFoundError(f"kv of {key:016x} rank {rank} is not found")
+                os.rename(path, os.path.join(self.claimed_dir, os.path.basename(path)))
+            except FileNotFoundError:
+                # 部分rank的KV已被清理，整份KV不可用
+                self.discard(key, nranks)
+                return False
+        return True
+
+    def discard(self, key, nranks):
+        for rank in range(nranks):
+            for directory in (self.transport_dir, self.claimed_dir):
+                path, _ = self._find(key, rank, directory)
+                if path is not None:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+    def _cleanup(self):
+        now = time.time()
+        if now - self.last_cleanup_time < self.ttl:
+            return
+        self.last_cleanup_time = now
+        # 只清理未被认领的KV，不进入claimed子目录
+        for name in os.listdir(self.transport_dir):
+            path = os.path.join(self.transport_dir, name)
+            try:
+                if os.path.isfile(path) and now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def create_kv_transport(cfg):
+    """
+    根据配置创建KV传输，未开启prefill与decode分离时返回None
+    """
+    if cfg.engine_role == "mixed":
+        return None
+    if cfg.kv_transport == "shm":
+        # 未被接收的KV保留两倍的等待时间后清理
+        return SharedMemoryKVTransport(cfg.kv_transport_dir, 2 * cfg.kv_transfer_timeout)
+    raise ValueError(f"unknown kv transport: {cfg.kv_transport}, should be shm")
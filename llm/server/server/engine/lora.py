@@ -0,0 +1,257 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# LORA_ADAPTER_DIR下每个子目录为一个adapter，目录名即adapter_id，与PaddleNLP保存的LoRA模型格式一致
+LORA_CONFIG_NAME = "lora_config.json"
+LORA_WEIGHTS_NAME = "lora_model_state.pdparams"
+# 支持的LoRA目标层，以及按张量并行切分时是否按输入维度切分（行切分），其余按输出维度切分
+SUPPORTED_TARGET_MODULES = {
+    "q_proj": False,
+    "k_proj": False,
+    "v_proj": False,
+    "o_proj": True,
+    "gate_proj": False,
+    "up_proj": False,
+    "down_proj": True,
+}
+_ADAPTER_ID_PATTERN = re.compile(r"[A-Za-z0-9_\-][A-Za-z0-9_.\-]*")
+_WEIGHT_NAME_PATTERN = re.compile(r"layers\.(\d+)\..*\.(\w+)\.lora_([AB])$")
+
+
+def get_adapter_key(adapter_id):
+    """
+    adapter_id对应的整型key，服务进程与推理进程以此标识adapter，为正的int64
+    """
+    return int(hashlib.sha256(adapter_id.encode("utf-8")).hexdigest()[:15], 16) + 1
+
+
+def get_target_module_shapes(model_cfg, target_modules, nranks=1):
+    """
+    各目标层在当前张量并行rank上的输入、输出维度
+
+    Returns:
+        dict: 目标层名 -> (输入维度, 输出维度)
+    """
+    hidden_size = model_cfg["hidden_size"]
+    num_heads = model_cfg.get("num_attention_heads", model_cfg.get("n_head"))
+    num_kv_heads = model_cfg.get("num_key_value_heads") or num_heads
+    head_dim = hidden_size // num_heads
+    intermediate_size = model_cfg["intermediate_size"]
+    shapes = {
+        "q_proj": (hidden_size, num_heads * head_dim),
+        "k_proj": (hidden_size, num_kv_heads * head_dim),
+        "v_proj": (hidden_size, num_kv_heads * head_dim),
+        "o_proj": (num_heads * head_dim, hidden_size),
+        "gate_proj": (hidden_size, intermediate_size),
+        "up_proj": (hidden_size, intermediate_size),
+        "down_proj": (intermediate_size, hidden_size),
+    }
+    result = {}
+    for module in target_modules:
+        in_dim, out_dim = shapes[module]
+        if SUPPORTED_TARGET_MODULES[module]:
+            result[module] = (in_dim // nranks, out_dim)
+        else:
+            result[module] = (in_dim, out_dim // nranks)
+    return result
+
+
+class LoraRegistry(object):
+    """
+    服务进程中的adapter注册表，请求预处理时检查adapter是否存在及其配置，新增的adapter无需重启服务
+    """
+    def __init__(self, adapter_dir, max_rank):
+        self.adapter_dir = adapter_dir
+        self.max_rank = max_rank
+        self.adapters = dict()
+        self.lock = threading.Lock()
+
+    def get_key(self, adapter_id):
+        """
+        检查adapter并返回其key
+
+        Raises:
+            ValueError: adapter不存在或配置不合法
+        """
+        if not isinstance(adapter_id, str) or not _ADAPTER_ID_PATTERN.fullmatch(adapter_id):
+            raise ValueError(f"invalid adapter_id: {adapter_id}")
+        # 已注册的adapter也可能已被删除，每次都检查文件是否存在
+        if not self.exists(adapter_id):
+            raise ValueError(f"adapter {adapter_id} is not found in {self.adapter_dir}")
+        with self.lock:
+            if adapter_id in self.adapters:
+                return self.adapters[adapter_id]
+        config_path = os.path.join(self.adapter_dir, adapter_id, LORA_CONFIG_NAME)
+        with open(config_path, "r", encoding="utf-8") as f:
+            rank = int(json.load(f)["r"])
+        if rank > self.max_rank:
+            raise ValueError(f"the rank {rank} of adapter {adapter_id} exceeds LORA_MAX_RANK {self.max_rank}")
+        key = get_adapter_key(adapter_id)
+        with self.lock:
+            self.adapters[adapter_id] = key
+        return key
+
+    def exists(self, adapter_id):
+        """
+        adapter的配置与权重文件是否存在
+        """
+        adapter_path = os.path.join(self.adapter_dir, adapter_id)
+        return os.path.exists(os.path.join(adapter_path, LORA_CONFIG_NAME)) and \
+            os.path.exists(os.path.join(adapter_path, LORA_WEIGHTS_NAME))
+
+
+class LoraSlotManager(object):
+    """
+    引擎中adapter在显存中的位置分配，正在推理的任务使用的adapter常驻，
+    不再使用的adapter保留在显存中供后续请求复用，需要位置时按LRU换出，
+    同一时刻推理的不同adapter数不超过位置数
+    """
+    def __init__(self, max_loras):
+        # 各adapter所在的位置及使用它的任务数
+        self.slots = dict()
+        self.ref_counts = dict()
+        # 未被使用的已加载adapter，按最近使用的顺序排列
+        self.idle_keys = OrderedDict()
+        self.free_slots = list(range(max_loras - 1, -1, -1))
+        self.lock = threading.Lock()
+
+    def can_acquire(self, key):
+        """
+        判断adapter能否获得位置：已在显存中，或者有空闲位置或可换出的adapter
+        """
+        with self.lock:
+            return key in self.slots or len(self.free_slots) > 0 or len(self.idle_keys) > 0
+
+    def acquire(self, key):
+        """
+        任务插入时获取adapter的位置
+
+        Returns:
+            int: adapter在显存中的位置，无可用位置时返回None
+        """
+        with self.lock:
+            if key not in self.slots:
+                if self.free_slots:
+                    slot = self.free_slots.pop()
+                elif self.idle_keys:
+                    evicted_key, _ = self.idle_keys.popitem(last=False)
+                    slot = self.slots.pop(evicted_key)
+                    del self.ref_counts[evicted_key]
+                else:
+                    return None
+                self.slots[key] = slot
+                self.ref_counts[key] = 0
+            self.idle_keys.pop(key, None)
+            self.ref_counts[key] += 1
+            return self.slots[key]
+
+    def release(self, key):
+        """
+        任务结束时释放adapter，不再被使用时保留在显存中等待复用
+        """
+        with self.lock:
+            self.ref_counts[key] -= 1
+            if self.ref_counts[key] == 0:
+                self.idle_keys[key] = None
+
+    def active_num(self):
+        """
+        正在被使用的adapter数
+        """
+        with self.lock:
+            return len(self.slots) - len(self.idle_keys)
+
+
+class LoraWeightCache(object):
+    """
+    推理进程中adapter权重的内存LRU缓存，权重按当前rank切分，LoRA的缩放系数合入B矩阵，
+    rank不足LORA_MAX_RANK的部分补0，可以直接拷贝到显存中的固定形状Tensor
+    """
+    def __init__(self, adapter_dir, capacity, num_layers, module_shapes, max_rank, rank=0, nranks=1):
+        self.adapter_dir = adapter_dir
+        self.capacity = capacity
+        self.num_layers = num_layers
+        self.module_shapes = module_shapes
+        self.max_rank = max_rank
+        self.rank = rank
+        self.nranks = nranks
+        self.adapter_ids = dict()
+        self.weights = OrderedDict()
+
+    def _get_adapter_id(self, key):
+        if key not in self.adapter_ids:
+            # 新增的adapter，重新扫描目录
+            for adapter_id in os.listdir(self.adapter_dir):
+                self.adapter_ids[get_adapter_key(adapter_id)] = adapter_id
+        if key not in self.adapter_ids:
+            raise ValueError(f"adapter {key:016x} is not found in {self.adapter_dir}")
+        return self.adapter_ids[key]
+
+    def get(self, key):
+        """
+        获取adapter的权重
+
+        Returns:
+            dict: 目标层名 -> (A, B)，shape分别为[层数, 输入维度, max_rank]与[层数, max_rank, 输出维度]
+        """
+        if key in self.weights:
+            self.weights.move_to_end(key)
+            return self.weights[key]
+        weights = self._load(os.path.join(self.adapter_dir, self._get_adapter_id(key)))
+        self.weights[key] = weights
+        while len(self.weights) > self.capacity:
+            self.weights.popitem(last=False)
+        return weights
+
+    def _load(self, adapter_path):
+        import paddle
+        with open(os.path.join(adapter_path, LORA_CONFIG_NAME), "r", encoding="utf-8") as f:
+            lora_config = json.load(f)
+        lora_rank = int(lora_config["r"])
+        scaling = float(lora_config.get("lora_alpha", lora_rank)) / lora_rank
+        state_dict = paddle.load(os.path.join(adapter_path, LORA_WEIGHTS_NAME), return_numpy=True)
+        return self.build(state_dict, lora_rank, scaling)
+
+    def build(self, state_dict, lora_rank, scaling):
+        """
+        由LoRA权重的state_dict组装各目标层的A、B矩阵，未包含的层为0，不影响输出
+        """
+        weights = {module: (np.zeros([self.num_layers, in_dim, self.max_rank], dtype=np.float32),
+                            np.zeros([self.num_layers, self.max_rank, out_dim], dtype=np.float32))
+                   for module, (in_dim, out_dim) in self.module_shapes.items()}
+        for name, value in state_dict.items():
+            match = _WEIGHT_NAME_PATTERN.search(name)
+            if match is None or match.group(2) not in weights:
+                continue
+            layer, module, matrix = int(match.group(1)), match.group(2), match.group(3)
+            value = np.asarray(value, dtype=np.float32)
+            # 行切分的层切分A的输入维度，列切分的层切分B的输出维度
+            if matrix == "A" and SUPPORTED_TARGET_MODULES[module]:
+                value = np.split(value, self.nranks, axis=0)[self.rank]
+            elif matrix == "B" and not SUPPORTED_TARGET_MODULES[module]:
+                value = np.split(value, self.nranks, axis=1)[self.rank]
+            if matrix == "A":
+                weights[module][0][layer, :, :lora_rank] = value
+            else:
+                weights[module][1][layer, :lora_rank, :] = value * scaling
+        return weights
@@ -0,0 +1,146 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+
+
+class PrefixCache(object):
+    """
+    基于token block哈希的前缀缓存索引
+    1. 每个写满prompt token的block以 hash(前一个block的hash, 当前block的token) 作为键，
+       首个block的前一个hash为LoRA adapter的key，使用不同adapter计算的KV不会被复用
+    2. 被请求使用的缓存block通过引用计数管理，引用数为0时进入LRU队列，可被淘汰
+    3. 只记录block的归属关系，不负责分配显存，分配由ResourceManager完成
+    """
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.hash_to_block = dict()
+        self.block_to_hash = dict()
+        # 缓存block的引用计数
+        self.ref_counts = dict()
+        # 引用计数为0的缓存block，按最近使用时间排序，头部最先被淘汰
+        self.evictable_blocks = OrderedDict()
+        # 命中统计
+        self.query_token_num = 0
+        self.hit_token_num = 0
+
+    def compute_block_hashes(self, input_ids, lora_key=0):
+        """
+        计算prompt中每个写满token的block的链式哈希
+
+        Args:
+            input_ids (list[int]): prompt的token
+            lora_key (int): 请求使用的LoRA adapter的key，0表示不使用adapter
+        """
+        block_hashes = list()
+        prev_hash = lora_key
+        for i in range(len(input_ids) // self.block_size):
+            block = tuple(input_ids[i * self.block_size:(i + 1) * self.block_size])
+            prev_hash = hash((prev_hash, block))
+            block_hashes.append(prev_hash)
+        return block_hashes
+
+    def match(self, block_hashes):
+        """
+        查找最长的已缓存前缀，并增加命中block的引用计数
+
+        Returns:
+            List[int]: 命中的block id列表
+        """
+        matched_blocks = list()
+        for block_hash in block_hashes:
+            block_id = self.hash_to_block.get(block_hash)
+            if block_id is None:
+                break
+            matched_blocks.append(block_id)
+        for block_id in matched_blocks:
+            self.acquire(block_id)
+        return matched_blocks
+
+    def acquire(self, block_id):
+        """
+        增加缓存block的引用计数
+        """
+        if self.ref_counts[block_id] == 0:
+            del self.evictable_blocks[block_id]
+        self.ref_counts[block_id] += 1
+
+    def release(self, block_id):
+        """
+        释放缓存block的一个引用，引用数为0时放入LRU队列尾部
+
+        Returns:
+            bool: block是否由缓存管理，为False时调用方需自行回收该block
+        """
+        if block_id not in self.block_to_hash:
+            return False
+        self.ref_counts[block_id] -= 1
+        if self.ref_counts[block_id] == 0:
+            self.evictable_blocks[block_id] = None
+        return True
+
+    def insert(self, block_hash, block_id):
+        """
+        将已完成计算的block加入缓存索引，此时该block被当前请求持有
+
+        Returns:
+            bool: 是否插入成功，相同内容的block已存在时返回False
+        """
+        if block_hash in self.hash_to_block or block_id in self.block_to_hash:
+            return False
+        self.hash_to_block[block_hash] = block_id
+        self.block_to_hash[block_id] = block_hash
+        self.ref_counts[block_id] = 1
+        return True
+
+    def evict(self):
+        """
+        淘汰最久未使用且无引用的缓存block
+
+        Returns:
+            int: 被淘汰的block id，无可淘汰block时返回None
+        """
+        if not self.evictable_blocks:
+            return None
+        block_id, _ = self.evictable_blocks.popitem(last=False)
+        del self.hash_to_block[self.block_to_hash.pop(block_id)]
+        del self.ref_counts[block_id]
+        return block_id
+
+    def evictable_block_num(self):
+        """
+        当前可淘汰的缓存block数量
+        """
+        return len(self.evictable_blocks)
+
+    def cached_block_num(self):
+        """
+        当前缓存索引中的block数量
+        """
+        return len(self.block_to_hash)
+
+    def record_hit(self, query_token_num, hit_token_num):
+        """
+        记录命中情况
+        """
+        self.query_token_num += query_token_num
+        self.hit_token_num += hit_token_num
+
+    def hit_rate(self):
+        """
+        按token统计的命中率
+        """
+        if self.query_token_num == 0:
+            return 0.0
+        return self.hit_token_num * 1.0 / self.query_token_num
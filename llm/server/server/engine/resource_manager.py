@@ -12,14 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
+import heapq
 import os
 import random
 import threading
 import time
+from collections import deque
 
-import numpy as np
-from server.utils import model_server_logger
+from server.engine.lora import LoraSlotManager
+from server.engine.prefix_cache import PrefixCache
+from server.utils import HOT_PATH, model_server_logger
+
+
+# 预估生成长度的指数滑动平均系数
+DEC_LEN_EWMA_ALPHA = 0.05
 
 
 class ResourceManager(object):
@@ -29,10 +35,40 @@ class ResourceManager(object):
     def __init__(self, cfg):
         self.cfg = cfg
         self.stop_flags = [True] * cfg.max_batch_size
+        # 空闲位置的最小堆，分配时总是取编号最小的位置，使运行中的任务集中在batch前部
+        self.free_slots = list(range(cfg.max_batch_size))
         self.free_list = list(range(cfg.max_block_num - 1, -1, -1))
         self.tasks_list = [None] * self.cfg.max_batch_size
+        # 推理进程插入任务失败的位置及错误码，由引擎替换为共享内存，位置回收时清零
+        self.slot_errors = [0] * cfg.max_batch_size
         # 引擎当前的batch情况
         self.real_bsz = 0
+        # 插入线程与TokenProcessor线程会同时修改block资源
+        self.lock = threading.Lock()
+        # 位置或block被回收、有新请求缓存时唤醒插入线程
+        self.update_event = threading.Event()
+        # 为分块prefill任务的后续分块预留、尚未分配的block数量
+        self.reserved_block_num = 0
+        # 上一分块已计算完成、等待下发下一分块的任务位置
+        self.prefill_chunk_slots = deque()
+        # 已通知推理进程停止、尚未结束的被抢占任务数
+        self.preempting_num = 0
+        # 已结束、等待重新放入调度队列的被抢占任务
+        self.preempted_tasks = deque()
+        # 首个采样已完成prefill、等待放入调度队列的同一请求的其余采样
+        self.forked_tasks = deque()
+        self.preempted_num = 0
+        self.resumed_num = 0
+        # 已完成任务生成长度的指数滑动平均，用于准入控制预估新任务的block占用，无历史数据时按max_dec_len预估
+        self.expected_dec_len = None
+        # 前缀缓存，复用相同前缀请求已计算好的block
+        self.prefix_cache = None
+        if getattr(cfg, "enable_prefix_cache", False):
+            self.prefix_cache = PrefixCache(cfg.block_size)
+        # LoRA adapter在显存中的位置，限制同一batch中的不同adapter数
+        self.lora_slots = None
+        if getattr(cfg, "enable_lora", False):
+            self.lora_slots = LoraSlotManager(cfg.max_loras)
         model_server_logger.info(f"{self.info()}")
 
     def get_required_block_number(self, input_token_num):
@@ -74,117 +110,513 @@ class ResourceManager(object):
         else:
             raise ValueError('unknown required type')
         block_num = min(block_num, self.cfg.max_query_block_num)
+        with self.lock:
+            block_list = self._allocate_blocks(block_num)
+        if block_list:
+            model_server_logger.info(f"dispatch {len(block_list)} blocks.", extra=HOT_PATH)
+        return block_list
+
+    def _allocate_blocks(self, block_num, reserved_num=0, use_reserved=False):
+        """
+        从空闲block中分配，空闲block不足时淘汰无引用的缓存block，调用方需持有self.lock
+
+        Args:
+            block_num (int): 立即分配的block数量
+            reserved_num (int): 额外为分块prefill的后续分块预留的block数量
+            use_reserved (bool): 是否从已预留的block中分配
+        """
         block_list = list()
-        if block_num > len(self.free_list):
-            model_server_logger.error("block_num:{0} > free_list len:{1}".format(block_num, len(self.free_list)))
+        available_block_num = self._free_block_num()
+        if not use_reserved:
+            available_block_num -= self.reserved_block_num
+        if block_num + reserved_num > available_block_num:
+            model_server_logger.error("block_num:{0} > available block num:{1}".format(
+                block_num + reserved_num, available_block_num))
             return block_list
         for _ in range(block_num):
-            used_block_id = self.free_list.pop()
+            if self.free_list:
+                used_block_id = self.free_list.pop()
+            else:
+                used_block_id = self.prefix_cache.evict()
             block_list.append(used_block_id)
-        model_server_logger.info(f"dispatch {len(block_list)} blocks.")
+        if use_reserved:
+            self.reserved_block_num -= block_num
+        self.reserved_block_num += reserved_num
         return block_list
 
+    def _free_block_num(self):
+        """
+        可分配的block数量，包含可被淘汰的缓存block
+        """
+        free_block_num = len(self.free_list)
+        if self.prefix_cache is not None:
+            free_block_num += self.prefix_cache.evictable_block_num()
+        return free_block_num
+
+    def _get_prefill_end(self, input_token_num, prefill_start):
+        """
+        计算本次prefill的结束位置，开启分块prefill时每次最多计算prefill_chunk_size个token
+        """
+        if not self.cfg.enable_chunked_prefill:
+            return input_token_num
+        return min(input_token_num, prefill_start + self.cfg.prefill_chunk_size)
+
+    def _get_prefill_block_number(self, input_token_num, prefill_end):
+        """
+        计算到prefill_end为止所需的block数量，最后一个分块额外包含解码所需的block
+        """
+        if prefill_end < input_token_num:
+            block_num = self.get_encoder_block_number(prefill_end)
+        else:
+            block_num = self.get_required_block_number(input_token_num)
+        return min(block_num, self.cfg.max_query_block_num)
+
+    def _get_prefill_block_tables(self, task):
+        """
+        为新任务分配首个分块所需的block，并为后续分块预留block
+        """
+        input_token_num = len(task["input_ids"])
+        task["prefill_start"] = 0
+        task["prefill_end"] = self._get_prefill_end(input_token_num, 0)
+        block_num = self._get_prefill_block_number(input_token_num, task["prefill_end"])
+        reserved_num = self._get_prefill_block_number(input_token_num, input_token_num) - block_num
+        with self.lock:
+            task["block_tables"] = self._allocate_blocks(block_num, reserved_num)
+        task["reserved_block_num"] = reserved_num if task["block_tables"] else 0
+        if task["block_tables"]:
+            model_server_logger.info(f"dispatch {block_num} blocks, reserve {reserved_num} blocks.", extra=HOT_PATH)
+
+    def _get_transferred_block_tables(self, task):
+        """
+        为从prefill实例接收KV的任务分配block，前kv_token_num个token的KV由推理进程从KV传输拷贝到block中，
+        只需计算之后的首个生成token
+        """
+        input_token_num = len(task["input_ids"])
+        task["prefill_start"] = task["kv_token_num"]
+        task["prefill_end"] = input_token_num
+        block_num = self._get_prefill_block_number(input_token_num, input_token_num)
+        with self.lock:
+            task["block_tables"] = self._allocate_blocks(block_num)
+        task["reserved_block_num"] = 0
+
+    def _get_prefix_cached_block_tables(self, task):
+        """
+        分配显存资源，优先复用前缀缓存中已计算好的block
+        命中缓存的prompt token无需再做prefill，prefill从prefill_start开始；
+        未命中部分写满prompt token的block哈希记录在prefix_block_hashes中，prefill完成后加入缓存
+        """
+        input_ids = task["input_ids"]
+        input_token_num = len(input_ids)
+        # adapter作用于k_proj、v_proj时KV与adapter相关，不同adapter的请求不共享缓存block
+        block_hashes = self.prefix_cache.compute_block_hashes(input_ids, task.get("lora_key", 0))
+        # 至少保留一个token参与prefill计算，以得到首个生成token
+        max_matched_num = (input_token_num - 1) // self.cfg.block_size
+        with self.lock:
+            matched_blocks = self.prefix_cache.match(block_hashes[:max_matched_num])
+            prefill_start = len(matched_blocks) * self.cfg.block_size
+            prefill_end = self._get_prefill_end(input_token_num, prefill_start)
+            block_num = self._get_prefill_block_number(input_token_num, prefill_end)
+            reserved_num = self._get_prefill_block_number(input_token_num, input_token_num) - block_num
+            new_blocks = self._allocate_blocks(block_num - len(matched_blocks), reserved_num)
+            if not new_blocks and block_num > len(matched_blocks):
+                for block_id in matched_blocks:
+                    self.prefix_cache.release(block_id)
+                task["block_tables"] = []
+                return
+        self.prefix_cache.record_hit(input_token_num, prefill_start)
+        task["block_tables"] = matched_blocks + new_blocks
+        task["prefill_start"] = prefill_start
+        task["prefill_end"] = prefill_end
+        task["reserved_block_num"] = reserved_num
+        task["prefix_block_hashes"] = block_hashes[len(matched_blocks):]
+        model_server_logger.info(f"dispatch {len(new_blocks)} blocks, reuse {len(matched_blocks)} cached blocks, "
+                                 f"reserve {reserved_num} blocks.", extra=HOT_PATH)
+
+    def commit_prefix_blocks(self, index):
+        """
+        prefill完成后，将任务写满prompt token的block加入前缀缓存
+        """
+        if self.prefix_cache is None:
+            return
+        task = self.tasks_list[index]
+        block_hashes = task.pop("prefix_block_hashes", None)
+        if not block_hashes:
+            return
+        start = task["cached_token_num"] // self.cfg.block_size
+        with self.lock:
+            for i, block_hash in enumerate(block_hashes):
+                self.prefix_cache.insert(block_hash, task["block_tables"][start + i])
+
     def _recycle_block_tables(self, block_tables):
         """
         回收显存资源blocks
         """
-        ori_number = len(self.free_list)
-        self.free_list.extend(block_tables)
-        # self.free_list = list(set(self.free_list + block_tables))
-        cur_number = len(self.free_list)
-        model_server_logger.info(f"recycle {cur_number - ori_number} blocks.")
+        with self.lock:
+            ori_number = self._free_block_num()
+            if self.prefix_cache is None:
+                self.free_list.extend(block_tables)
+            else:
+                for block_id in block_tables:
+                    if not self.prefix_cache.release(block_id):
+                        self.free_list.append(block_id)
+            cur_number = self._free_block_num()
+        model_server_logger.info(f"recycle {cur_number - ori_number} blocks.", extra=HOT_PATH)
+        self.notify_update()
 
     def available_batch(self):
         """
         引擎当前可用最大Batch
         """
-        return np.sum(self.stop_flags)
+        return len(self.free_slots)
 
     def availabel_block_num(self):
         """
-        引擎当前可用的block数量
+        引擎当前可用的block数量，不包含为分块prefill预留的block
         """
-        return len(self.free_list)
+        return self._free_block_num() - self.reserved_block_num
 
-    def is_resource_sufficient(self, input_token_num):
+    def is_resource_sufficient(self, input_token_num, max_dec_len=None, lora_key=0):
         """
-        判断当前可用资源是否满足新的需求
+        判断当前可用资源是否满足新的需求，使用LoRA adapter的任务还需要adapter已在显存中或有可用的adapter位置
         """
         if self.available_batch() < 1:
             return False
+        if lora_key and not self.lora_slots.can_acquire(lora_key):
+            return False
         block_num = self.get_required_block_number(input_token_num)
         if block_num > self.availabel_block_num():
             return False
+        if self.cfg.enable_admission_control:
+            if max_dec_len is None:
+                max_dec_len = self.cfg.max_dec_len
+            projected_block_num = self.projected_block_num() + \
+                self._get_projected_block_number(input_token_num, max_dec_len, 0)
+            if projected_block_num > self.cfg.total_block_num * self.cfg.admission_overcommit_ratio:
+                return False
         return True
 
+    def _get_projected_block_number(self, input_token_num, max_dec_len, generated_token_num):
+        """
+        预估任务结束时占用的block数量
+        """
+        dec_len = max_dec_len if self.expected_dec_len is None else min(max_dec_len, self.expected_dec_len)
+        dec_len = max(dec_len, generated_token_num)
+        return (input_token_num + int(dec_len) + self.cfg.block_size - 1) // self.cfg.block_size
+
+    def projected_block_num(self):
+        """
+        所有正在推理的任务预估最终占用的block数量
+        """
+        projected_block_num = 0
+        for task in self.tasks_list[:self.real_bsz]:
+            if task is not None:
+                # 被抢占后恢复的任务，抢占前生成的token已计入input_ids
+                generated_token_num = task["tokens_all_num"] - len(task.get("generated_token_ids", []))
+                projected_block_num += self._get_projected_block_number(
+                    len(task["input_ids"]), task["max_dec_len"], generated_token_num)
+        return projected_block_num
+
+    def committed_block_num(self):
+        """
+        所有正在推理的任务已分配的block数量
+        """
+        return sum(len(task["block_tables"]) for task in self.tasks_list[:self.real_bsz] if task is not None)
+
+    def record_dec_len(self, dec_len):
+        """
+        记录已完成任务的生成长度，更新预估生成长度
+        """
+        if self.expected_dec_len is None:
+            self.expected_dec_len = float(dec_len)
+        else:
+            self.expected_dec_len += DEC_LEN_EWMA_ALPHA * (dec_len - self.expected_dec_len)
+
     def allocate_resources_for_new_tasks(self, tasks):
         """
         为新任务分配资源
         """
-
-        allocated_position = 0 # 新任务插入的位置
-        processing_task_index = 0 # 当前正在处理的任务index
         processed_tasks = list()
-        while allocated_position < self.cfg.max_batch_size:
-            if processing_task_index >= len(tasks):
+        for task in tasks:
+            if self.available_batch() == 0:
                 break
 
-            if len(tasks[processing_task_index]["input_ids"]) > self.cfg.max_seq_len:
+            if len(task["input_ids"]) > self.cfg.max_seq_len:
                 model_server_logger.error("req_id: {0} input_ids len:{1} > {2}".format(
-                    tasks[
-                        processing_task_index]["req_id"], len(tasks[
-                        processing_task_index]["input_ids"]), self.cfg.max_seq_len
-                ))
-                processing_task_index += 1
+                    task["req_id"], len(task["input_ids"]), self.cfg.max_seq_len))
                 continue
 
-            can_insert = False
-            while allocated_position + 1 <= self.cfg.max_batch_size:
-                if sum(self.stop_flags[allocated_position : allocated_position + 1]) == 1:
-                    can_insert = True
-                    break
-                allocated_position += 1
-            if can_insert:
-                if self.stop_flags[allocated_position]:
-                    task = copy.deepcopy(tasks[processing_task_index])
-
-                    if not isinstance(task["eos_token_ids"], list):
-                        task["eos_token_ids"] = [task["eos_token_ids"]]
-
-                    if "infer_seed" in task and task["infer_seed"]:
-                        task["infer_seed"] = int(task["infer_seed"])
-                    else:
-                        task["infer_seed"] = random.randint(0, 9223372036854775807)
-                    task["idx"] = allocated_position
-                    task["block_tables"] = self._get_block_tables(len(task["input_ids"]))
-                    if not task["block_tables"]:
-                        model_server_logger.error("req_id: {0} block_tables is empty".format(task["req_id"]))
-                        continue
-
-                    processed_tasks.append(task)
-                    self.stop_flags[allocated_position] = False
-                    task["inference_start_time"] = time.time()
-                    task["inference_time_cost"] = -1.0
-                    task["tokens_all_num"] = int(0)
-                    self.tasks_list[allocated_position] = task
-                    model_server_logger.info(f"allocate req_id: {task['req_id']}, "
-                                            f"allocated_position:{allocated_position}, input_ids_length: {len(task['input_ids'])}")
-                allocated_position += 1
-            processing_task_index += 1
-
-        # 统计引擎正在推理时的batch size
-        for i in range(self.cfg.max_batch_size - 1, -1, -1):
-            if not self.stop_flags[i]:
-                self.real_bsz = i + 1
-                break
+            # 任务由调用方独占，直接在原字典上补充字段，避免逐个任务深拷贝
+            if not isinstance(task["eos_token_ids"], list):
+                task["eos_token_ids"] = [task["eos_token_ids"]]
+
+            if "infer_seed" in task and task["infer_seed"]:
+                task["infer_seed"] = int(task["infer_seed"])
+            else:
+                task["infer_seed"] = random.randint(0, 9223372036854775807)
+            if task.get("lora_key"):
+                task["lora_slot"] = self.lora_slots.acquire(task["lora_key"])
+                if task["lora_slot"] is None:
+                    model_server_logger.error("req_id: {0} no lora slot is available".format(task["req_id"]))
+                    continue
+            if task.get("kv_token_num"):
+                self._get_transferred_block_tables(task)
+            elif self.prefix_cache is not None:
+                self._get_prefix_cached_block_tables(task)
+            else:
+                self._get_prefill_block_tables(task)
+            if not task["block_tables"]:
+                model_server_logger.error("req_id: {0} block_tables is empty".format(task["req_id"]))
+                if task.get("lora_key"):
+                    self.lora_slots.release(task["lora_key"])
+                continue
+            task["cached_token_num"] = task["prefill_start"]
+
+            if "prompt_token_num" in task:
+                self.resumed_num += 1
+            allocated_position = self._allocate_slot()
+            task["idx"] = allocated_position
+            task.setdefault("arrival_time", time.time())
+            task["inference_start_time"] = time.time()
+            task["inference_time_cost"] = -1.0
+            task["tokens_all_num"] = int(0)
+            self.tasks_list[allocated_position] = task
+            processed_tasks.append(task)
+            model_server_logger.info(f"allocate req_id: {task['req_id']}, "
+                                    f"allocated_position:{allocated_position}, input_ids_length: {len(task['input_ids'])}, "
+                                    f"cached_token_num: {task['cached_token_num']}, prefill_end: {task['prefill_end']}")
 
         model_server_logger.info("in num:{0} new task num:{1} real_bsz is:{2}".format(
-            len(tasks), len(processed_tasks), self.real_bsz))
-        model_server_logger.info(f"{self.info()}")
+            len(tasks), len(processed_tasks), self.real_bsz), extra=HOT_PATH)
+        model_server_logger.info(f"{self.info()}", extra=HOT_PATH)
+        return processed_tasks
+
+    def finish_prefill_chunk(self, index):
+        """
+        分块prefill任务的一个分块计算完成，等待插入线程下发下一个分块
+        """
+        with self.lock:
+            self.prefill_chunk_slots.append(index)
+        self.notify_update()
+
+    def allocate_resources_for_next_chunks(self):
+        """
+        为上一分块已计算完成的任务分配下一分块所需的block，这部分block在任务插入时已预留
+        """
+        processed_tasks = list()
+        with self.lock:
+            while self.prefill_chunk_slots:
+                index = self.prefill_chunk_slots.popleft()
+                task = self.tasks_list[index]
+                if task is None:
+                    continue
+                input_token_num = len(task["input_ids"])
+                task["prefill_start"] = task["prefill_end"]
+                task["prefill_end"] = self._get_prefill_end(input_token_num, task["prefill_start"])
+                block_num = self._get_prefill_block_number(input_token_num, task["prefill_end"]) - \
+                    len(task["block_tables"])
+                if block_num > 0:
+                    task["block_tables"].extend(self._allocate_blocks(block_num, use_reserved=True))
+                    task["reserved_block_num"] -= block_num
+                processed_tasks.append(task)
+                model_server_logger.info(f"req_id: {task['req_id']} prefill chunk "
+                                         f"[{task['prefill_start']}, {task['prefill_end']}), dispatch {block_num} blocks",
+                                         extra=HOT_PATH)
         return processed_tasks
 
+    def preempt(self, task=None):
+        """
+        选择一个正在推理的任务进行抢占，同一时刻只抢占一个任务，避免在资源释放前重复抢占
+        按优先级从低到高、插入时间从晚到早选择，prefill未完成的任务不参与抢占
+
+        Args:
+            task (dict): 等待插入的任务，不为None时只抢占优先级低于该任务的任务
+
+        Returns:
+            int: 被抢占任务的位置，无可抢占任务时返回None
+        """
+        with self.lock:
+            if self.preempting_num > 0:
+                return None
+            min_priority = None if task is None else task.get("priority", 0)
+            victim = None
+            for index, running_task in enumerate(self.tasks_list[:self.real_bsz]):
+                if running_task is None or running_task["prefill_end"] < len(running_task["input_ids"]):
+                    continue
+                priority = running_task.get("priority", 0)
+                if min_priority is not None and priority >= min_priority:
+                    continue
+                key = (priority, -running_task["arrival_time"])
+                if victim is None or key < victim[0]:
+                    victim = (key, index)
+            if victim is None:
+                return None
+            index = victim[1]
+            self.tasks_list[index]["preempted"] = True
+            self.preempting_num += 1
+            self.preempted_num += 1
+        model_server_logger.info(f"preempt req_id: {self.tasks_list[index]['req_id']}, position: {index}")
+        return index
+
+    def requeue_preempted_task(self, task, generated_token_ids):
+        """
+        被抢占任务在推理进程中结束后，以prompt和已生成的token作为输入，等待重新调度
+        """
+        new_token_num = len(generated_token_ids) - len(task.get("generated_token_ids", []))
+        prompt_token_num = task.setdefault("prompt_token_num", len(task["input_ids"]))
+        task["input_ids"] = list(task["input_ids"][:prompt_token_num]) + list(generated_token_ids)
+        task["generated_token_ids"] = list(generated_token_ids)
+        task["max_dec_len"] -= new_token_num
+        task["min_dec_len"] = max(task.get("min_dec_len", 1) - new_token_num, 1)
+        task["preempted_times"] = task.get("preempted_times", 0) + 1
+        # 从prefill实例接收的KV已被释放，恢复时重新计算
+        if task.pop("kv_token_num", None) is not None:
+            task.pop("kv_transfer_key", None)
+        for key in ("preempted", "idx", "block_tables", "prefix_block_hashes"):
+            task.pop(key, None)
+        with self.lock:
+            self.preempted_tasks.append(task)
+        self.notify_update()
+
+    def pop_preempted_tasks(self):
+        """
+        取出所有等待重新调度的被抢占任务
+        """
+        tasks = list()
+        with self.lock:
+            while self.preempted_tasks:
+                tasks.append(self.preempted_tasks.popleft())
+        return tasks
+
+    def release_forked_tasks(self, task):
+        """
+        n>1的请求只插入首个采样，其prefill完成、prompt的block加入前缀缓存后，再放出其余采样，
+        其余采样插入时命中前缀缓存，只需计算最后一个未写满block内的token
+        """
+        forked_tasks = task.pop("forked_tasks", None)
+        if not forked_tasks:
+            return
+        with self.lock:
+            self.forked_tasks.extend(forked_tasks)
+        self.notify_update()
+
+    def pop_forked_tasks(self):
+        """
+        取出所有可以放入调度队列的采样
+        """
+        tasks = list()
+        with self.lock:
+            while self.forked_tasks:
+                tasks.append(self.forked_tasks.popleft())
+        return tasks
+
+    def abort(self, req_ids):
+        """
+        取消正在推理的任务，由TokenProcessor在任务于推理进程中停止后回收资源
+        等待下发下一个分块的分块prefill任务已在推理进程中停止，直接回收资源
+
+        Args:
+            req_ids (set): 需要取消的req_id
+
+        Returns:
+            list[int]: 需要通知推理进程停止的位置
+            list[dict]: 已回收资源、需要直接结束的任务，包括尚未放出的同一请求的其余采样
+        """
+        stop_slots, stopped_slots, finished_tasks = list(), list(), list()
+        with self.lock:
+            for index, task in enumerate(self.tasks_list[:self.real_bsz]):
+                if task is None or self.stop_flags[index] or task.get("aborted") or task["req_id"] not in req_ids:
+                    continue
+                task["aborted"] = True
+                finished_tasks.extend(task.pop("forked_tasks", None) or [])
+                if index in self.prefill_chunk_slots:
+                    self.prefill_chunk_slots.remove(index)
+                    stopped_slots.append(index)
+                else:
+                    stop_slots.append(index)
+        for index in stopped_slots:
+            task = self.tasks_list[index]
+            self.release_slot(index)
+            self._recycle_block_tables(task["block_tables"])
+            finished_tasks.append(task)
+        return stop_slots, finished_tasks
+
+    def remove_pending_tasks(self, req_ids):
+        """
+        移除等待重新调度的被抢占任务及等待放出的采样
+
+        Returns:
+            list[dict]: 被移除的任务
+        """
+        removed_tasks = list()
+        with self.lock:
+            for tasks in (self.preempted_tasks, self.forked_tasks):
+                remaining_tasks = [task for task in tasks if task["req_id"] not in req_ids]
+                if len(remaining_tasks) < len(tasks):
+                    removed_tasks.extend(task for task in tasks if task["req_id"] in req_ids)
+                    tasks.clear()
+                    tasks.extend(remaining_tasks)
+        return removed_tasks
+
+    def _allocate_slot(self):
+        """
+        分配编号最小的空闲位置，并更新引擎正在推理时的batch size
+        """
+        with self.lock:
+            index = heapq.heappop(self.free_slots)
+            self.stop_flags[index] = False
+            self.real_bsz = max(self.real_bsz, index + 1)
+        return index
+
+    def release_slot(self, index):
+        """
+        回收任务占用的位置
+        """
+        with self.lock:
+            if self.stop_flags[index]:
+                return
+            self.stop_flags[index] = True
+            self.slot_errors[index] = 0
+            # 归还分块prefill未使用的预留block
+            if self.tasks_list[index] is not None:
+                self.reserved_block_num -= self.tasks_list[index].get("reserved_block_num", 0)
+                if self.tasks_list[index].get("preempted"):
+                    self.preempting_num -= 1
+                if self.tasks_list[index].get("lora_key"):
+                    self.lora_slots.release(self.tasks_list[index]["lora_key"])
+            self.tasks_list[index] = None
+            heapq.heappush(self.free_slots, index)
+            # real_bsz只在尾部位置释放时收缩，均摊O(1)
+            while self.real_bsz > 0 and self.stop_flags[self.real_bsz - 1]:
+                self.real_bsz -= 1
+        self.notify_update()
+
+    def notify_update(self):
+        """
+        唤醒等待资源的插入线程
+        """
+        self.update_event.set()
+
+    def wait_for_update(self, timeout):
+        """
+        等待资源状态变化或新请求到达，调用方需在被唤醒后重新检查条件
+        """
+        self.update_event.wait(timeout)
+        self.update_event.clear()
+
     def info(self):
         info = f"ResourceManager info, " \
                f"total_block_number: {self.total_block_number()}, total_batch_number: {len(self.stop_flags)}, " \
                f"availabel_block_num: {self.availabel_block_num()}, available_batch: {self.available_batch()}"
+        if self.reserved_block_num > 0:
+            info += f", reserved_block_num: {self.reserved_block_num}"
+        if self.cfg.enable_admission_control:
+            info += f", committed_block_num: {self.committed_block_num()}, " \
+                    f"projected_block_num: {self.projected_block_num()}, expected_dec_len: {self.expected_dec_len}"
+        if self.preempted_num > 0:
+            info += f", preempted_num: {self.preempted_num}, resumed_num: {self.resumed_num}"
+        if self.prefix_cache is not None:
+            info += f", cached_block_num: {self.prefix_cache.cached_block_num()}, " \
+                    f"prefix_cache_hit_rate: {self.prefix_cache.hit_rate():.4f}"
+        if self.lora_slots is not None:
+            info += f", active_lora_num: {self.lora_slots.active_num()}"
         return info
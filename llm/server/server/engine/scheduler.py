@@ -0,0 +1,253 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+from server.utils import model_server_logger
+
+
+class BaseScheduler(object):
+    """
+    缓存请求的调度策略基类
+    execute线程通过put缓存请求，插入线程通过pop按策略取出下一个可插入引擎的请求
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.lock = threading.Lock()
+        # 缓存的采样数，包含n>1请求随首个采样缓存的其余采样，用于限制缓存队列长度
+        self.sample_num = 0
+
+    def put(self, task):
+        """
+        缓存新请求
+        """
+        with self.lock:
+            self._put(task)
+            self.sample_num += self._count_samples(task)
+
+    def pop(self, is_resource_sufficient):
+        """
+        按调度策略取出下一个资源满足的请求
+
+        Args:
+            is_resource_sufficient (Callable[[int, int, int], bool]): 根据输入token数、最大生成长度及LoRA adapter判断引擎资源是否充足
+
+        Returns:
+            dict: 取出的请求，无可调度请求时返回None
+        """
+        with self.lock:
+            task = self._pop(is_resource_sufficient)
+            if task is not None:
+                self.sample_num -= self._count_samples(task)
+            return task
+
+    def requeue(self, task):
+        """
+        重新放入被抢占的请求，排在相同优先级的新请求之前
+        """
+        with self.lock:
+            self._requeue(task)
+            self.sample_num += self._count_samples(task)
+
+    def peek(self):
+        """
+        查看下一个待调度的请求，不取出
+        """
+        with self.lock:
+            return self._peek()
+
+    def remove(self, req_ids):
+        """
+        移除指定req_id的缓存请求
+
+        Returns:
+            list[dict]: 被移除的请求
+        """
+        with self.lock:
+            removed_tasks = self._remove(req_ids)
+            self.sample_num -= sum(self._count_samples(task) for task in removed_tasks)
+            return removed_tasks
+
+    def __len__(self):
+        raise NotImplementedError
+
+    @staticmethod
+    def _count_samples(task):
+        return 1 + len(task.get("forked_tasks") or [])
+
+    @staticmethod
+    def _fits(task, is_resource_sufficient):
+        return is_resource_sufficient(len(task["input_ids"]), task.get("max_dec_len"), task.get("lora_key", 0))
+
+    def _put(self, task):
+        raise NotImplementedError
+
+    def _requeue(self, task):
+        raise NotImplementedError
+
+    def _peek(self):
+        raise NotImplementedError
+
+    def _remove(self, req_ids):
+        raise NotImplementedError
+
+    def _pop(self, is_resource_sufficient):
+        raise NotImplementedError
+
+
+class FIFOScheduler(BaseScheduler):
+    """
+    先来先服务，队首请求资源不足时停止调度
+    """
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        # 从左侧插入，从右侧取出
+        self.tasks = deque()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def _put(self, task):
+        self.tasks.appendleft(task)
+
+    def _requeue(self, task):
+        self.tasks.append(task)
+
+    def _peek(self):
+        return self.tasks[-1] if self.tasks else None
+
+    def _remove(self, req_ids):
+        removed_tasks = [task for task in self.tasks if task["req_id"] in req_ids]
+        if removed_tasks:
+            self.tasks = deque(task for task in self.tasks if task["req_id"] not in req_ids)
+        return removed_tasks
+
+    def _pop(self, is_resource_sufficient):
+        if not self.tasks or not self._fits(self.tasks[-1], is_resource_sufficient):
+            return None
+        return self.tasks.pop()
+
+
+class SkipAheadScheduler(FIFOScheduler):
+    """
+    先来先服务，队首请求资源不足时，在有限窗口内跳过队首选择资源满足的较小请求，减少队头阻塞
+    队首请求被跳过的次数达到上限后不再跳过，避免长请求饿死
+    """
+    def _pop(self, is_resource_sufficient):
+        if not self.tasks:
+            return None
+        head = self.tasks[-1]
+        if self._fits(head, is_resource_sufficient):
+            return self.tasks.pop()
+        if head.get("schedule_skip_times", 0) >= self.cfg.schedule_max_skip_times:
+            return None
+        window = min(self.cfg.schedule_window, len(self.tasks))
+        for i in range(2, window + 1):
+            if self._fits(self.tasks[-i], is_resource_sufficient):
+                head["schedule_skip_times"] = head.get("schedule_skip_times", 0) + 1
+                task = self.tasks[-i]
+                del self.tasks[-i]
+                return task
+        return None
+
+
+class HeapScheduler(BaseScheduler):
+    """
+    按优先级键取出请求的调度基类，键相同时先来先服务
+    堆中元素为 (键, 入队顺序, 入堆序号, 请求)，入堆序号唯一，保证不会比较到请求字典
+    """
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.tasks = list()
+        self.counter = itertools.count()
+        self.push_counter = itertools.count()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def _key(self, task):
+        raise NotImplementedError
+
+    def _put(self, task):
+        task["schedule_order"] = next(self.counter)
+        task["schedule_enqueue_time"] = time.monotonic()
+        # n>1请求的其余采样在首个采样prefill完成后才放入队列，沿用请求的入队顺序与时间
+        for forked_task in task.get("forked_tasks") or []:
+            forked_task["schedule_order"] = task["schedule_order"]
+            forked_task["schedule_enqueue_time"] = task["schedule_enqueue_time"]
+        self._push(task)
+
+    def _requeue(self, task):
+        # 沿用首次入队的顺序与时间，先于之后到达的相同优先级请求
+        task.setdefault("schedule_enqueue_time", time.monotonic())
+        self._push(task)
+
+    def _push(self, task):
+        heapq.heappush(self.tasks, (self._key(task), task.get("schedule_order", -1), next(self.push_counter), task))
+
+    def _peek(self):
+        return self.tasks[0][-1] if self.tasks else None
+
+    def _remove(self, req_ids):
+        removed_tasks = [item[-1] for item in self.tasks if item[-1]["req_id"] in req_ids]
+        if removed_tasks:
+            self.tasks = [item for item in self.tasks if item[-1]["req_id"] not in req_ids]
+            heapq.heapify(self.tasks)
+        return removed_tasks
+
+    def _pop(self, is_resource_sufficient):
+        if not self.tasks or not self._fits(self.tasks[0][-1], is_resource_sufficient):
+            return None
+        return heapq.heappop(self.tasks)[-1]
+
+
+class ShortestPromptFirstScheduler(HeapScheduler):
+    """
+    输入token数最少的请求优先，并按等待时间老化，避免持续到达的短请求使长请求饿死：
+    每等待1秒相当于输入减少SCHEDULE_SPF_AGING_RATE个token，即按 token数 - rate * (当前时间 - 入队时间) 排序，
+    各请求之间的相对顺序不随当前时间变化，等价于按 token数 + rate * 入队时间 排序
+    """
+    def _key(self, task):
+        return len(task["input_ids"]) + self.cfg.schedule_spf_aging_rate * task["schedule_enqueue_time"]
+
+
+class PriorityScheduler(HeapScheduler):
+    """
+    按请求的priority字段调度，数值越大优先级越高，默认为0
+    """
+    def _key(self, task):
+        return -task.get("priority", 0)
+
+
+SCHEDULERS = {
+    "fifo": FIFOScheduler,
+    "skip_ahead": SkipAheadScheduler,
+    "spf": ShortestPromptFirstScheduler,
+    "priority": PriorityScheduler,
+}
+
+
+def create_scheduler(cfg):
+    """
+    根据配置创建调度器
+    """
+    if cfg.schedule_policy not in SCHEDULERS:
+        raise ValueError(f"unknown schedule policy: {cfg.schedule_policy}, "
+                         f"should be one of {list(SCHEDULERS.keys())}")
+    model_server_logger.info(f"create scheduler with policy: {cfg.schedule_policy}")
+    return SCHEDULERS[cfg.schedule_policy](cfg)
@@ -0,0 +1,135 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+# 与speculate_save_output算子的输出格式一致：
+# [0]为信号位，[1]为batch size，[2, 2+bsz)为各位置本步接受的token数，
+# 从2+SPECULATE_MAX_BSZ开始，每个位置占SPECULATE_MAX_TOKENS_PER_STEP个token
+SPECULATE_MAX_BSZ = 256
+SPECULATE_MAX_TOKENS_PER_STEP = 6
+
+
+def speculate_output_size():
+    """
+    投机解码输出Tensor的长度
+    """
+    return SPECULATE_MAX_BSZ * SPECULATE_MAX_TOKENS_PER_STEP + SPECULATE_MAX_BSZ + 2
+
+
+def parse_speculate_output(output_tokens):
+    """
+    解析投机解码的输出，取出各位置本步接受的token
+
+    Args:
+        output_tokens (np.ndarray): speculate_get_output获取的输出，shape为[speculate_output_size(), 1]
+
+    Returns:
+        list[np.ndarray]: 各位置本步接受的token，未接受时为空
+    """
+    bsz = int(output_tokens[1, 0])
+    accept_num = output_tokens[2:2 + bsz, 0]
+    start = 2 + SPECULATE_MAX_BSZ
+    tokens = output_tokens[start:start + bsz * SPECULATE_MAX_TOKENS_PER_STEP, 0].reshape(
+        [bsz, SPECULATE_MAX_TOKENS_PER_STEP])
+    return [tokens[i, :max(int(accept_num[i]), 0)] for i in range(bsz)]
+
+
+class NgramProposer(object):
+    """
+    基于请求自身上下文（prompt与已生成token）的n-gram草稿生成，即prompt lookup decoding：
+    以上下文末尾的n个token在上下文中查找最近一次出现的位置，将其后的token作为草稿，
+    n从max_ngram_size递减到1，摘要、代码修改等大量复制输入内容的场景接受率较高
+    """
+    def __init__(self, max_ngram_size, max_draft_tokens):
+        self.max_ngram_size = max_ngram_size
+        self.max_draft_tokens = max_draft_tokens
+
+    def propose(self, context, max_draft_tokens=None):
+        """
+        生成草稿token
+
+        Args:
+            context (np.ndarray): 位置当前的上下文token
+            max_draft_tokens (int): 本次最多生成的草稿token数，为None时使用配置值
+
+        Returns:
+            np.ndarray: 草稿token，无匹配时为空
+        """
+        if max_draft_tokens is None:
+            max_draft_tokens = self.max_draft_tokens
+        context_len = len(context)
+        if max_draft_tokens <= 0 or context_len < 2:
+            return context[:0]
+        for n in range(min(self.max_ngram_size, context_len - 1), 0, -1):
+            pattern = context[context_len - n:]
+            # 候选起点逐个token过滤，不包含上下文末尾的n-gram自身
+            starts = np.flatnonzero(context[:context_len - n] == pattern[0])
+            for k in range(1, n):
+                if len(starts) == 0:
+                    break
+                starts = starts[context[starts + k] == pattern[k]]
+            if len(starts) > 0:
+                draft_start = starts[-1] + n
+                return context[draft_start:draft_start + max_draft_tokens]
+        return context[:0]
+
+
+class SpeculateDrafter(object):
+    """
+    推理进程中为各位置维护上下文，在每个推理步后为处于解码阶段的位置生成下一步的草稿token
+    """
+    def __init__(self, proposer, max_batch_size, max_context_len):
+        self.proposer = proposer
+        self.contexts = np.zeros([max_batch_size, max_context_len], dtype=np.int64)
+        self.context_lens = np.zeros([max_batch_size], dtype=np.int64)
+
+    def reset(self, slot, token_ids, start=0):
+        """
+        插入任务时以输入token初始化位置的上下文，分块prefill的后续分块从start位置写入，
+        保留之前分块的token，丢弃中间分块生成的无意义token
+        """
+        start = min(start, self.context_lens[slot], self.contexts.shape[1])
+        token_num = min(len(token_ids), self.contexts.shape[1] - start)
+        self.contexts[slot, start:start + token_num] = token_ids[:token_num]
+        self.context_lens[slot] = start + token_num
+
+    def append(self, slot, token_ids):
+        """
+        追加位置本步接受的token
+        """
+        start = self.context_lens[slot]
+        token_num = min(len(token_ids), self.contexts.shape[1] - start)
+        self.contexts[slot, start:start + token_num] = token_ids[:token_num]
+        self.context_lens[slot] = start + token_num
+
+    def propose(self, slot, max_draft_tokens):
+        """
+        为位置生成草稿token，返回位置上下文的最后一个token及草稿token
+        """
+        context = self.contexts[slot, :self.context_lens[slot]]
+        if len(context) == 0:
+            return None, context
+        return context[-1], self.proposer.propose(context, max_draft_tokens)
+
+
+def create_proposer(cfg):
+    """
+    根据配置创建草稿生成器，未开启投机解码时返回None
+    """
+    if cfg.speculate_method == "none":
+        return None
+    if cfg.speculate_method == "ngram":
+        return NgramProposer(cfg.speculate_max_ngram_size, cfg.speculate_max_draft_tokens)
+    raise ValueError(f"unknown speculate method: {cfg.speculate_method}, should be one of none and ngram")
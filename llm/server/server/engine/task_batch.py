@@ -0,0 +1,257 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+# 每个任务的整型参数，按列存储
+INT_FIELDS = (
+    "idx",
+    "token_num",  # 本次需要prefill的token数
+    "prefill_start",  # 已在KV Cache中的prompt token数，包括命中前缀缓存及已完成的prefill分块
+    "block_num",
+    "eos_num",
+    "min_dec_len",
+    "max_dec_len",  # -1表示使用推理进程的默认值
+    "infer_seed",
+    "guided_fsm",  # 约束解码状态机的key，0表示不使用约束解码
+    "guided_state",  # 约束解码的初始状态，被抢占的任务恢复时为已生成token之后的状态
+    "lora_key",  # LoRA adapter的key，0表示不使用adapter
+    "lora_slot",  # adapter在显存中的位置，-1表示不使用adapter
+    "kv_transfer_key",  # prefill实例在prefill后发送、decode实例在插入时接收KV的key，0表示不传输
+    "context_num",  # 随首个分块发送的prefill_start之前的token数，用于初始化投机解码的上下文
+)
+# 每个任务的采样参数及默认值，需与checker.add_default_params保持一致
+FLOAT_FIELDS = (
+    ("topp", 0.7),
+    ("temperature", 0.95),
+    ("penalty_score", 1.0),
+    ("frequency_score", 0.0),
+    ("presence_score", 0.0),
+)
+INT_FIELD_INDEX = {name: i for i, name in enumerate(INT_FIELDS)}
+FLOAT_FIELD_INDEX = {name: i for i, (name, _) in enumerate(FLOAT_FIELDS)}
+
+VERSION = 6
+
+# 推理进程插入任务失败时写入共享内存的错误码，推理进程停止该位置，引擎回收资源并结束任务
+SLOT_ERROR_NONE = 0
+SLOT_ERROR_GUIDED_FSM = 1  # 约束解码状态机不存在或与模型词表不一致
+SLOT_ERROR_LORA = 2  # LoRA adapter不存在或加载失败
+SLOT_ERROR_KV_TRANSFER = 3  # 接收prefill实例发送的KV失败，引擎重新计算prompt，不返回错误
+SLOT_ERROR_MESSAGES = {
+    SLOT_ERROR_GUIDED_FSM: "failed to load the guided decoding fsm",
+    SLOT_ERROR_LORA: "failed to load the lora adapter",
+    SLOT_ERROR_KV_TRANSFER: "failed to import the kv from the prefill instance",
+}
+# 头部字段：版本号、任务数、real_bsz、token总数、block总数、eos总数、停止位置数、上下文token总数
+META_NUM = 8
+
+
+class TaskBatch(object):
+    """
+    引擎发送给推理进程的一批任务，按列存储的定长二进制格式
+    1. 头部为int64元信息，随后依次为int64参数矩阵、float32采样参数矩阵
+    2. 所有任务的prompt token、block table、eos token分别拼接为连续数组，按各自的数量切分
+    3. 随后为需要推理进程停止的位置，用于抢占等场景
+    4. 最后为各任务首个分块prefill_start之前的token，只在开启投机解码时发送
+    序列化与反序列化的开销与数据字节数成正比，与Python对象数量无关
+    """
+    def __init__(self, real_bsz, int_values, float_values, token_ids, block_tables, eos_token_ids, stop_slots,
+                 context_token_ids):
+        self.real_bsz = int(real_bsz)
+        self.int_values = int_values
+        self.float_values = float_values
+        self.token_ids = token_ids
+        self.block_tables = block_tables
+        self.eos_token_ids = eos_token_ids
+        self.stop_slots = stop_slots
+        self.context_token_ids = context_token_ids
+        self.token_offsets = self._offsets("token_num")
+        self.context_offsets = self._offsets("context_num")
+        self.block_offsets = self._offsets("block_num")
+        self.eos_offsets = self._offsets("eos_num")
+
+    @classmethod
+    def from_tasks(cls, tasks, real_bsz, stop_slots=None, with_context=False):
+        """
+        由引擎侧的任务字典构造
+
+        Args:
+            tasks (list[dict]): 新插入的任务
+            real_bsz (int): 引擎当前的batch size
+            stop_slots (list[int]): 需要推理进程停止生成的位置
+            with_context (bool): 是否随首个分块发送prefill_start之前的token（命中前缀缓存或从prefill实例接收KV），
+                推理进程以完整的输入初始化投机解码的上下文
+        """
+        task_num = len(tasks)
+        int_values = np.zeros([task_num, len(INT_FIELDS)], dtype=np.int64)
+        float_values = np.zeros([task_num, len(FLOAT_FIELDS)], dtype=np.float32)
+        token_ids, block_tables, eos_token_ids, context_token_ids = [], [], [], []
+        for i, task in enumerate(tasks):
+            prefill_start = task.get("prefill_start", 0)
+            # 后续分块的prefill_start之前的token已随之前的分块发送
+            context_num = 0
+            if with_context and prefill_start == task.get("cached_token_num", prefill_start):
+                context_num = prefill_start
+                context_token_ids.append(np.asarray(task["input_ids"][:prefill_start], dtype=np.int32))
+            prefill_end = task.get("prefill_end", len(task["input_ids"]))
+            input_ids = np.asarray(task["input_ids"][prefill_start:prefill_end], dtype=np.int32)
+            min_dec_len = task.get("min_dec_len", 1)
+            max_dec_len = task.get("max_dec_len", task.get("seq_len", -1))
+            kv_transfer_key = task.get("kv_transfer_key", 0)
+            if prefill_end < len(task["input_ids"]):
+                # 分块prefill的中间分块只生成1个token，生成后推理进程即停止该位置，等待下一个分块；
+                # prefill实例在最后一个分块计算完成后才发送KV
+                min_dec_len, max_dec_len = 1, 1
+                kv_transfer_key = 0
+            eos = task["eos_token_ids"] if isinstance(task["eos_token_ids"], list) else [task["eos_token_ids"]]
+            token_ids.append(input_ids)
+            block_tables.append(np.asarray(task["block_tables"], dtype=np.int32))
+            eos_token_ids.append(np.asarray(eos, dtype=np.int64))
+            int_values[i] = (
+                task["idx"],
+                len(input_ids),
+                prefill_start,
+                len(task["block_tables"]),
+                len(eos),
+                min_dec_len,
+                max_dec_len,
+                task.get("infer_seed", 0),
+                task.get("guided_fsm", 0),
+                task.get("guided_state", 0),
+                task.get("lora_key", 0),
+                task.get("lora_slot", -1),
+                kv_transfer_key,
+                context_num,
+            )
+            float_values[i] = [task.get(name, default) for name, default in FLOAT_FIELDS]
+        return cls(
+            real_bsz,
+            int_values,
+            float_values,
+            cls._concat(token_ids, np.int32),
+            cls._concat(block_tables, np.int32),
+            cls._concat(eos_token_ids, np.int64),
+            np.asarray(stop_slots if stop_slots else [], dtype=np.int64),
+            cls._concat(context_token_ids, np.int32),
+        )
+
+    def encode(self):
+        """
+        序列化为bytes
+        """
+        meta = np.array([VERSION, len(self), self.real_bsz, len(self.token_ids), len(self.block_tables),
+                         len(self.eos_token_ids), len(self.stop_slots), len(self.context_token_ids)], dtype=np.int64)
+        return b"".join([
+            meta.tobytes(),
+            self.int_values.tobytes(),
+            self.float_values.tobytes(),
+            self.token_ids.tobytes(),
+            self.block_tables.tobytes(),
+            self.eos_token_ids.tobytes(),
+            self.stop_slots.tobytes(),
+            self.context_token_ids.tobytes(),
+        ])
+
+    @classmethod
+    def decode(cls, payload):
+        """
+        从bytes反序列化，各数组直接引用payload的内存，不做拷贝
+        """
+        meta = np.frombuffer(payload, dtype=np.int64, count=META_NUM)
+        version = int(meta[0])
+        if version != VERSION:
+            raise ValueError(f"unsupported task batch version: {version}, expected {VERSION}")
+        _, task_num, real_bsz, token_total, block_total, eos_total, stop_total, context_total = [int(x) for x in meta]
+        offset = meta.nbytes
+
+        def _take(dtype, count, shape=None):
+            nonlocal offset
+            array = np.frombuffer(payload, dtype=dtype, count=count, offset=offset)
+            offset += array.nbytes
+            return array.reshape(shape) if shape is not None else array
+
+        int_values = _take(np.int64, task_num * len(INT_FIELDS), [task_num, len(INT_FIELDS)])
+        float_values = _take(np.float32, task_num * len(FLOAT_FIELDS), [task_num, len(FLOAT_FIELDS)])
+        token_ids = _take(np.int32, token_total)
+        block_tables = _take(np.int32, block_total)
+        eos_token_ids = _take(np.int64, eos_total)
+        stop_slots = _take(np.int64, stop_total)
+        context_token_ids = _take(np.int32, context_total)
+        return cls(real_bsz, int_values, float_values, token_ids, block_tables, eos_token_ids, stop_slots,
+                   context_token_ids)
+
+    def __len__(self):
+        return self.int_values.shape[0]
+
+    def column(self, name):
+        """
+        获取所有任务的某个参数
+        """
+        if name in INT_FIELD_INDEX:
+            return self.int_values[:, INT_FIELD_INDEX[name]]
+        return self.float_values[:, FLOAT_FIELD_INDEX[name]]
+
+    def get_token_ids(self, i):
+        """
+        第i个任务本次需要prefill的token
+        """
+        return self.token_ids[self.token_offsets[i]:self.token_offsets[i + 1]]
+
+    def get_context_token_ids(self, i):
+        """
+        第i个任务随首个分块发送的prefill_start之前的token
+        """
+        return self.context_token_ids[self.context_offsets[i]:self.context_offsets[i + 1]]
+
+    def get_block_tables(self, i):
+        """
+        第i个任务的block table
+        """
+        return self.block_tables[self.block_offsets[i]:self.block_offsets[i + 1]]
+
+    def get_eos_token_ids(self, i):
+        """
+        第i个任务的eos token
+        """
+        return self.eos_token_ids[self.eos_offsets[i]:self.eos_offsets[i + 1]]
+
+    def padded_token_ids(self, width, pad_id):
+        """
+        各任务的token按行补齐为[任务数, width]的矩阵
+        """
+        return self._pad(self.token_ids, "token_num", width, pad_id, np.int64)
+
+    def padded_block_tables(self, width):
+        """
+        各任务的block table按行补齐为[任务数, width]的矩阵，空位为-1
+        """
+        return self._pad(self.block_tables, "block_num", width, -1, np.int32)
+
+    def _pad(self, values, count_name, width, pad_value, dtype):
+        padded = np.full([len(self), width], pad_value, dtype=dtype)
+        # 按行优先顺序的掩码与拼接顺序一致
+        padded[np.arange(width) < self.column(count_name)[:, None]] = values
+        return padded
+
+    def _offsets(self, name):
+        offsets = np.zeros([len(self) + 1], dtype=np.int64)
+        np.cumsum(self.column(name), out=offsets[1:])
+        return offsets
+
+    @staticmethod
+    def _concat(arrays, dtype):
+        if not arrays:
+            return np.zeros([0], dtype=dtype)
+        return np.concatenate(arrays).astype(dtype, copy=False)
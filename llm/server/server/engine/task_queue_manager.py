@@ -12,148 +12,243 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
 import os
-import threading
-import time
-from queue import Queue
-from multiprocessing.managers import (
-    AcquirerProxy,
-    BaseManager,
-    ListProxy,
-    Value,
-    ValueProxy,
-)
-
-from server.utils import get_logger
+import select
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from server.utils import HOT_PATH, get_logger
 
 logger = get_logger("infer_server", "task_queue_manager.log")
 
+# 共享内存头部字段的下标
+WRITE_POS = 0  # 生产者已发布数据的末尾位置
+READ_POS = 1  # 所有rank均已读取数据的末尾位置
+READ_LIMIT = 2  # 本轮各rank读取数据的末尾位置，由rank 0确定
+HEADER_NUM = 4
+# 数据记录的长度前缀字节数，长度为-1表示剩余空间不足，下一条记录从头部开始
+RECORD_HEADER_BYTES = 8
+WRAP_FLAG = -1
 
-class QueueManager(BaseManager):
+
+class Notifier(object):
     """
-    基础类
+    基于命名管道的跨进程通知，等待方通过select阻塞至被唤醒或超时，替代sleep轮询
     """
+    def __init__(self, name):
+        self.path = os.path.join("/dev/shm", name)
+        try:
+            os.mkfifo(self.path)
+        except FileExistsError:
+            pass
+        # 以读写方式打开，避免open时阻塞等待对端
+        self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
 
-    pass
+    def notify(self):
+        """
+        唤醒等待方，管道已满时说明已有未处理的通知，直接忽略
+        """
+        try:
+            os.write(self.fd, b"\0")
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise e
+
+    def wait(self, timeout):
+        """
+        等待通知，返回是否被唤醒
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        # 合并所有未处理的通知
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self, unlink=False):
+        """
+        关闭管道
+        """
+        os.close(self.fd)
+        if unlink:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
 
 
 class TaskQueueManager(object):
     """
-    管理类
+    引擎与各推理rank之间的任务队列，基于共享内存的单生产者多消费者环形缓冲区
+    1. 引擎进程是唯一的生产者，put时将序列化后的数据写入环形缓冲区，再发布写入位置
+    2. rank 0确定本轮读取范围，所有rank读取同一段数据并标记各自的读取位，全部读取后回收空间
+    3. 各字段的写入方：WRITE_POS只由引擎写入，READ_LIMIT只由rank 0在poll中写入，各rank在get中设置自己的读取位；
+       READ_POS及读取位的清零由本轮最后完成读取的rank写入，多个rank同时判定为最后一个时写入的值相同
+    4. 不使用跨进程锁，依赖推理进程每轮在poll与get之间的barrier：rank 0在barrier之前确定READ_LIMIT，
+       各rank在barrier之后才读取；读取位未清零时poll不会修改READ_LIMIT，而各rank完成本轮get后才会进入下一轮的barrier，
+       因此下一轮读取总在本轮READ_POS推进、读取位清零之后开始。引擎只读取READ_POS，回收的空间不会再被读取。
+       数据与位置的可见顺序依赖x86的写入顺序保证
     """
 
-    def __init__(self, rank=0, mp_num=8, port=56666):
+    def __init__(self, rank=0, mp_num=8, port=56666, create=False):
         """
         初始化函数，用于创建对象时进行初始化操作。
+
+        rank: 推理进程的rank，引擎端为0
+        mp_num: 推理进程的数量
+        port: 队列标识，同一服务的引擎与推理进程需保持一致
+        create: 是否创建共享内存，由引擎端创建，推理进程连接
         """
-        self.max_get_num = int(os.getenv("ENGINE_MAX_NEED_NUM", 0))
-        QueueManager.register('get_list')
-        QueueManager.register('get_value')
-        QueueManager.register('get_lock')
-        QueueManager.register('get_barrier1')
-        QueueManager.register('get_barrier2')
-        QueueManager.register('get_queue')
-
-        self.client_manager = QueueManager(address=('127.0.0.1', port),
-                                           authkey=b'infer_queue'
-                                           )
-        self.client_manager.connect()
-        self.list = self.client_manager.get_list()
-        self.value = self.client_manager.get_value()
-        self.lock = self.client_manager.get_lock()
-        self.barrier1 = self.client_manager.get_barrier1()
-        self.barrier2 = self.client_manager.get_barrier2()
-        self.queue = self.client_manager.get_queue()
         self.mp_num = mp_num
         self.rank = rank
-        self.position = 1 << rank
-        self.total_num = (1 << self.mp_num) - 1
-        logger.info(f"init task queue manager success, rank: {rank}")
+        self.create = create
+        self.capacity = int(os.getenv("INFER_QUEUE_CAPACITY", 16 * 1024 * 1024))
+        self.capacity = (self.capacity + RECORD_HEADER_BYTES - 1) // RECORD_HEADER_BYTES * RECORD_HEADER_BYTES
+
+        header_bytes = HEADER_NUM * 8
+        flag_bytes = (self.mp_num + 7) // 8 * 8
+        total_bytes = header_bytes + flag_bytes + self.capacity
+        name = f"fd_infer_queue_{port}"
+        if create:
+            try:
+                tmp = shared_memory.SharedMemory(create=False, name=name)
+                tmp.close()
+                tmp.unlink()
+            except:
+                pass
+            self.shm = shared_memory.SharedMemory(create=True, size=total_bytes, name=name)
+        else:
+            self.shm = shared_memory.SharedMemory(create=False, name=name)
+        self.header = np.ndarray([HEADER_NUM], dtype=np.int64, buffer=self.shm.buf)
+        # 每个rank的读取位，各rank设置自己的位置，本轮最后完成读取的rank统一清零
+        self.read_flags = np.ndarray([self.mp_num], dtype=np.uint8, buffer=self.shm.buf, offset=header_bytes)
+        self.data = self.shm.buf[header_bytes + flag_bytes:header_bytes + flag_bytes + self.capacity]
+        if create:
+            self.header[:] = 0
+            self.read_flags[:] = 0
+
+        # put时唤醒rank 0，所有rank读取完毕时唤醒引擎的插入线程
+        self.put_notifier = Notifier(f"fd_infer_queue_put_{port}")
+        self.consumed_notifier = Notifier(f"fd_infer_queue_consumed_{port}")
+        logger.info(f"init task queue manager success, rank: {rank}, capacity: {self.capacity}")
 
     def empty(self):
         """
-        暴露至推理端，用于判断队列是否为空
+        判断队列中是否有未被所有rank读取的数据
         """
-        try:
-            return len(self.list) == 0
-        except Exception as e:
-            logger.error(f"empty function meets error: {e}")
-            raise e
-
-    def put(self, item):
-        """
-        向队列中添加数据
-        """
-        self.lock.acquire()
-        if 0 < self.value.get() < self.total_num:
-            self.lock.release()
-            while 0 < self.value.get() < self.total_num:
-                time.sleep(0.001)
-            logger.info("put item to queue wait finish")
-            self.lock.acquire()
-        if self.max_get_num <= 0 and self.value.get() == self.total_num:
-            self.list[:] = []
-        self.value.set(0)
-        self.list.append(item)
-        self.lock.release()
-        logger.info("put item to queue success")
+        return self.header[READ_POS] == self.header[WRITE_POS]
+
+    def put(self, payload):
+        """
+        向队列中添加序列化后的数据，剩余空间不足时等待各rank读取
+        """
+        record_bytes = RECORD_HEADER_BYTES + \
+            (len(payload) + RECORD_HEADER_BYTES - 1) // RECORD_HEADER_BYTES * RECORD_HEADER_BYTES
+        if record_bytes > self.capacity:
+            raise Exception(f"The size of item ({record_bytes} bytes) exceeds the capacity of "
+                            f"task queue ({self.capacity} bytes), please increase INFER_QUEUE_CAPACITY.")
+
+        write_pos = int(self.header[WRITE_POS])
+        offset = write_pos % self.capacity
+        # 剩余连续空间放不下时，跳到缓冲区头部写入
+        padding = self.capacity - offset if self.capacity - offset < record_bytes else 0
+        while write_pos + padding + record_bytes - int(self.header[READ_POS]) > self.capacity:
+            self.consumed_notifier.wait(0.001)
+        if padding > 0:
+            self._write_int64(offset, WRAP_FLAG)
+            write_pos += padding
+            offset = 0
+        self._write_int64(offset, len(payload))
+        start = offset + RECORD_HEADER_BYTES
+        self.data[start:start + len(payload)] = payload
+        # 数据写入完成后再发布写入位置
+        self.header[WRITE_POS] = write_pos + record_bytes
+        self.put_notifier.notify()
+        logger.info("put item to queue success", extra=HOT_PATH)
+
+    def poll(self):
+        """
+        由rank 0调用，判断是否有新数据，并确定本轮所有rank读取的数据范围
+        """
+        if self.read_flags.any():
+            return True
+        if self.empty():
+            return False
+        self.header[READ_LIMIT] = self.header[WRITE_POS]
+        return True
 
     def get(self):
         """
-        从队列中获取数据
+        从队列中获取本轮数据，所有rank读取的数据相同
+
+        Returns:
+            list[bytes]: 读取的数据
+            bool: 是否所有rank均已完成本轮读取
         """
         input_list = []
         read_finish = False
-        self.lock.acquire()
-        if self.value.get() & self.position == 0 and len(self.list) > 0:
-            # 控制进入引擎的输入数量. 默认服务中所有输入都拷贝进引擎一起处理
-            if self.max_get_num > 0:
-                input_list.extend(self.list[: self.max_get_num])
-            else:
-                input_list.extend(self.list[:])
-            set_value = self.value.get() | self.position
-            logger.info("rank: {0} set_value: {1}".format(self.rank, set_value))
-            if set_value >= self.total_num:
-                if self.max_get_num > 0:
-                    for i in range(self.max_get_num):
-                        self.list.pop(0)
-                else:
-                    self.list[:] = []
-                set_value = 0
-                read_finish = True
-            self.value.set(set_value)
-        self.lock.release()
+        read_pos = int(self.header[READ_POS])
+        read_limit = int(self.header[READ_LIMIT])
+        if self.read_flags[self.rank] or read_pos >= read_limit:
+            return input_list, read_finish
+
+        pos = read_pos
+        while pos < read_limit:
+            offset = pos % self.capacity
+            length = self._read_int64(offset)
+            if length == WRAP_FLAG:
+                pos += self.capacity - offset
+                continue
+            start = offset + RECORD_HEADER_BYTES
+            # 拷贝出数据，空间在所有rank读取后会被复用
+            input_list.append(bytes(self.data[start:start + length]))
+            pos += RECORD_HEADER_BYTES + \
+                (length + RECORD_HEADER_BYTES - 1) // RECORD_HEADER_BYTES * RECORD_HEADER_BYTES
+
+        self.read_flags[self.rank] = 1
+        logger.info("rank: {0} read {1} items".format(self.rank, len(input_list)), extra=HOT_PATH)
+        # 最后完成读取的rank回收空间，多个rank同时判定时写入的值相同
+        if self.read_flags.all():
+            self.header[READ_POS] = read_limit
+            self.read_flags[:] = 0
+            read_finish = True
+            self.consumed_notifier.notify()
         return input_list, read_finish
 
+    def wait_for_put(self, timeout):
+        """
+        推理端等待新数据写入队列
+        """
+        return self.put_notifier.wait(timeout)
 
-def launch_queue_service(port, num_workers):
-    """
-    启动进程间通信队列服务
+    def wait_for_consumed(self, timeout):
+        """
+        引擎端等待队列中的数据被所有rank读取
+        """
+        return self.consumed_notifier.wait(timeout)
 
-    port: 监听端口号
-    num_workers: infer进程的数量
-    """
-    try:
-        logger.info(f"start launch queue service, port:{port}")
-        value = Value("i", 0)
-        QueueManager.register("get_value", callable=lambda: value, proxytype=ValueProxy)
-        List = list()
-        QueueManager.register("get_list", callable=lambda: List, proxytype=ListProxy)
-        lock = threading.Lock()
-        QueueManager.register('get_lock',
-                            callable=lambda: lock,
-                            proxytype=AcquirerProxy)
-        barrier1 = threading.Barrier(num_workers)
-        QueueManager.register('get_barrier1', callable=lambda: barrier1)
-        barrier2 = threading.Barrier(num_workers)
-        QueueManager.register('get_barrier2', callable=lambda: barrier2)
-        q = Queue()
-        QueueManager.register("get_queue", callable=lambda: q)
-        m = QueueManager(address=('127.0.0.1', port), authkey=b'infer_queue')
-        s = m.get_server()
-        logger.info("launch queue service success")
-        s.serve_forever()
-        logger.info("finish queue service")
-    except Exception as e:
-        logger.error(f"launch queue service failed, error_msg: {e}")
-        raise e
+    def close(self):
+        """
+        释放共享内存，引擎端同时删除共享内存
+        """
+        del self.header
+        del self.read_flags
+        self.data.release()
+        self.shm.close()
+        self.put_notifier.close(unlink=self.create)
+        self.consumed_notifier.close(unlink=self.create)
+        if self.create:
+            self.shm.unlink()
+
+    def _write_int64(self, offset, value):
+        self.data[offset:offset + RECORD_HEADER_BYTES] = int(value).to_bytes(
+            RECORD_HEADER_BYTES, "little", signed=True)
+
+    def _read_int64(self, offset):
+        return int.from_bytes(self.data[offset:offset + RECORD_HEADER_BYTES], "little", signed=True)
@@ -21,7 +21,10 @@ import numpy as np
 from collections import Counter
 from datetime import datetime
 from paddlenlp_ops import get_output
-from server.utils import datetime_diff, model_server_logger, monitor_logger
+from server.engine.speculate import parse_speculate_output, speculate_output_size
+from server.engine.task_batch import SLOT_ERROR_KV_TRANSFER, SLOT_ERROR_MESSAGES
+from server.metrics import ServerMetrics
+from server.utils import HOT_PATH, datetime_diff, model_server_logger, monitor_logger
 
 
 class TokenProcessor(object):
@@ -39,7 +42,14 @@ class TokenProcessor(object):
         self.all_tokens = [[] for _ in range(self.cfg.max_batch_size)]
 
         self.tokens_counter = Counter()
-        self.output_tokens = paddle.full(shape=[self.cfg.max_batch_size + 2, 1], fill_value=2, dtype="int64")
+        if self.cfg.speculate_method == "none":
+            self.output_tokens = paddle.full(shape=[self.cfg.max_batch_size + 2, 1], fill_value=2, dtype="int64")
+            self.get_output = get_output
+        else:
+            # 投机解码时每个位置一步输出多个token
+            from paddlenlp_ops import speculate_get_output
+            self.output_tokens = paddle.full(shape=[speculate_output_size(), 1], fill_value=2, dtype="int64")
+            self.get_output = speculate_get_output
         self.worker = None
 
         self.record_time_interval = int(os.getenv("RECORD_TIME_INTERVAL", "600"))
@@ -48,6 +58,8 @@ class TokenProcessor(object):
         self.number_of_tasks = 0
         self.number_of_input_tokens = 0
         self.number_of_output_tokens = 0
+        # 请求级延迟与token数的直方图，通过METRICS_PORT导出
+        self.metrics = ServerMetrics()
 
     def set_resource_manager(self, resource_manager):
         """
@@ -76,7 +88,7 @@ class TokenProcessor(object):
             try:
                 rank_id = 0
                 is_blocking = True
-                get_output(self.output_tokens, rank_id, is_blocking)
+                self.get_output(self.output_tokens, rank_id, is_blocking)
 
                 if self.output_tokens[0, 0] == -2:
                     continue
@@ -108,11 +120,23 @@ class TokenProcessor(object):
             "req_id": task_id,
             "is_end": 0,
             "token_ids": [token_id],
-            "send_idx": self.tokens_counter[task_id],
+            # 被抢占后恢复的任务，从已发送的token数开始计数
+            "send_idx": len(task.get("generated_token_ids", [])) + self.tokens_counter[task_id],
             "inference_time_cost": inference_time_cost,
             "infer_seed": task["infer_seed"],
             "return_all_tokens": task.get("return_all_tokens", False),
         }
+        # 请求的首个结果携带prompt的token数，用于统计用量
+        if result["send_idx"] == 0:
+            result["input_token_num"] = task.get("prompt_token_num", len(task["input_ids"]))
+        # n>1的请求，标记结果所属的采样
+        if "sample_index" in task:
+            result["index"] = task["sample_index"]
+        # 开启合并发送的请求，由发送线程按参数合并后发送
+        # 设置了停止字符串的请求，由发送线程在解码后的文本中匹配
+        for key in ("coalesce_tokens", "coalesce_ms", "stop"):
+            if task.get(key) is not None:
+                result[key] = task[key]
 
         # 收集benchmark信息
         if task.get("benchmark"):
@@ -128,12 +152,18 @@ class TokenProcessor(object):
             result["token_ids"] = []
             result["tokens_all_num"] = len(self.all_tokens[i]) + 1
             result["tokens_all_ids"] = self.all_tokens[i]
+            # 用于统计用量及结束原因，被抢占后恢复的任务，max_dec_len为恢复时剩余的生成长度
+            result["input_token_num"] = task.get("prompt_token_num", len(task["input_ids"]))
+            result["output_token_num"] = len(self.all_tokens[i])
+            new_token_num = len(self.all_tokens[i]) - len(task.get("generated_token_ids", []))
+            result["finish_reason"] = "length" if new_token_num >= task["max_dec_len"] else "stop"
 
             # 生成请求的完整日志，用于平台监控
             info_dict = {}
             info_dict["req_id"] = task["req_id"]
             info_dict["input_token_num"] = len(task["input_ids"])
             info_dict["output_token_num"] = len(self.all_tokens[i])
+            info_dict["cached_token_num"] = task.get("cached_token_num", 0)
             if hasattr(task, "preprocess_start_time") and hasattr(task, "preprocess_end_time"):
                 info_dict["preprocess_cost_time"] = datetime_diff(task["preprocess_start_time"],
                                                                   task["preprocess_end_time"])
@@ -147,17 +177,85 @@ class TokenProcessor(object):
 
         return result
 
+    def _record_token_metrics(self, task, now, inter_token_times):
+        """
+        记录生成token的时延，请求的首个token记录排队时间与首token时延，之后的token记录与上一个token的间隔
+        被抢占后恢复的任务，恢复后首个token的间隔包含重新调度的等待时间
+        """
+        last_token_time = task.get("last_token_time")
+        task["last_token_time"] = now
+        if last_token_time is not None:
+            inter_token_times.append(now - last_token_time)
+            return
+        if "preprocess_end_time" in task and "schedule_start_time" in task:
+            self.metrics.queue_wait_time.observe(
+                (task["schedule_start_time"] - task["preprocess_end_time"]).total_seconds())
+        if "preprocess_start_time" in task:
+            self.metrics.first_token_time.observe(now - task["preprocess_start_time"].timestamp())
+
+    def _record_finished_metrics(self, index, task, now):
+        """
+        记录已完成请求的端到端时延、token数及被抢占次数
+        """
+        if "preprocess_start_time" in task:
+            self.metrics.request_time.observe(now - task["preprocess_start_time"].timestamp())
+        self.metrics.prompt_tokens.observe(task.get("prompt_token_num", len(task["input_ids"])))
+        self.metrics.output_tokens.observe(len(self.all_tokens[index]))
+        self.metrics.preemptions.observe(task.get("preempted_times", 0))
+
     def _recycle_resources(self, task_id, index, task):
         """
         对于已完成的任务，回收资源
         """
-        self.resource_manager.stop_flags[index] = True
-        self.resource_manager.tasks_list[index] = None
+        self.resource_manager.release_slot(index)
         self.resource_manager._recycle_block_tables(task["block_tables"])
         if task_id in self.tokens_counter:
             del self.tokens_counter[task_id]
         self.all_tokens[index] = list()
 
+    def _preempt_resources(self, task_id, index, task):
+        """
+        被抢占的任务在推理进程中结束后回收资源，并重新放入调度队列
+
+        Returns:
+            bool: 是否重新调度，任务已生成到max_dec_len时返回False，按正常结束处理
+        """
+        generated_token_ids = self.all_tokens[index]
+        new_token_num = len(generated_token_ids) - len(task.get("generated_token_ids", []))
+        if new_token_num >= task["max_dec_len"]:
+            return False
+        self._recycle_resources(task_id, index, task)
+        self.resource_manager.requeue_preempted_task(task, generated_token_ids)
+        return True
+
+    def _abort_result(self, i, task_id, task):
+        """
+        被取消的任务在推理进程中停止后回收资源，返回结束结果
+        """
+        result = self._get_single_result(i, task_id, task["eos_token_ids"][0], task)
+        result["finish_reason"] = "abort"
+        self._recycle_resources(task_id, i, task)
+        model_server_logger.info(f"req_id: {task_id} aborted, generated token num: {len(result['tokens_all_ids'])}")
+        return result
+
+    def _slot_error_result(self, i, task_id, task, slot_error):
+        """
+        推理进程插入任务失败并停止位置后回收资源：接收KV失败的任务重新放入调度队列计算prompt，不返回结果；
+        其余任务返回错误结果，n>1请求等待首个采样prefill的其余采样放入调度队列
+        """
+        self.resource_manager.release_forked_tasks(task)
+        if slot_error == SLOT_ERROR_KV_TRANSFER:
+            self._recycle_resources(task_id, i, task)
+            self.resource_manager.requeue_preempted_task(task, task.get("generated_token_ids", []))
+            model_server_logger.warning(f"req_id: {task_id} failed to import kv, recompute the prompt")
+            return None
+        error_msg = SLOT_ERROR_MESSAGES.get(slot_error, f"unknown slot error {slot_error}")
+        result = self._get_single_result(i, task_id, task["eos_token_ids"][0], task)
+        result.update({"error_msg": f"req_id: {task_id} {error_msg}", "error_code": 500})
+        self._recycle_resources(task_id, i, task)
+        model_server_logger.error(f"req_id: {task_id} failed in infer process: {error_msg}")
+        return result
+
     def _recycle_beam_resources(self, task_id_list, index_list, block_tables):
         assert len(task_id_list) == len(index_list), \
             f"{len(task_id_list)} task_id don't equal to {len(index_list)} index"
@@ -165,49 +263,101 @@ class TokenProcessor(object):
         for i in range(len(task_id_list)):
             task_id = task_id_list[i]
             index = index_list[i]
-            self.resource_manager.tasks_list[index] = None
-            self.resource_manager.stop_flags[index] = True
+            self.resource_manager.release_slot(index)
             if task_id in self.tokens_counter:
                 del self.tokens_counter[task_id]
             self.all_tokens[index] = list()
 
     def _process_batch_output(self):
         """
-        处理一个batch的输出结果
+        处理一个batch的输出结果，开启投机解码时每个位置一步可能接受多个token
         """
         tokens = self.output_tokens.numpy()
-        batch = self.output_tokens[1, 0]
-        tokens = tokens[2:batch + 2]
+        if self.cfg.speculate_method == "none":
+            batch = int(tokens[1, 0])
+            batch_tokens = tokens[2:batch + 2]
+        else:
+            batch_tokens = parse_speculate_output(tokens)
 
         batch_result = list()
         # 用于判断当前此批结果中是否存在已完成的任务
         exist_finished_task = False
-        for i in range(batch):
-            if self.resource_manager.stop_flags[i]:
-                continue
-
-            token_id = int(tokens[i, 0])
-            if token_id < 0:
-                continue
-
-            task = self.resource_manager.tasks_list[i]
-
-            task_id = task["req_id"]
-            result = self._get_single_result(i, task_id, token_id, task)
-
-            self.tokens_counter[task_id] += 1
-            if token_id not in task["eos_token_ids"]:
-                self.all_tokens[i].append(token_id)
+        now = time.time()
+        inter_token_times = list()
+        for i, token_ids in enumerate(batch_tokens):
+            for token_id in token_ids:
+                # 本步接受的token中已生成结束符时，位置已回收，丢弃之后的token
+                if self.resource_manager.stop_flags[i]:
+                    break
+                token_id = int(token_id)
+                if token_id < 0:
+                    break
+                if self._process_token(i, token_id, now, inter_token_times, batch_result):
+                    exist_finished_task = True
+
+        self.metrics.inter_token_time.observe_many(inter_token_times)
+        self.postprocess(batch_result, exist_finished_task)
 
-            self.number_of_output_tokens += 1
-            if token_id in task["eos_token_ids"]:
-                self._recycle_resources(task_id, i, task)
-                model_server_logger.info("req_id: {0} finished".format(task_id))
-                model_server_logger.info(f"{self.resource_manager.info()}")
-                exist_finished_task = True
-            batch_result.append(result)
+    def _process_token(self, i, token_id, now, inter_token_times, batch_result):
+        """
+        处理一个位置生成的一个token，结果追加到batch_result
 
-        self.postprocess(batch_result, exist_finished_task)
+        Returns:
+            bool: 任务是否已结束
+        """
+        task = self.resource_manager.tasks_list[i]
+
+        task_id = task["req_id"]
+        # 被取消的任务，在推理进程中停止前生成的token不再返回，停止后回收资源并结束请求
+        # 分块prefill的中间分块生成token时该位置已停止，可以直接结束
+        if task.get("aborted"):
+            if token_id in task["eos_token_ids"] or task["prefill_end"] < len(task["input_ids"]):
+                batch_result.append(self._abort_result(i, task_id, task))
+                return True
+            return False
+        # 推理进程插入失败的任务，停止前生成的token无意义，停止后回收资源
+        slot_error = int(self.resource_manager.slot_errors[i])
+        if slot_error:
+            if token_id in task["eos_token_ids"] or task["prefill_end"] < len(task["input_ids"]):
+                result = self._slot_error_result(i, task_id, task, slot_error)
+                if result is not None:
+                    batch_result.append(result)
+                    return True
+            return False
+        # 分块prefill的中间分块生成的token无意义，直接丢弃，由插入线程下发下一个分块
+        if task["prefill_end"] < len(task["input_ids"]):
+            self.resource_manager.finish_prefill_chunk(i)
+            return False
+        # 首个token生成时prefill已完成，此时prompt的block可以加入前缀缓存
+        if task_id not in self.tokens_counter:
+            self.resource_manager.commit_prefix_blocks(i)
+            self.resource_manager.release_forked_tasks(task)
+            # 被抢占后恢复的任务，恢复抢占前已生成的token
+            if "generated_token_ids" in task:
+                self.all_tokens[i] = list(task["generated_token_ids"])
+        # 被抢占的任务生成结束符时不返回结果，等待重新调度后继续生成
+        if token_id in task["eos_token_ids"] and task.get("preempted"):
+            if self._preempt_resources(task_id, i, task):
+                model_server_logger.info(f"req_id: {task_id} preempted, "
+                                         f"generated token num: {len(task['generated_token_ids'])}")
+                return False
+        result = self._get_single_result(i, task_id, token_id, task)
+
+        self.tokens_counter[task_id] += 1
+        if token_id not in task["eos_token_ids"]:
+            self.all_tokens[i].append(token_id)
+            self._record_token_metrics(task, now, inter_token_times)
+
+        self.number_of_output_tokens += 1
+        batch_result.append(result)
+        if token_id in task["eos_token_ids"]:
+            self.resource_manager.record_dec_len(len(self.all_tokens[i]))
+            self._record_finished_metrics(i, task, now)
+            self._recycle_resources(task_id, i, task)
+            model_server_logger.info("req_id: {0} finished".format(task_id))
+            model_server_logger.info(f"{self.resource_manager.info()}", extra=HOT_PATH)
+            return True
+        return False
 
 
 class WarmUpTokenProcessor(TokenProcessor):
@@ -229,7 +379,7 @@ class WarmUpTokenProcessor(TokenProcessor):
         while self._is_running:
             try:
                 rank_id = 0
-                get_output(self.output_tokens, rank_id, self._is_blocking)
+                self.get_output(self.output_tokens, rank_id, self._is_blocking)
 
                 if self.output_tokens[0, 0] == -2:
                     continue
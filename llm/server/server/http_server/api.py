@@ -12,17 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import json
-import queue
-import time
 import uuid
 from datetime import datetime
-from functools import partial
-from typing import Dict, List, Optional
+from typing import AsyncGenerator, Dict, List, Optional, Union
 
 import numpy as np
 import tritonclient.grpc as grpcclient
+import tritonclient.grpc.aio as grpcclient_aio
 from pydantic import BaseModel, Field
+from server.utils import http_server_logger
 from tritonclient import utils as triton_utils
 
 
@@ -44,6 +44,16 @@ class Req(BaseModel):
     system: Optional[str] = None
     return_all_tokens: Optional[bool] = None
     eos_token_ids: Optional[List[int]] = None
+    priority: Optional[int] = None
+    coalesce_tokens: Optional[int] = None
+    coalesce_ms: Optional[float] = None
+    stop: Optional[Union[str, List[str]]] = None
+    guided_json: Optional[Union[Dict, str]] = None
+    guided_regex: Optional[str] = None
+    guided_choice: Optional[List[str]] = None
+    adapter_id: Optional[str] = None
+    prefill_req_id: Optional[str] = None
+    prefill_token_ids: Optional[List[int]] = None
     benchmark: bool = False
     # http服务使用的请求参数
     stream: bool = False
@@ -58,11 +68,201 @@ class Req(BaseModel):
         return req_dict
 
 
-def chat_completion_generator(infer_grpc_url: str, req: Req, yield_json: bool) -> Dict:
+class TritonStream(object):
     """
-    基于Triton推理服务的聊天补全结果的生成器。
+    到Triton推理服务的一个gRPC长连接及其上的双向流，多个请求复用同一个流发送，按响应的请求ID分发结果
+    连接断开时，等待结果的请求全部返回错误，随后自动重连
+    """
+    def __init__(self, infer_grpc_url: str):
+        self.infer_grpc_url = infer_grpc_url
+        # 待发送的请求
+        self.requests = asyncio.Queue()
+        # 各请求的结果队列
+        self.result_queues = dict()
+        self.task = None
+
+    def start(self):
+        """
+        在当前事件循环中启动流的收发任务
+        """
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        """
+        停止收发任务并关闭连接
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def infer(self, req_dict: Dict, timeout: int) -> AsyncGenerator[Dict, None]:
+        """
+        通过流发送请求，并逐条返回结果，直到请求结束或出错
+        """
+        req_id = req_dict["req_id"]
+        if req_id in self.result_queues:
+            yield {"error_msg": f"The req_id {req_id} already exists in the current batch, "
+                                f"the current request will be ignored.", "error_code": 400}
+            return
+
+        result_queue = asyncio.Queue()
+        self.result_queues[req_id] = result_queue
+        # n>1的请求，所有采样均结束后请求才结束
+        remaining_num = req_dict.get("n", 1)
+        finished = False
+        try:
+            self._put_request(req_dict, req_id)
+            while True:
+                try:
+                    result = await asyncio.wait_for(result_queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    yield {"error_msg": f"Timeout while waiting for the result of request {req_id} ({timeout}s)",
+                           "error_code": 408}
+                    break
+                # 调用方可能修改结果，需在返回前判断是否结束
+                if result.get("is_end") == 1:
+                    remaining_num -= 1
+                finished = bool(result.get("error_msg") or result.get("error_code")) or remaining_num <= 0
+                yield result
+                if finished:
+                    break
+        finally:
+            self.result_queues.pop(req_id, None)
+            # 客户端断开连接、提前结束读取或等待超时，通知推理服务取消请求，不等待取消结果
+            if not finished:
+                self._put_request({"req_id": req_id, "abort": True}, f"abort-{uuid.uuid4().hex}")
+                http_server_logger.info(f"abort unfinished request: {req_id}")
+
+    async def abort(self, req_id: str, timeout: int) -> Dict:
+        """
+        通知推理服务取消请求，返回请求是否存在，被取消的请求以finish_reason为abort的结果结束
+        """
+        abort_id = f"abort-{uuid.uuid4().hex}"
+        result_queue = asyncio.Queue()
+        self.result_queues[abort_id] = result_queue
+        try:
+            self._put_request({"req_id": req_id, "abort": True}, abort_id)
+            return await asyncio.wait_for(result_queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return {"req_id": req_id, "error_msg": f"Timeout while aborting request {req_id} ({timeout}s)",
+                    "error_code": 408}
+        finally:
+            self.result_queues.pop(abort_id, None)
+
+    async def server_info(self, timeout: int) -> Dict:
+        """
+        查询推理服务当前的资源信息
+        """
+        info_id = f"server-info-{uuid.uuid4().hex}"
+        result_queue = asyncio.Queue()
+        self.result_queues[info_id] = result_queue
+        try:
+            self._put_request({"req_id": info_id, "server_info": True}, info_id)
+            result = await asyncio.wait_for(result_queue.get(), timeout=timeout)
+            result.setdefault("error_msg", "")
+            result.setdefault("error_code", 0)
+            return result
+        except asyncio.TimeoutError:
+            return {"error_msg": f"Timeout while querying server info ({timeout}s)", "error_code": 408}
+        finally:
+            self.result_queues.pop(info_id, None)
+
+    def _put_request(self, req_dict: Dict, request_id: str):
+        inputs = [grpcclient.InferInput("IN", [1], triton_utils.np_to_triton_dtype(np.object_))]
+        inputs[0].set_data_from_numpy(np.array([json.dumps([req_dict])], dtype=np.object_))
+        outputs = [grpcclient.InferRequestedOutput("OUT")]
+        self.requests.put_nowait({"model_name": "model", "inputs": inputs, "outputs": outputs,
+                                  "request_id": request_id})
+
+    async def _request_iterator(self):
+        while True:
+            yield await self.requests.get()
+
+    async def _run(self):
+        while True:
+            triton_client = grpcclient_aio.InferenceServerClient(url=self.infer_grpc_url, verbose=False)
+            try:
+                async for output_item, error in triton_client.stream_infer(self._request_iterator()):
+                    if error is not None:
+                        # 流上返回的错误不携带请求ID，无法分发，对应请求会等待至超时
+                        http_server_logger.error(f"receive error from infer service: {error}")
+                        continue
+                    result = json.loads(output_item.as_numpy("OUT")[0])
+                    result = result[0] if isinstance(result, list) else result
+                    req_id = output_item.get_response().id or result.get("req_id")
+                    result_queue = self.result_queues.get(req_id)
+                    if result_queue is not None:
+                        result_queue.put_nowait(result)
+                error_msg = "grpc stream to infer service is closed"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error_msg = f"grpc stream to infer service is broken: {e}"
+            finally:
+                await triton_client.close()
+
+            http_server_logger.error(f"{error_msg}, {len(self.result_queues)} requests failed, reconnecting...")
+            for result_queue in self.result_queues.values():
+                result_queue.put_nowait({"error_msg": error_msg, "error_code": 500})
+            await asyncio.sleep(1)
+
+
+class TritonStreamPool(object):
+    """
+    到Triton推理服务的gRPC长连接池，请求轮流分配到各连接的流上，避免每个HTTP请求建立连接
+    """
+    def __init__(self, infer_grpc_url: str, stream_num: int):
+        self.streams = [TritonStream(infer_grpc_url) for _ in range(stream_num)]
+        self.next_stream = 0
+
+    def start(self):
+        """
+        启动所有连接，需在事件循环中调用
+        """
+        for stream in self.streams:
+            stream.start()
+
+    async def close(self):
+        """
+        关闭所有连接
+        """
+        for stream in self.streams:
+            await stream.close()
+
+    def infer(self, req_dict: Dict, timeout: int) -> AsyncGenerator[Dict, None]:
+        """
+        选择一个流发送请求，返回结果的异步生成器
+        """
+        stream = self.streams[self.next_stream]
+        self.next_stream = (self.next_stream + 1) % len(self.streams)
+        return stream.infer(req_dict, timeout)
+
+    async def abort(self, req_id: str, timeout: int = 10) -> Dict:
+        """
+        取消请求，推理服务按req_id查找请求，可以从任一流发送
+        """
+        stream = self.streams[self.next_stream]
+        self.next_stream = (self.next_stream + 1) % len(self.streams)
+        return await stream.abort(req_id, timeout)
+
+    async def server_info(self, timeout: int = 10) -> Dict:
+        """
+        查询推理服务当前的资源信息
+        """
+        stream = self.streams[self.next_stream]
+        self.next_stream = (self.next_stream + 1) % len(self.streams)
+        return await stream.server_info(timeout)
+
+
+async def chat_completion_generator(stream_pool: TritonStreamPool, req: Req, yield_json: bool) -> AsyncGenerator:
+    """
+    基于Triton推理服务的聊天补全结果的异步生成器。
     Args:
-        infer_grpc_url (str): Triton推理服务的gRPC URL。
+        stream_pool (TritonStreamPool): 到Triton推理服务的gRPC长连接池。
         req (Request): 聊天补全请求。
         yield_json (bool): 是否返回json格式，否则返回Resp类
     Returns:
@@ -70,71 +270,31 @@ def chat_completion_generator(infer_grpc_url: str, req: Req, yield_json: bool) -
             如果正常，返回{'token': xxx, 'is_end': xxx, 'send_idx': xxx, ..., 'error_msg': '', 'error_code': 0}
             如果异常，返回{'error_msg': xxx, 'error_code': xxx}，error_msg字段不为空，error_code字段不为0
     """
-    class _TritonOutputData:
-        """接收Triton服务返回的数据"""
-        def __init__(self):
-            self._completed_requests = queue.Queue()
-
-    def _triton_callback(output_data, result, error):
-        """Triton客户端的回调函数"""
-        if error:
-            output_data._completed_requests.put(error)
-        else:
-            output_data._completed_requests.put(result)
-
     def _format_resp(resp_dict):
         if yield_json:
             return json.dumps(resp_dict, ensure_ascii=False) + "\n"
         else:
             return resp_dict
 
-    # 准备请求数据
-    timeout = req.timeout
-    req_id = req.req_id
-    req_dict = req.to_dict_for_infer()
     http_received_time = datetime.now()
+    results = stream_pool.infer(req.to_dict_for_infer(), req.timeout)
+    try:
+        async for result in results:
+            result["error_msg"] = result.get("error_msg", "")
+            result["error_code"] = result.get("error_code", 0)
+            if req.benchmark:
+                result["http_received_time"] = str(http_received_time)
+            yield _format_resp(result)
+    finally:
+        # 客户端断开连接时立即关闭结果生成器，通知推理服务取消请求
+        await results.aclose()
 
-    inputs = [grpcclient.InferInput("IN", [1], triton_utils.np_to_triton_dtype(np.object_))]
-    inputs[0].set_data_from_numpy(np.array([json.dumps([req_dict])], dtype=np.object_))
-    outputs = [grpcclient.InferRequestedOutput("OUT")]
-    output_data = _TritonOutputData()
-
-    # 建立连接
-    with grpcclient.InferenceServerClient(url=infer_grpc_url, verbose=False) as triton_client:
-        triton_client.start_stream(callback=partial(_triton_callback, output_data))
-
-        # 发送请求
-        triton_client.async_stream_infer(model_name="model",
-                                            inputs=inputs,
-                                            request_id=req_dict['req_id'],
-                                            outputs=outputs)
-        # 处理返回结果
-        while True:
-            output_item = output_data._completed_requests.get(timeout=timeout)
-            if type(output_item) == triton_utils.InferenceServerException:
-                error_msg = f"status is {output_item.status()}, msg is {output_item.message()}"
-                yield _format_resp({"error_msg": error_msg, "error_code": 500})
-                break
-            else:
-                result = json.loads(output_item.as_numpy("OUT")[0])
-                result = result[0] if isinstance(result, list) else result
-                result["error_msg"] = result.get("error_msg", "")
-                result["error_code"] = result.get("error_code", 0)
-                if req.benchmark:
-                    result["http_received_time"] = str(http_received_time)
-                yield _format_resp(result)
-                if (result.get("error_msg") or result.get("error_code")) or result.get("is_end") == 1:
-                    break
-
-        # 手动关闭连接
-        triton_client.stop_stream()
-        triton_client.close()
 
-def chat_completion_result(infer_grpc_url: str, req: Req) -> Dict:
+async def chat_completion_result(stream_pool: TritonStreamPool, req: Req) -> Dict:
     """
     获取非流式生成结果
     Args:
-        infer_grpc_url (str): gRPC服务地址
+        stream_pool (TritonStreamPool): 到Triton推理服务的gRPC长连接池
         req (Req): 请求参数对象
     Returns:
         dict: 聊天补全结果的生成器。
@@ -143,7 +303,7 @@ def chat_completion_result(infer_grpc_url: str, req: Req) -> Dict:
     """
     result = None
     error_resp = None
-    for resp in chat_completion_generator(infer_grpc_url, req, yield_json=False):
+    async for resp in chat_completion_generator(stream_pool, req, yield_json=False):
         if resp.get("error_msg") or resp.get("error_code"):
             error_resp = resp
             error_resp["result"] = ""
@@ -153,7 +313,7 @@ def chat_completion_result(infer_grpc_url: str, req: Req) -> Dict:
                 for key in ['token', 'is_end', 'send_idx', 'return_all_tokens', 'token']:
                     if key in result:
                         del result[key]
-    if not result:
+    if not result and not error_resp:
         error_resp = {
             "error_msg": "HTTP parsing data error",
             "error_code": 500,
@@ -13,25 +13,158 @@
 # limitations under the License.
 
 import argparse
+import asyncio
 import os
 
 import uvicorn
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from server.http_server.api import (
     Req,
+    TritonStreamPool,
     chat_completion_generator,
     chat_completion_result,
 )
+from server.http_server.openai_api import (
+    ChatCompletionRequest,
+    CompletionRequest,
+    openai_result,
+    openai_stream_generator,
+)
 from server.utils import http_server_logger
 
 http_server_logger.info(f"create fastapi app...")
 app = FastAPI()
+# 到推理服务的gRPC长连接池，每个HTTP服务进程一个，在事件循环启动后创建
+stream_pool = None
+# 非流式请求等待结果期间，检查客户端是否断开连接的间隔
+DISCONNECT_CHECK_INTERVAL = 1.0
+
+
+@app.on_event("startup")
+async def start_stream_pool():
+    """
+    创建到推理服务的gRPC长连接池
+    """
+    global stream_pool
+    grpc_port = int(os.getenv("GRPC_PORT", 0))
+    if grpc_port == 0:
+        http_server_logger.error(f"GRPC_PORT ({grpc_port}) for infer service is invalid")
+        return
+    stream_num = int(os.getenv("PUSH_MODE_HTTP_GRPC_STREAMS", 4))
+    stream_pool = TritonStreamPool(f"localhost:{grpc_port}", stream_num)
+    stream_pool.start()
+    http_server_logger.info(f"create grpc stream pool, grpc_port: {grpc_port}, stream_num: {stream_num}")
+
+
+@app.on_event("shutdown")
+async def close_stream_pool():
+    """
+    关闭gRPC长连接池
+    """
+    if stream_pool is not None:
+        await stream_pool.close()
+
 
 @app.post("/v1/chat/completions")
-def create_chat_completion(req: Req):
+async def create_chat_completion(raw_request: Request):
+    """
+    服务端路由函数，请求中包含model字段或response_type为openai时，按OpenAI的格式处理，否则按原有格式处理
+    """
+    body = await raw_request.json()
+    if "model" in body or str(body.get("response_type", "")).lower() == "openai":
+        body.pop("response_type", None)
+        try:
+            request = ChatCompletionRequest(**body)
+        except Exception as e:
+            return JSONResponse(status_code=400, content={"error": {"message": str(e), "type": "invalid_request_error"}})
+        return await create_openai_response(request, raw_request)
+    try:
+        req = Req(**body)
+    except Exception as e:
+        return {"error_msg": str(e), "error_code": 400}
+    return await create_fastdeploy_response(req, raw_request)
+
+
+@app.post("/v1/completions")
+async def create_completion(request: CompletionRequest, raw_request: Request):
+    """
+    OpenAI格式的文本补全接口
+    """
+    return await create_openai_response(request, raw_request)
+
+
+@app.post("/v1/abort/{req_id}")
+async def abort_request(req_id: str):
+    """
+    取消请求，返回{'req_id': xxx, 'aborted': xxx, 'error_msg': '', 'error_code': 0}，
+    aborted表示请求是否存在，被取消的请求以finish_reason为abort的结果结束
     """
-    服务端路由函数
+    http_server_logger.info(f"receive abort request: {req_id}")
+    if stream_pool is None:
+        grpc_port = int(os.getenv("GRPC_PORT", 0))
+        return {"req_id": req_id, "error_msg": f"GRPC_PORT ({grpc_port}) for infer service is invalid",
+                "error_code": 400}
+    return await stream_pool.abort(req_id)
+
+
+@app.get("/v1/server_info")
+async def get_server_info():
+    """
+    查询服务当前的资源信息，包括可用block数、可用batch、排队请求数及实例角色，供router按负载分发请求
+    """
+    if stream_pool is None:
+        grpc_port = int(os.getenv("GRPC_PORT", 0))
+        return {"error_msg": f"GRPC_PORT ({grpc_port}) for infer service is invalid", "error_code": 400}
+    return await stream_pool.server_info()
+
+
+async def _wait_unless_disconnected(raw_request: Request, coroutine):
+    """
+    等待非流式请求的结果，客户端断开连接时取消等待，由结果生成器通知推理服务取消请求
+    流式请求由StreamingResponse在客户端断开时关闭生成器，无需检查
+
+    Returns:
+        bool: 客户端是否已断开连接
+        Any: 请求的结果，客户端断开时为None
+    """
+    task = asyncio.ensure_future(coroutine)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_CHECK_INTERVAL)
+        if done:
+            return False, task.result()
+        if await raw_request.is_disconnected():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            return True, None
+
+
+async def create_openai_response(request, raw_request: Request):
+    """
+    处理OpenAI格式的请求，stream为True时以SSE格式流式返回
+    """
+    http_server_logger.info(f"receive openai request, stream: {request.stream}, n: {request.n}")
+    if stream_pool is None:
+        grpc_port = int(os.getenv("GRPC_PORT", 0))
+        return JSONResponse(status_code=500, content={"error": {
+            "message": f"GRPC_PORT ({grpc_port}) for infer service is invalid", "type": "server_error"}})
+    if request.stream:
+        return StreamingResponse(openai_stream_generator(stream_pool, request), media_type="text/event-stream")
+    disconnected, resp = await _wait_unless_disconnected(raw_request, openai_result(stream_pool, request))
+    if disconnected:
+        http_server_logger.info(f"client disconnected, openai request aborted")
+        return JSONResponse(status_code=499, content={"error": {
+            "message": "client disconnected", "type": "server_error"}})
+    status_code, content = resp
+    return JSONResponse(status_code=status_code, content=content)
+
+
+async def create_fastdeploy_response(req: Req, raw_request: Request):
+    """
+    处理原有格式的请求
     返回：
         如果stream为True，流式返回
             如果正常，返回{'token': xxx, 'is_end': xxx, 'send_idx': xxx, ..., 'error_msg': '', 'error_code': 0}
@@ -42,17 +175,20 @@ def create_chat_completion(req: Req):
     """
     try:
         http_server_logger.info(f"receive request: {req.req_id}")
-        grpc_port = int(os.getenv("GRPC_PORT", 0))
-        if grpc_port == 0:
+        if stream_pool is None:
+            grpc_port = int(os.getenv("GRPC_PORT", 0))
             return {"error_msg": f"GRPC_PORT ({grpc_port}) for infer service is invalid",
                     "error_code": 400}
-        grpc_url = f"localhost:{grpc_port}"
 
         if req.stream:
-            generator = chat_completion_generator(infer_grpc_url=grpc_url, req=req, yield_json=True)
+            generator = chat_completion_generator(stream_pool=stream_pool, req=req, yield_json=True)
             resp = StreamingResponse(generator, media_type="text/event-stream")
         else:
-            resp = chat_completion_result(infer_grpc_url=grpc_url, req=req)
+            disconnected, resp = await _wait_unless_disconnected(
+                raw_request, chat_completion_result(stream_pool=stream_pool, req=req))
+            if disconnected:
+                http_server_logger.info(f"client disconnected, request aborted: {req.req_id}")
+                resp = {"error_msg": "client disconnected", "error_code": 499}
     except Exception as e:
         resp = {'error_msg': str(e), 'error_code': 501}
     finally:
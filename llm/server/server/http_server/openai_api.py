@@ -0,0 +1,249 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+import uuid
+from typing import AsyncGenerator, Dict, List, Optional, Union
+
+from pydantic import BaseModel
+from server.http_server.api import TritonStreamPool
+
+# OpenAI参数与模型服务参数的对应关系
+PARAM_MAPPING = {
+    "max_tokens": "max_dec_len",
+    "temperature": "temperature",
+    "top_p": "topp",
+    "presence_penalty": "presence_score",
+    "frequency_penalty": "frequency_score",
+    "seed": "infer_seed",
+    "n": "n",
+    "priority": "priority",
+    "stop": "stop",
+    "response_format": "response_format",
+    "guided_json": "guided_json",
+    "guided_regex": "guided_regex",
+    "guided_choice": "guided_choice",
+    "adapter_id": "adapter_id",
+}
+DEFAULT_MODEL_NAME = "fastdeploy"
+
+
+class StreamOptions(BaseModel):
+    """流式返回的选项"""
+    include_usage: bool = False
+
+
+class CompletionRequest(BaseModel):
+    """OpenAI /v1/completions的请求参数"""
+    model: Optional[str] = None
+    prompt: Union[str, List[int]]
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    n: int = 1
+    stream: bool = False
+    stream_options: Optional[StreamOptions] = None
+    stop: Optional[Union[str, List[str]]] = None
+    seed: Optional[int] = None
+    presence_penalty: Optional[float] = None
+    frequency_penalty: Optional[float] = None
+    user: Optional[str] = None
+    response_format: Optional[Dict] = None
+    # 模型服务的扩展参数
+    priority: Optional[int] = None
+    guided_json: Optional[Union[Dict, str]] = None
+    guided_regex: Optional[str] = None
+    guided_choice: Optional[List[str]] = None
+    adapter_id: Optional[str] = None
+    timeout: int = 300
+
+
+class ChatCompletionRequest(BaseModel):
+    """OpenAI /v1/chat/completions的请求参数"""
+    model: Optional[str] = None
+    messages: List[Dict]
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    n: int = 1
+    stream: bool = False
+    stream_options: Optional[StreamOptions] = None
+    stop: Optional[Union[str, List[str]]] = None
+    seed: Optional[int] = None
+    presence_penalty: Optional[float] = None
+    frequency_penalty: Optional[float] = None
+    user: Optional[str] = None
+    response_format: Optional[Dict] = None
+    # 模型服务的扩展参数
+    priority: Optional[int] = None
+    guided_json: Optional[Union[Dict, str]] = None
+    guided_regex: Optional[str] = None
+    guided_choice: Optional[List[str]] = None
+    adapter_id: Optional[str] = None
+    timeout: int = 300
+
+
+class _Choice(object):
+    """一个采样的生成状态"""
+    def __init__(self):
+        self.text = ""
+        self.finish_reason = None
+        self.token_num = 0
+        self.sent_role = False
+
+
+def to_infer_dict(request: Union[CompletionRequest, ChatCompletionRequest], req_id: str, stream: bool) -> Dict:
+    """
+    将OpenAI请求参数转换为模型服务的请求参数，非流式请求只返回最终结果，减少中间结果的传输
+    """
+    req_dict = {"req_id": req_id}
+    if isinstance(request, ChatCompletionRequest):
+        req_dict["messages"] = request.messages
+    elif isinstance(request.prompt, str):
+        req_dict["text"] = request.prompt
+    else:
+        req_dict["input_ids"] = request.prompt
+    for key, infer_key in PARAM_MAPPING.items():
+        value = getattr(request, key)
+        if value is not None:
+            req_dict[infer_key] = value
+    if not stream:
+        req_dict["return_all_tokens"] = True
+    return req_dict
+
+
+def error_response(result: Dict) -> (int, Dict):
+    """
+    将模型服务返回的错误转换为OpenAI格式的错误及HTTP状态码，参数检查失败的错误码为200或400
+    """
+    error_code = result.get("error_code", 500)
+    status_code = 400 if error_code in (200, 400) else 408 if error_code == 408 else 500
+    error_type = "invalid_request_error" if status_code == 400 else "server_error"
+    return status_code, {"error": {"message": result.get("error_msg", ""), "type": error_type, "code": error_code}}
+
+
+def _usage(prompt_tokens, choices):
+    completion_tokens = sum(choice.token_num for choice in choices)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _is_error(result):
+    return bool(result.get("error_msg") or result.get("error_code"))
+
+
+async def openai_stream_generator(stream_pool: TritonStreamPool,
+                                  request: Union[CompletionRequest, ChatCompletionRequest]) -> AsyncGenerator:
+    """
+    OpenAI格式的流式返回，每条结果以`data: `开头、空行结尾，最后返回`data: [DONE]`
+    各采样的结果交替返回，以index区分；停止字符串由模型服务匹配，匹配到时以finish_reason为stop结束
+    """
+    is_chat = isinstance(request, ChatCompletionRequest)
+    req_id = f"{'chatcmpl' if is_chat else 'cmpl'}-{uuid.uuid4().hex}"
+    created = int(time.time())
+    model = request.model or DEFAULT_MODEL_NAME
+    obj = "chat.completion.chunk" if is_chat else "text_completion"
+    choices = [_Choice() for _ in range(request.n)]
+    prompt_tokens = 0
+
+    def _chunk(index, text, finish_reason):
+        choice = choices[index]
+        if is_chat:
+            delta = {"content": text} if text else {}
+            if not choice.sent_role:
+                delta["role"] = "assistant"
+                choice.sent_role = True
+            data = {"index": index, "delta": delta, "finish_reason": finish_reason}
+        else:
+            data = {"index": index, "text": text, "logprobs": None, "finish_reason": finish_reason}
+        chunk = {"id": req_id, "object": obj, "created": created, "model": model, "choices": [data]}
+        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+    results = stream_pool.infer(to_infer_dict(request, req_id, True), request.timeout)
+    try:
+        async for result in results:
+            if _is_error(result):
+                yield f"data: {json.dumps(error_response(result)[1], ensure_ascii=False)}\n\n"
+                break
+            prompt_tokens = result.get("input_token_num", prompt_tokens)
+            index = result.get("index", 0)
+            choice = choices[index]
+            if choice.finish_reason is not None:
+                continue
+            choice.token_num += len(result.get("token_ids", []))
+            text = result.get("token", "")
+            if result.get("is_end") == 1:
+                choice.finish_reason = result.get("finish_reason", "stop")
+            if text or choice.finish_reason is not None:
+                yield _chunk(index, text, choice.finish_reason)
+            if all(choice.finish_reason is not None for choice in choices):
+                break
+    finally:
+        # 提前结束时立即关闭结果生成器，释放请求的结果队列
+        await results.aclose()
+
+    if request.stream_options is not None and request.stream_options.include_usage:
+        chunk = {"id": req_id, "object": obj, "created": created, "model": model, "choices": [],
+                 "usage": _usage(prompt_tokens, choices)}
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+async def openai_result(stream_pool: TritonStreamPool,
+                        request: Union[CompletionRequest, ChatCompletionRequest]) -> (int, Dict):
+    """
+    OpenAI格式的非流式返回
+
+    Returns:
+        int: HTTP状态码
+        dict: 返回结果
+    """
+    is_chat = isinstance(request, ChatCompletionRequest)
+    req_id = f"{'chatcmpl' if is_chat else 'cmpl'}-{uuid.uuid4().hex}"
+    choices = [_Choice() for _ in range(request.n)]
+    prompt_tokens = 0
+    results = stream_pool.infer(to_infer_dict(request, req_id, False), request.timeout)
+    try:
+        async for result in results:
+            if _is_error(result):
+                return error_response(result)
+            if result.get("is_end") != 1:
+                continue
+            prompt_tokens = result.get("input_token_num", prompt_tokens)
+            choice = choices[result.get("index", 0)]
+            choice.token_num = result.get("output_token_num", 0)
+            choice.text = result.get("tokens_all", "")
+            choice.finish_reason = result.get("finish_reason", "stop")
+    finally:
+        # 出错提前返回时立即关闭结果生成器，释放请求的结果队列
+        await results.aclose()
+
+    if is_chat:
+        choices_data = [{"index": i, "message": {"role": "assistant", "content": choice.text},
+                         "finish_reason": choice.finish_reason} for i, choice in enumerate(choices)]
+    else:
+        choices_data = [{"index": i, "text": choice.text, "logprobs": None,
+                         "finish_reason": choice.finish_reason} for i, choice in enumerate(choices)]
+    return 200, {
+        "id": req_id,
+        "object": "chat.completion" if is_chat else "text_completion",
+        "created": int(time.time()),
+        "model": request.model or DEFAULT_MODEL_NAME,
+        "choices": choices_data,
+        "usage": _usage(prompt_tokens, choices),
+    }
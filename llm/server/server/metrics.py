@@ -0,0 +1,99 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+
+import numpy as np
+
+# 各直方图的分桶上界，最后隐含+Inf桶
+REQUEST_TIME_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+TOKEN_TIME_BUCKETS = (0.005, 0.01, 0.015, 0.02, 0.025, 0.03, 0.04, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0, 2.5)
+TOKEN_NUM_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+PREEMPTION_BUCKETS = (0, 1, 2, 4, 8)
+
+
+class Histogram(object):
+    """
+    Prometheus格式的直方图，记录时只更新各桶的计数，由导出端读取累积值
+    只应在一个线程中记录，导出端读取时可能与记录交错，最多相差正在记录的一个样本
+    """
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(float(b) for b in buckets)
+        # 每个桶内的样本数，不含更小的桶，最后一个为+Inf桶
+        self.bucket_counts = np.zeros([len(self.buckets) + 1], dtype=np.int64)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        记录一个样本
+        """
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def observe_many(self, values):
+        """
+        批量记录样本，用于每个推理步的逐token统计
+        """
+        if len(values) == 0:
+            return
+        values = np.asarray(values, dtype=np.float64)
+        indices = np.searchsorted(self.buckets, values, side="left")
+        self.bucket_counts += np.bincount(indices, minlength=len(self.bucket_counts))
+        self.sum += float(values.sum())
+
+    def snapshot(self):
+        """
+        获取导出所需的累积值
+
+        Returns:
+            list[int]: 各桶上界对应的累积样本数，最后一个为+Inf桶，即样本总数
+            float: 样本值之和
+        """
+        return np.cumsum(self.bucket_counts).tolist(), self.sum
+
+
+class ServerMetrics(object):
+    """
+    服务的请求级延迟与token数统计，由TokenProcessor在处理生成结果时记录
+    """
+    def __init__(self):
+        self.queue_wait_time = Histogram(
+            "fd_queue_wait_seconds", "Time from request preprocessed to scheduled into the engine",
+            REQUEST_TIME_BUCKETS)
+        self.first_token_time = Histogram(
+            "fd_time_to_first_token_seconds", "Time from request received to first token generated",
+            REQUEST_TIME_BUCKETS)
+        self.inter_token_time = Histogram(
+            "fd_inter_token_latency_seconds", "Time between two consecutive tokens of a request",
+            TOKEN_TIME_BUCKETS)
+        self.request_time = Histogram(
+            "fd_e2e_request_latency_seconds", "Time from request received to last token generated",
+            REQUEST_TIME_BUCKETS)
+        self.prompt_tokens = Histogram(
+            "fd_request_prompt_tokens", "Number of prompt tokens of finished requests",
+            TOKEN_NUM_BUCKETS)
+        self.output_tokens = Histogram(
+            "fd_request_generation_tokens", "Number of generated tokens of finished requests",
+            TOKEN_NUM_BUCKETS)
+        self.preemptions = Histogram(
+            "fd_request_preemptions", "Number of times finished requests were preempted",
+            PREEMPTION_BUCKETS)
+
+    def histograms(self):
+        """
+        获取所有直方图
+        """
+        return [value for value in self.__dict__.values() if isinstance(value, Histogram)]
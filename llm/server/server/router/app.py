@@ -0,0 +1,393 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import asyncio
+import json
+import os
+import uuid
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from server.router.router import Router
+from server.utils import router_logger
+
+router_logger.info(f"create router app...")
+app = FastAPI()
+# 在事件循环启动后创建
+router = None
+client = None
+poll_task = None
+# 正在处理的请求所在的实例及其在实例上的req_id，用于取消请求
+inflight_requests = dict()
+# 非流式请求等待结果期间，检查客户端是否断开连接的间隔
+DISCONNECT_CHECK_INTERVAL = 1.0
+
+
+@app.on_event("startup")
+async def start_router():
+    """
+    按环境变量创建router，并启动定期查询各实例资源信息的任务
+    """
+    global router, client, poll_task
+    urls = [url.strip() for url in os.getenv("ROUTER_REPLICAS", "").split(",") if url.strip()]
+    router = Router(urls,
+                    policy=os.getenv("ROUTER_POLICY", "prefix_affinity"),
+                    prefix_len=int(os.getenv("ROUTER_PREFIX_LEN", 1024)),
+                    affinity_load_gap=float(os.getenv("ROUTER_AFFINITY_LOAD_GAP", 1.0)))
+    client = httpx.AsyncClient(timeout=None)
+    poll_task = asyncio.get_running_loop().create_task(
+        _poll_server_info(float(os.getenv("ROUTER_POLL_INTERVAL", 0.5))))
+    router_logger.info(f"router replicas: {urls}, policy: {router.policy}")
+
+
+@app.on_event("shutdown")
+async def close_router():
+    """
+    停止查询任务并关闭连接
+    """
+    if poll_task is not None:
+        poll_task.cancel()
+    if client is not None:
+        await client.aclose()
+
+
+async def _poll_server_info(interval):
+    """
+    定期查询各实例的资源信息，查询失败的实例不再分发请求，直到恢复
+    """
+    async def _poll(replica):
+        try:
+            resp = await client.get(f"{replica.url}/v1/server_info", timeout=max(interval, 1.0))
+            info = resp.json()
+        except Exception as e:
+            info = None
+            if replica.healthy:
+                router_logger.error(f"replica {replica.url} is unavailable: {e}")
+        replica.update(info)
+
+    while True:
+        await asyncio.gather(*[_poll(replica) for replica in router.replicas])
+        await asyncio.sleep(interval)
+
+
+@app.post("/v1/chat/completions")
+async def create_chat_completion(raw_request: Request):
+    """
+    与推理服务相同的接口，请求中包含model字段或response_type为openai时为OpenAI格式
+    """
+    body = await raw_request.json()
+    openai_format = "model" in body or str(body.get("response_type", "")).lower() == "openai"
+    return await dispatch("/v1/chat/completions", body, openai_format, raw_request)
+
+
+@app.post("/v1/completions")
+async def create_completion(raw_request: Request):
+    """
+    OpenAI格式的文本补全接口
+    """
+    body = await raw_request.json()
+    return await dispatch("/v1/completions", body, True, raw_request)
+
+
+@app.post("/v1/abort/{req_id}")
+async def abort_request(req_id: str):
+    """
+    取消请求，转发到请求所在的实例；不是由router分配req_id的请求（如OpenAI格式）转发到所有实例
+    """
+    if req_id in inflight_requests:
+        targets = [inflight_requests[req_id]]
+    else:
+        targets = [(replica, req_id) for replica in router.replicas if replica.healthy]
+    results = await asyncio.gather(*[_abort(replica, upstream_req_id) for replica, upstream_req_id in targets])
+    aborted = any(result.get("aborted", False) for result in results)
+    router_logger.info(f"abort request: {req_id}, aborted: {aborted}")
+    return {"req_id": req_id, "aborted": aborted, "error_msg": "", "error_code": 0}
+
+
+@app.get("/v1/server_info")
+async def get_server_info():
+    """
+    router查询到的各实例状态
+    """
+    return {"policy": router.policy, "replicas": [{
+        "url": replica.url, "healthy": replica.healthy, "engine_role": replica.role,
+        "load": replica.load(), "inflight_num": replica.inflight_num, "server_info": replica.info,
+    } for replica in router.replicas]}
+
+
+async def _abort(replica, req_id):
+    try:
+        resp = await client.post(f"{replica.url}/v1/abort/{req_id}", timeout=10)
+        return resp.json()
+    except Exception as e:
+        router_logger.error(f"abort {req_id} on {replica.url} failed: {e}")
+        return {}
+
+
+def _error_content(openai_format, message, status_code):
+    if openai_format:
+        return {"error": {"message": message, "type": "server_error", "code": status_code}}
+    return {"error_msg": message, "error_code": status_code}
+
+
+def _error_response(openai_format, message, status_code):
+    content = _error_content(openai_format, message, status_code)
+    if openai_format:
+        return JSONResponse(status_code=status_code, content=content)
+    return content
+
+
+async def dispatch(path, body, openai_format, raw_request):
+    """
+    为请求选择实例并转发；有可用的prefill与decode实例时，FastDeploy格式且n为1的请求先后由两类实例处理，
+    其余请求由mixed实例处理
+    """
+    if not openai_format:
+        # 由router分配req_id，用于取消请求
+        body.setdefault("req_id", str(uuid.uuid4()))
+        if body.get("n", 1) == 1 and router.is_disaggregated():
+            return await _dispatch_disaggregated(path, body, raw_request)
+    replica = router.select(body)
+    if replica is None:
+        return _error_response(openai_format, "No available replica", 503)
+    router_logger.info(f"dispatch request {body.get('req_id', '')} to {replica.url}")
+    if body.get("stream"):
+        return StreamingResponse(_proxy_stream(replica, path, body, openai_format), media_type="text/event-stream")
+    disconnected, resp = await _wait_unless_disconnected(raw_request, _proxy(replica, path, body, openai_format))
+    if disconnected:
+        return _error_response(openai_format, "client disconnected", 499)
+    status_code, content = resp
+    if openai_format:
+        return JSONResponse(status_code=status_code, content=content)
+    return content
+
+
+async def _proxy(replica, path, body, openai_format=False, req_id=None):
+    """
+    转发非流式请求，req_id为客户端请求的req_id，与转发到实例的req_id不同时（如prefill请求）需指定；
+    单次请求失败可能只是连接被中断，实例是否可用由_poll_server_info判断
+
+    Returns:
+        int: HTTP状态码
+        dict: 结果
+    """
+    req_id = req_id or body.get("req_id")
+    _track(replica, req_id, body.get("req_id"))
+    try:
+        resp = await client.post(f"{replica.url}{path}", json=body)
+        return resp.status_code, resp.json()
+    except (httpx.HTTPError, ValueError) as e:
+        router_logger.error(f"proxy request {req_id} to {replica.url} failed: {e}")
+        return 502, _error_content(openai_format, f"replica {replica.url} failed: {e}", 502)
+    finally:
+        _untrack(replica, req_id)
+
+
+async def _proxy_stream(replica, path, body, openai_format=False):
+    """
+    转发流式请求，客户端断开时关闭到实例的连接，由实例取消请求；
+    实例出错时按请求的格式返回错误，OpenAI格式为SSE的错误消息
+    """
+    req_id = body.get("req_id")
+    _track(replica, req_id, req_id)
+    try:
+        async with client.stream("POST", f"{replica.url}{path}", json=body) as resp:
+            async for chunk in resp.aiter_raw():
+                yield chunk
+    except httpx.HTTPError as e:
+        router_logger.error(f"proxy stream request {req_id} to {replica.url} failed: {e}")
+        content = _error_content(openai_format, f"replica {replica.url} failed: {e}", 502)
+        if openai_format:
+            yield f"data: {json.dumps(content, ensure_ascii=False)}\n\ndata: [DONE]\n\n".encode()
+        else:
+            yield (json.dumps(content, ensure_ascii=False) + "\n").encode()
+    finally:
+        _untrack(replica, req_id)
+
+
+async def _dispatch_disaggregated(path, body, raw_request):
+    """
+    prefill实例计算prompt并生成首个token，随后decode实例接收其KV继续生成，
+    返回结果与mixed实例一致：首个token在decode实例的结果之前返回，send_idx与token数合并计算
+    """
+    req_id = body["req_id"]
+    prefill_req_id = f"{req_id}-prefill"
+    disconnected, prefill_result = await _wait_unless_disconnected(raw_request, _prefill(path, body, prefill_req_id))
+    if disconnected:
+        return _error_response(False, "client disconnected", 499)
+    prefill_token_ids = prefill_result.get("tokens_all_ids", [])
+    if prefill_result.get("error_code") or prefill_result.get("finish_reason") != "length" or not prefill_token_ids:
+        # 出错或首个token即为结束符，直接返回prefill实例的结果
+        prefill_result.pop("tokens_all_ids", None)
+        prefill_result["req_id"] = req_id
+        return prefill_result
+
+    replica = router.select(body, "decode")
+    if replica is None:
+        return _error_response(False, "No available decode replica", 503)
+    decode_body = dict(body, prefill_req_id=prefill_req_id, prefill_token_ids=prefill_token_ids)
+    merge = _PrefillMerger(req_id, prefill_result, body.get("return_all_tokens", False))
+    router_logger.info(f"dispatch request {req_id} to decode replica {replica.url}")
+    if body.get("stream"):
+        return StreamingResponse(merge.stream(_proxy_stream(replica, path, decode_body)),
+                                 media_type="text/event-stream")
+    disconnected, resp = await _wait_unless_disconnected(raw_request, _proxy(replica, path, decode_body))
+    if disconnected:
+        return _error_response(False, "client disconnected", 499)
+    return merge.merge_end(resp[1])
+
+
+async def _prefill(path, body, prefill_req_id):
+    """
+    在prefill实例上计算prompt，返回首个token的非流式结果
+    """
+    replica = router.select(body, "prefill")
+    if replica is None:
+        return {"error_msg": "No available prefill replica", "error_code": 503}
+    prefill_body = dict(body, req_id=prefill_req_id, stream=False, return_all_tokens=True)
+    # 停止字符串由decode实例匹配
+    prefill_body.pop("stop", None)
+    router_logger.info(f"dispatch request {body['req_id']} to prefill replica {replica.url}")
+    _, result = await _proxy(replica, path, prefill_body, req_id=body["req_id"])
+    return result
+
+
+class _PrefillMerger(object):
+    """
+    将prefill实例生成的首个token合并到decode实例的结果中
+    """
+    def __init__(self, req_id, prefill_result, return_all_tokens):
+        self.req_id = req_id
+        self.text = prefill_result.get("tokens_all", "")
+        self.token_ids = prefill_result["tokens_all_ids"]
+        self.input_token_num = prefill_result.get("input_token_num")
+        self.return_all_tokens = return_all_tokens
+
+    def merge_end(self, result):
+        """
+        合并结束结果中的完整文本与token数
+        """
+        if result.get("error_code"):
+            return result
+        result["req_id"] = self.req_id
+        if "tokens_all" in result:
+            result["tokens_all"] = self.text + result["tokens_all"]
+        if "tokens_all_ids" in result:
+            result["tokens_all_ids"] = self.token_ids + result["tokens_all_ids"]
+        if "output_token_num" in result:
+            result["output_token_num"] += len(self.token_ids)
+        if self.input_token_num is not None:
+            result["input_token_num"] = self.input_token_num
+        return result
+
+    async def stream(self, chunks):
+        """
+        在decode实例的流式结果前返回首个token，后续结果的send_idx顺延
+        """
+        if not self.return_all_tokens:
+            yield json.dumps({"req_id": self.req_id, "is_end": 0, "token": self.text, "token_ids": self.token_ids,
+                              "send_idx": 0, "input_token_num": self.input_token_num,
+                              "error_msg": "", "error_code": 0}, ensure_ascii=False) + "\n"
+        buffer = b""
+        async for chunk in chunks:
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield self._merge_line(line)
+        if buffer.strip():
+            yield self._merge_line(buffer)
+
+    def _merge_line(self, line):
+        result = json.loads(line)
+        if "send_idx" in result:
+            result["send_idx"] += len(self.token_ids)
+        if result.get("is_end") == 1:
+            result = self.merge_end(result)
+        else:
+            result["req_id"] = self.req_id
+            result.pop("input_token_num", None)
+        return json.dumps(result, ensure_ascii=False) + "\n"
+
+
+def _track(replica, req_id, upstream_req_id):
+    replica.inflight_num += 1
+    if req_id is not None:
+        inflight_requests[req_id] = (replica, upstream_req_id)
+
+
+def _untrack(replica, req_id):
+    replica.inflight_num -= 1
+    if req_id is not None:
+        inflight_requests.pop(req_id, None)
+
+
+async def _wait_unless_disconnected(raw_request: Request, coroutine):
+    """
+    等待非流式请求的结果，客户端断开连接时取消等待并关闭到实例的连接，由实例取消请求
+
+    Returns:
+        bool: 客户端是否已断开连接
+        Any: 请求的结果，客户端断开时为None
+    """
+    task = asyncio.ensure_future(coroutine)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_CHECK_INTERVAL)
+        if done:
+            return False, task.result()
+        if await raw_request.is_disconnected():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            return True, None
+
+
+def launch_router(port: int) -> None:
+    """
+    启动router服务，各进程独立查询实例状态，使用单进程以获得一致的负载视图
+    """
+    router_logger.info(f"launch router... port: {port}")
+    try:
+        uvicorn.run(app="server.router.app:app",
+                    host='0.0.0.0',
+                    port=port,
+                    workers=1,
+                    log_level="error")
+    except Exception as e:
+        router_logger.error(f"launch router error, {e}")
+
+
+def main():
+    """main函数"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", default=9900, type=int, help="port to the router")
+    parser.add_argument("--replicas", default=None, type=str,
+                        help="comma separated http urls of the replicas, overrides ROUTER_REPLICAS")
+    parser.add_argument("--policy", default=None, type=str,
+                        help="round_robin, least_loaded or prefix_affinity, overrides ROUTER_POLICY")
+    args = parser.parse_args()
+    if args.replicas is not None:
+        os.environ["ROUTER_REPLICAS"] = args.replicas
+    if args.policy is not None:
+        os.environ["ROUTER_POLICY"] = args.policy
+    launch_router(port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import time
+
+
+def get_prefix_key(body, prefix_len):
+    """
+    请求prompt前缀的哈希，相同system prompt或相同对话历史的请求得到相同的key，
+    多轮对话不包含最后一轮消息，其余请求取prompt的前prefix_len个字符
+
+    Args:
+        body (dict): FastDeploy或OpenAI格式的请求
+        prefix_len (int): 参与哈希的前缀字符数
+
+    Returns:
+        str: 前缀的哈希，请求没有prompt时返回None
+    """
+    if body.get("messages"):
+        messages = body["messages"][:-1] if len(body["messages"]) > 1 else body["messages"]
+        prompt = (body.get("system") or "") + json.dumps(messages, ensure_ascii=False)
+    elif body.get("text") or body.get("prompt"):
+        prompt = body.get("text") or body.get("prompt")
+        if not isinstance(prompt, str):
+            prompt = json.dumps(prompt)
+    elif body.get("input_ids"):
+        prompt = json.dumps(body["input_ids"])
+    else:
+        return None
+    return hashlib.sha1(prompt[:prefix_len].encode("utf-8")).hexdigest()
+
+
+class Replica(object):
+    """
+    一个推理服务实例，记录最近一次查询到的资源信息及router分发的请求数
+    """
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.healthy = False
+        self.info = dict()
+        self.update_time = 0.0
+        # 正在由该实例处理的请求数
+        self.inflight_num = 0
+        # 最近一次查询资源信息之后分发的请求数，资源信息尚未反映这些请求
+        self.dispatched_num = 0
+
+    @property
+    def role(self):
+        return self.info.get("engine_role", "mixed")
+
+    def update(self, info):
+        """
+        更新资源信息，info为None表示查询失败
+        """
+        if info is None or info.get("error_code"):
+            self.healthy = False
+            return
+        self.info = info
+        self.healthy = True
+        self.update_time = time.time()
+        self.dispatched_num = 0
+
+    def load(self):
+        """
+        实例负载：排队与运行中的请求占batch的比例，加上已占用的block比例
+        """
+        total_batch_size = max(self.info.get("total_batch_size", 1), 1)
+        request_num = self.info.get("waiting_num", 0) + self.info.get("running_num", 0) + self.dispatched_num
+        return request_num / total_batch_size + 1.0 - self.info.get("available_resource", 1.0)
+
+
+class Router(object):
+    """
+    按策略为请求选择实例
+    1. round_robin：轮流分发
+    2. least_loaded：选择负载最低的实例
+    3. prefix_affinity：按prompt前缀的哈希选择实例（rendezvous hashing，实例增减时只影响部分前缀），
+       相同前缀的请求落在同一实例上命中其前缀缓存；该实例负载比最低负载高出affinity_load_gap时改为选择负载最低的实例
+    """
+    POLICIES = ("round_robin", "least_loaded", "prefix_affinity")
+
+    def __init__(self, urls, policy="prefix_affinity", prefix_len=1024, affinity_load_gap=1.0):
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown router policy: {policy}, should be one of {self.POLICIES}")
+        self.replicas = [Replica(url) for url in urls]
+        self.policy = policy
+        self.prefix_len = prefix_len
+        self.affinity_load_gap = affinity_load_gap
+        self.next_index = 0
+
+    def candidates(self, role):
+        """
+        可处理指定角色请求的健康实例
+        """
+        return [replica for replica in self.replicas if replica.healthy and replica.role == role]
+
+    def is_disaggregated(self):
+        """
+        是否有可用的prefill与decode实例
+        """
+        return len(self.candidates("prefill")) > 0 and len(self.candidates("decode")) > 0
+
+    def select(self, body, role="mixed"):
+        """
+        为请求选择实例，并计入该实例的分发请求数
+
+        Returns:
+            Replica: 选中的实例，没有可用实例时返回None
+        """
+        replicas = self.candidates(role)
+        if not replicas:
+            return None
+        if self.policy == "round_robin":
+            replica = replicas[self.next_index % len(replicas)]
+            self.next_index += 1
+        else:
+            replica = min(replicas, key=lambda r: r.load())
+            # decode阶段的请求已带有KV，无需按前缀选择
+            prefix_key = get_prefix_key(body, self.prefix_len) if role != "decode" else None
+            if self.policy == "prefix_affinity" and prefix_key is not None:
+                preferred = max(replicas, key=lambda r: hashlib.sha1(f"{prefix_key}{r.url}".encode()).digest())
+                if preferred.load() <= replica.load() + self.affinity_load_gap:
+                    replica = preferred
+        replica.dispatched_num += 1
+        return replica
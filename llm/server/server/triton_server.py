@@ -23,6 +23,7 @@ import threading
 import time
 import traceback
 from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import numpy as np
@@ -32,6 +33,11 @@ from server.checker import (
 )
 from server.engine import engine
 from server.engine.config import Config
+from server.engine.guided_decoding import GuidedDecodingCompiler, get_guided_spec
+from server.engine.kv_transport import create_kv_transport, get_kv_transfer_key
+from server.engine.lora import LoraRegistry
+from server.data.stop_matcher import StopStringMatcher
+from server.engine.scheduler import create_scheduler
 from server.utils import error_logger, model_server_logger
 
 import server
@@ -58,6 +64,50 @@ class TritonConfig(Config):
             setattr(self, k, v)
 
 
+class TritonHistogramExporter(object):
+    """
+    将直方图按Prometheus的约定导出为<name>_bucket、<name>_sum、<name>_count三组计数器，
+    每次导出只把上次导出后新增的计数累加到Triton的指标中
+    """
+    def __init__(self, histogram):
+        self.histogram = histogram
+        bucket_family = pb_utils.MetricFamily(
+            name=f"{histogram.name}_bucket",
+            description=histogram.description,
+            kind=pb_utils.MetricFamily.COUNTER,
+        )
+        sum_family = pb_utils.MetricFamily(
+            name=f"{histogram.name}_sum",
+            description=histogram.description,
+            kind=pb_utils.MetricFamily.COUNTER,
+        )
+        count_family = pb_utils.MetricFamily(
+            name=f"{histogram.name}_count",
+            description=histogram.description,
+            kind=pb_utils.MetricFamily.COUNTER,
+        )
+        bounds = [f"{bound:g}" for bound in histogram.buckets] + ["+Inf"]
+        self.bucket_metrics = [bucket_family.Metric(labels={"le": bound}) for bound in bounds]
+        self.sum_metric = sum_family.Metric(labels={})
+        self.count_metric = count_family.Metric(labels={})
+        self.exported_counts = [0] * len(bounds)
+        self.exported_sum = 0.0
+
+    def export(self):
+        """
+        导出新增的计数
+        """
+        counts, total = self.histogram.snapshot()
+        for metric, count, exported_count in zip(self.bucket_metrics, counts, self.exported_counts):
+            if count > exported_count:
+                metric.increment(count - exported_count)
+        if counts[-1] > self.exported_counts[-1]:
+            self.count_metric.increment(counts[-1] - self.exported_counts[-1])
+            self.sum_metric.increment(total - self.exported_sum)
+        self.exported_counts = counts
+        self.exported_sum = total
+
+
 class TritonTokenProcessor(engine.TokenProcessor):
     """
     创建Triton服务的Processor
@@ -65,46 +115,199 @@ class TritonTokenProcessor(engine.TokenProcessor):
     def __init__(self, cfg, triton_server):
         super().__init__(cfg)
         self.triton_server = triton_server
-        # 缓存的结果
-        self.cached_generated_tokens = queue.Queue()
+        # 缓存的结果，每个发送线程一个队列，请求按req_id哈希到固定的队列，n>1的各采样按所属请求的req_id哈希
+        self.cached_generated_tokens = [queue.Queue() for _ in range(self.cfg.push_mode_sender_threads)]
         # Token缓存，针对部分特殊Token累积后再发送
         self.token_buffer = dict()
         # Score缓存，针对部分特殊Token累积后再发送
         self.score_buffer = dict()
 
-        self.push_mode_sender_thread = threading.Thread(target=self._push_mode_sender_thread, args=())
-        self.push_mode_sender_thread.daemon = True
-        self.push_mode_sender_thread.start()
+        self.push_mode_sender_threads = list()
+        for cached_generated_tokens in self.cached_generated_tokens:
+            sender_thread = threading.Thread(target=self._push_mode_sender_thread, args=(cached_generated_tokens, ))
+            sender_thread.daemon = True
+            sender_thread.start()
+            self.push_mode_sender_threads.append(sender_thread)
 
-    def _push_mode_sender_thread(self):
+    def _push_mode_sender_thread(self, cached_generated_tokens):
+        """
+        发送线程，负责分配到本线程的请求的解码与发送，各线程的请求互不相交，
+        各线程使用独立的DataProcessor，解码状态与通信句柄只被本线程使用，仅在读写response_sender时加锁
+        """
+        try:
+            from server.data.processor import DataProcessor
+            data_processor = DataProcessor()
+        except Exception as e:
+            model_server_logger.error("push_mode_sender thread exit unexpectedly, failed to create data processor: "
+                                      f"{e}, {str(traceback.format_exc())}")
+            return
+        # 开启合并发送的请求中尚未发送的结果
+        coalescing_results = dict()
+        # 设置了停止字符串的请求的匹配状态，以及已匹配到停止字符串、等待推理进程停止的请求
+        stop_matchers = dict()
+        stopped_req_ids = set()
         while True:
             try:
-                batch_result = self.cached_generated_tokens.get()
+                try:
+                    batch_result = cached_generated_tokens.get(timeout=self._get_coalesce_timeout(coalescing_results))
+                except queue.Empty:
+                    batch_result = list()
+                send_results = list()
                 for result in batch_result:
-                    req_id = result["req_id"]
                     is_end = result.get("is_end", 0)
+                    # 已因停止字符串结束的请求，丢弃之后的结果，直到推理进程停止后的结束结果
+                    if result["req_id"] in stopped_req_ids:
+                        if is_end == 1:
+                            stopped_req_ids.discard(result["req_id"])
+                        continue
                     return_all_tokens = result.get("return_all_tokens", False)
-                    # 非流式返回下仅返回最后一个Token结果
-                    if is_end == 0 and (return_all_tokens or self.cfg.disable_streaming):
+                    # 非流式返回下仅返回最后一个Token结果，设置了停止字符串的请求仍需逐步解码匹配
+                    if is_end == 0 and (return_all_tokens or self.cfg.disable_streaming) and "stop" not in result:
                         continue
                     if return_all_tokens and "topk_tokens" in result:
                         del result["topk_tokens"]
-                    result = self.triton_server.data_processor.process_response(result)
+                    send_results.append(result)
+                # 同一推理步的结果批量解码
+                send_results = data_processor.batch_process_response(send_results)
+                send_results = self._match_stop_strings(send_results, data_processor, stop_matchers, stopped_req_ids)
+                send_results = self._coalesce_results(send_results, coalescing_results)
+                for result in send_results:
+                    req_id = result["req_id"]
+                    is_end = result.get("is_end", 0)
                     model_server_logger.debug(f"Send result to client under push mode: {result}")
+                    end_flag = is_end
                     with self.triton_server.thread_lock:
-                        _send_result([result], self.triton_server.response_sender[req_id], is_end)
+                        sender = self.triton_server.response_sender[req_id]
                         if is_end == 1:
                             del self.triton_server.response_sender[req_id]
-                            self.triton_server._update_metrics()
+                            end_flag = self.triton_server._finish_sample(req_id)
+                    _send_result([result], sender, end_flag)
+                    if is_end == 1:
+                        self.triton_server._update_metrics()
             except Exception as e:
                     model_server_logger.error("Unexcepted error happend: {}, {}".format(e, str(traceback.format_exc())))
 
+    def _match_stop_strings(self, results, data_processor, stop_matchers, stopped_req_ids):
+        """
+        在设置了停止字符串的请求的解码文本中增量匹配，可能是停止字符串前缀的文本暂不返回
+        匹配到时将结果改为结束结果，停止字符串及之后的文本不返回，并通知插入线程停止推理、回收资源
+
+        Args:
+            results (list[dict]): 解码后的结果
+            data_processor (DataProcessor): 发送线程的DataProcessor，匹配到停止字符串时清除请求的解码状态
+            stop_matchers (dict): 各请求的匹配状态，由发送线程维护
+            stopped_req_ids (set): 已匹配到停止字符串、等待推理进程停止的请求，由发送线程维护
+
+        Returns:
+            list[dict]: 需要发送的结果
+        """
+        send_results = list()
+        for result in results:
+            stop = result.pop("stop", None)
+            req_id = result["req_id"]
+            if stop is None:
+                send_results.append(result)
+                continue
+            # 同一批结果中匹配到停止字符串之后的结果，推理进程已生成结束符时无需再等待结束结果
+            if req_id in stopped_req_ids:
+                if result.get("is_end", 0) == 1:
+                    stopped_req_ids.discard(req_id)
+                continue
+            matcher = stop_matchers.get(req_id)
+            if matcher is None:
+                matcher = stop_matchers[req_id] = StopStringMatcher(stop)
+            result["token"], stopped = matcher.feed(result.get("token", ""))
+            if stopped:
+                del stop_matchers[req_id]
+                data_processor.clear_request_status(req_id)
+                result["is_end"] = 1
+                result["finish_reason"] = "stop"
+                result["tokens_all"] = matcher.text
+                result["output_token_num"] = result["send_idx"] + len(result.get("token_ids", []))
+                stopped_req_ids.add(req_id)
+                self.triton_server._stop_task(req_id)
+                send_results.append(result)
+            elif result.get("is_end", 0) == 1:
+                del stop_matchers[req_id]
+                result["token"] += matcher.flush()
+                send_results.append(result)
+            elif not (result.get("return_all_tokens", False) or self.cfg.disable_streaming):
+                send_results.append(result)
+        return send_results
+
+    def _coalesce_results(self, results, coalescing_results):
+        """
+        合并开启了coalesce_tokens或coalesce_ms的请求的流式结果，累积到coalesce_tokens个token、
+        距首个未发送token超过coalesce_ms毫秒或请求结束时，合并为一条结果发送
+
+        Args:
+            results (list[dict]): 本次待发送的结果
+            coalescing_results (dict): 各请求尚未发送的合并结果，由发送线程维护
+
+        Returns:
+            list[dict]: 需要立即发送的结果
+        """
+        now = time.time()
+        send_results = list()
+        for result in results:
+            coalesce_tokens = result.pop("coalesce_tokens", None)
+            coalesce_ms = result.pop("coalesce_ms", None)
+            if coalesce_tokens is None and coalesce_ms is None:
+                send_results.append(result)
+                continue
+            pending = coalescing_results.pop(result["req_id"], None)
+            if pending is None:
+                pending = {"token_num": 0, "start_time": now,
+                           "coalesce_tokens": coalesce_tokens, "coalesce_ms": coalesce_ms}
+            else:
+                # 合并后的结果保留最新的状态信息，send_idx为其中首个token的序号
+                previous = pending["result"]
+                result["token"] = previous.get("token", "") + result.get("token", "")
+                result["token_ids"] = previous.get("token_ids", []) + result.get("token_ids", [])
+                result["send_idx"] = previous["send_idx"]
+            pending["result"] = result
+            pending["token_num"] += 1
+            if result.get("is_end", 0) == 1 or \
+                    (coalesce_tokens is not None and pending["token_num"] >= coalesce_tokens) or \
+                    (coalesce_ms is not None and (now - pending["start_time"]) * 1000 >= coalesce_ms):
+                send_results.append(result)
+            else:
+                coalescing_results[result["req_id"]] = pending
+
+        # 发送等待时间已到的合并结果
+        for req_id in list(coalescing_results.keys()):
+            pending = coalescing_results[req_id]
+            if pending["coalesce_ms"] is not None and (now - pending["start_time"]) * 1000 >= pending["coalesce_ms"]:
+                send_results.append(coalescing_results.pop(req_id)["result"])
+        return send_results
+
+    def _get_coalesce_timeout(self, coalescing_results):
+        """
+        计算发送线程等待新结果的超时时间，保证合并结果按时发送
+        """
+        timeout = None
+        now = time.time()
+        for pending in coalescing_results.values():
+            if pending["coalesce_ms"] is None:
+                continue
+            remaining = max(pending["start_time"] + pending["coalesce_ms"] / 1000 - now, 0)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
     def postprocess(self, batch_result, exist_finished_task=False):
         """
         生成单步结果后处理函数
         """
         try:
-            self.cached_generated_tokens.put(batch_result)
+            if len(self.cached_generated_tokens) == 1:
+                self.cached_generated_tokens[0].put(batch_result)
+                return
+            shard_results = [list() for _ in self.cached_generated_tokens]
+            for result in batch_result:
+                shard_results[hash(_get_parent_req_id(result)) % len(shard_results)].append(result)
+            for cached_generated_tokens, results in zip(self.cached_generated_tokens, shard_results):
+                if results:
+                    cached_generated_tokens.put(results)
         except Exception as e:
             model_server_logger.info(
                 "Unexcepted problem happend while process output token: {}, {}"
@@ -163,11 +366,19 @@ class TritonServer(object):
             "available_resource":
             self.metric_family.Metric(
                 labels={"available_resource": "available_resource"}),
+            "preempted_num":
+            self.metric_family.Metric(
+                labels={"preempted_num": "preempted_num"}),
+            "resumed_num":
+            self.metric_family.Metric(
+                labels={"resumed_num": "resumed_num"}),
         }
 
         # Triton服务所需变量
         # response_sender的线程锁，避免多线程访问或读写时的问题
         self.thread_lock = threading.Lock()
+        # 多个发送线程会同时更新指标，导出直方图时加锁
+        self.metrics_lock = threading.Lock()
 
         base_config = Config()
         self.cfg = TritonConfig(base_config)
@@ -176,6 +387,9 @@ class TritonServer(object):
         # 初始化底层引擎
         self.token_processor = TritonTokenProcessor(self.cfg, self)
         self.engine = engine.Engine(self.cfg, self.token_processor)
+        self.histogram_exporters = [
+            TritonHistogramExporter(histogram) for histogram in self.token_processor.metrics.histograms()
+        ]
         model_server_logger.info("Creat engine...")
         self.engine.start()
         model_server_logger.info("Create engine success")
@@ -197,6 +411,13 @@ class TritonServer(object):
         tasks = json.loads(request_tensor.as_numpy()[0])
 
         model_server_logger.info(f"receive task: {tasks}")
+        if tasks and isinstance(tasks[0], dict) and tasks[0].get("abort"):
+            self._abort_task_push_mode(tasks[0].get("req_id"), current_response_sender)
+            return
+        if tasks and isinstance(tasks[0], dict) and tasks[0].get("server_info"):
+            # 服务资源信息查询，供router按负载分发请求
+            _send_result(self._get_current_server_info(), current_response_sender, 1)
+            return
         self._process_task_push_mode(tasks, current_response_sender)
         self._update_metrics()
 
@@ -215,6 +436,8 @@ class TritonServer(object):
             time.sleep(5)
         model_server_logger.info("Terminate the engine now.")
         self.enable_insert_task_push_mode = False
+        if hasattr(self, "preprocess_pool"):
+            self.preprocess_pool.shutdown(wait=False)
         time.sleep(1)
         del self.engine
         if hasattr(self, "http_process"):
@@ -222,9 +445,7 @@ class TritonServer(object):
         model_server_logger.info("Triton service is terminated!")
 
     def _initialize_push_mode(self):
-        from server.data.processor import DataProcessor
-        self.data_processor = DataProcessor()
-        model_server_logger.info("create data processor success")
+        from server.data.processor import TokenizeCache
 
         # 是否开启HTTP协议支持
         if self.cfg.push_mode_http_port < 0:
@@ -253,8 +474,36 @@ class TritonServer(object):
 
             # 需要维护每个请求的通信句柄
             self.response_sender = dict()
-            # 请求队列，从左侧插入，从右侧取出
-            self.cached_task_deque = deque()
+            # n>1的请求，各采样所属的请求及请求尚未结束的采样数
+            self.sample_parents = dict()
+            self.sample_remaining = dict()
+            # 等待插入线程处理的取消请求，以及匹配到停止字符串、需要停止的采样
+            self.abort_req_ids = deque()
+            self.stop_req_ids = deque()
+            # 请求预处理线程池，各线程使用独立的DataProcessor，共用tokenize缓存
+            self.tokenize_cache = TokenizeCache(self.cfg.tokenize_cache_size) \
+                if self.cfg.tokenize_cache_size > 0 else None
+            self.preprocess_local = threading.local()
+            self.preprocess_pool = ThreadPoolExecutor(max_workers=self.cfg.push_mode_preprocess_threads,
+                                                      thread_name_prefix="preprocess")
+            # 正在预处理的请求，以及预处理期间被取消的请求
+            self.preprocessing_req_ids = set()
+            self.preprocess_aborted_req_ids = set()
+            # 约束解码参数在预处理线程中编译，编译结果写入磁盘缓存，由推理进程按key加载
+            self.guided_compiler = None
+            if self.cfg.enable_guided_decoding:
+                self.guided_compiler = GuidedDecodingCompiler(self.cfg.guided_decoding_cache_dir,
+                                                              self.cfg.guided_decoding_cache_size,
+                                                              self.cfg.get_model_config()["vocab_size"],
+                                                              self.cfg.guided_decoding_max_states)
+            # LoRA adapter注册表，请求的adapter_id在预处理时转换为key，引擎按key分配显存位置
+            self.lora_registry = None
+            if self.cfg.enable_lora:
+                self.lora_registry = LoraRegistry(self.cfg.lora_adapter_dir, self.cfg.lora_max_rank)
+            # prefill与decode分离时的KV传输，decode实例在预处理线程中等待prefill实例发送的KV
+            self.kv_transport = create_kv_transport(self.cfg)
+            # 请求缓存队列，按调度策略取出请求插入引擎
+            self.scheduler = create_scheduler(self.cfg)
             # 持续监控引擎和请求队列，当引擎有资源时，从请求队列中获取数据，插入到引擎内
             self.enable_insert_task_push_mode = True
             self.insert_task_to_engine_thread = threading.Thread(
@@ -264,19 +513,11 @@ class TritonServer(object):
 
     def _process_task_push_mode(self, tasks, current_response_sender):
         """
-        针对推模式，对请求进行检查，如果没问题则插入到cached_task_deque中。
+        针对推模式，对请求进行基础检查后提交到预处理线程池，拼接对话模板、tokenize等耗时的处理不阻塞execute
         """
         try:
             # 基础检查，如果检查失败，则直接返回错误信息
-            tik = time.time()
             req_id = tasks[0]["req_id"]
-            cached_task_num = len(self.cached_task_deque)
-            if cached_task_num >= self.cfg.max_cached_task_num:
-                error_msg = f"cached task num ({cached_task_num}) exceeds " \
-                            f"the limit ({self.cfg.max_cached_task_num})"
-                _send_error(error_msg, current_response_sender, req_id=req_id)
-                return
-
             if not tasks or len(tasks) != 1 or not tasks[0]:
                 error_msg = f"request data should not be empty and query " \
                             f"num {len(tasks)} should be 1"
@@ -291,6 +532,19 @@ class TritonServer(object):
                 _send_error(error_msg, current_response_sender, req_id=req_id)
                 return
 
+            # n>1的请求拆分为n个采样，每个采样各占一个缓存位置和一个batch位置
+            n = task.get("n", 1)
+            if n > self.cfg.max_batch_size:
+                error_msg = f"The parameter n({n}) exceeds the limit BATCH_SIZE({self.cfg.max_batch_size})."
+                _send_error(error_msg, current_response_sender, req_id=req_id)
+                return
+            cached_task_num = self.scheduler.sample_num
+            if cached_task_num + n > self.cfg.max_cached_task_num:
+                error_msg = f"cached task num ({cached_task_num}) + n ({n}) exceeds " \
+                            f"the limit ({self.cfg.max_cached_task_num})"
+                _send_error(error_msg, current_response_sender, req_id=req_id)
+                return
+
             task_id = task["req_id"]
             with self.thread_lock:
                 if task_id in self.response_sender:
@@ -298,16 +552,38 @@ class TritonServer(object):
                                     f"the current request will be ignored."
                     _send_error(error_msg, current_response_sender, req_id=req_id)
                     return
+                preprocess_task_num = len(self.preprocessing_req_ids)
+                if preprocess_task_num >= self.cfg.max_preprocess_task_num:
+                    error_msg = f"preprocess task num ({preprocess_task_num}) exceeds " \
+                                f"the limit ({self.cfg.max_preprocess_task_num})"
+                    _send_error(error_msg, current_response_sender, req_id=req_id)
+                    return
+                # 预处理期间即占用req_id，避免重复的req_id同时进入预处理
+                self.response_sender[task_id] = current_response_sender
+                self.preprocessing_req_ids.add(task_id)
+            self.preprocess_pool.submit(self._preprocess_task, task, current_response_sender)
+        except Exception as e:
+            error_msg = "Unexcepted promblem happend while insert new task to server task queue: {}, {}".format(
+                e, str(traceback.format_exc()))
+            _send_error(error_msg, current_response_sender)
 
+    def _preprocess_task(self, task, current_response_sender):
+        """
+        在预处理线程中拼接对话模板、tokenize并检查输入长度，如果没问题则插入到scheduler中
+        """
+        task_id = task["req_id"]
+        try:
+            tik = time.time()
+            data_processor = self._get_preprocess_data_processor()
             # 添加默认参数
             task = add_default_params(task)
 
             # 拼接和tokenizer处理，默认支持截断
             if int(task.get("enable_text_truncate", 1)):
                 real_seq_len = self.cfg.max_seq_len - task.get("max_dec_len", 800)
-                task = self.data_processor.process_request(task, max_seq_len=real_seq_len)
+                task = data_processor.process_request(task, max_seq_len=real_seq_len)
             else:
-                task = self.data_processor.process_request(task)
+                task = data_processor.process_request(task)
 
             # 检查输入长度
             input_ids_len = len(task["input_ids"])
@@ -317,87 +593,346 @@ class TritonServer(object):
             if input_ids_len + min_dec_len >= self.cfg.max_seq_len:
                 error_msg = f"Input text is too long, input_ids_len ({input_ids_len}) " \
                             f"+ min_dec_len ({min_dec_len}) >= max_seq_len "
-                _send_error(error_msg, current_response_sender, req_id=req_id)
+                self._reject_task(task_id, error_msg, current_response_sender)
                 return
 
             if input_ids_len > self.cfg.seq_len_limit:
                 error_msg = f"Length of input token({input_ids_len}) exceeds the limit MAX_SEQ_LEN({self.cfg.seq_len_limit})."
-                _send_error(error_msg, current_response_sender, req_id=req_id)
+                self._reject_task(task_id, error_msg, current_response_sender)
                 return
             if task["max_dec_len"] > self.cfg.dec_len_limit:
                 error_msg = f"The parameter max_dec_len({task['max_dec_len']}) exceeds the limit MAX_DEC_LEN({self.cfg.dec_len_limit})."
-                _send_error(error_msg, current_response_sender, req_id=req_id)
+                self._reject_task(task_id, error_msg, current_response_sender)
                 return
 
             required_block_num = self.engine.resource_manager.get_required_block_number(input_ids_len)
             if required_block_num > self.engine.resource_manager.total_block_number():
                 error_msg = f"The input task required resources is exceed the limit, task={task}."
-                _send_error(error_msg, current_response_sender, req_id=req_id)
+                self._reject_task(task_id, error_msg, current_response_sender)
                 return
 
-            with self.thread_lock:
-                # 插入缓存队列
-                self.response_sender[task_id] = current_response_sender
+            guided_spec = get_guided_spec(task)
+            if guided_spec is not None:
+                if self.guided_compiler is None:
+                    error_msg = "Guided decoding is disabled, please set ENABLE_GUIDED_DECODING=1 to enable it."
+                    self._reject_task(task_id, error_msg, current_response_sender)
+                    return
+                try:
+                    # 相同参数的编译结果直接从缓存中获取，新参数的编译只阻塞当前预处理线程
+                    task["guided_fsm"] = self.guided_compiler.compile(
+                        guided_spec, data_processor.tokenizer, task["eos_token_ids"])
+                except ValueError as e:
+                    error_msg = f"Invalid guided decoding params: {e}"
+                    self._reject_task(task_id, error_msg, current_response_sender)
+                    return
+
+            if task.get("adapter_id") is not None:
+                if self.lora_registry is None:
+                    error_msg = "LoRA is disabled, please set LORA_ADAPTER_DIR to enable it."
+                    self._reject_task(task_id, error_msg, current_response_sender)
+                    return
+                try:
+                    task["lora_key"] = self.lora_registry.get_key(task["adapter_id"])
+                except ValueError as e:
+                    error_msg = f"Invalid adapter_id: {e}"
+                    self._reject_task(task_id, error_msg, current_response_sender)
+                    return
+
+            if self.cfg.engine_role != "mixed":
+                error_msg = self._prepare_kv_transfer(task)
+                if error_msg is not None:
+                    self._reject_task(task_id, error_msg, current_response_sender)
+                    return
 
             task["preprocess_end_time"] = datetime.now()
-            self.cached_task_deque.appendleft(task)
+            samples = self._fork_samples(task)
+            with self.thread_lock:
+                self.preprocessing_req_ids.discard(task_id)
+                aborted = task_id in self.preprocess_aborted_req_ids
+                self.preprocess_aborted_req_ids.discard(task_id)
+                # 插入缓存队列，n>1时各采样共用请求的通信句柄，所有采样结束后才结束请求
+                for sample in samples:
+                    self.response_sender[sample["req_id"]] = current_response_sender
+                if len(samples) > 1:
+                    for sample in samples:
+                        self.sample_parents[sample["req_id"]] = task_id
+                    self.sample_remaining[task_id] = len(samples)
+
+            # 预处理期间被取消的请求不再插入，直接结束
+            if aborted:
+                self.token_processor.postprocess([_abort_result(sample) for sample in samples], True)
+                model_server_logger.info(f"req_id ({task_id}) is aborted while preprocessing")
+                return
+            if len(samples) > 1 and self.cfg.enable_prefix_cache:
+                # 其余采样待首个采样prefill完成后再调度，复用前缀缓存中的prompt block
+                task["forked_tasks"] = samples[1:]
+                self.scheduler.put(task)
+            else:
+                for sample in samples:
+                    self.scheduler.put(sample)
+            self.engine.notify_update()
             tok = time.time()
             model_server_logger.info(f"cache task with req_id ({task_id}), "
-                                     f"cost time: {tok-tik}s, cached_task_num: {len(self.cached_task_deque)}.")
+                                     f"preprocess cost time: {tok-tik}s, cached_task_num: {len(self.scheduler)}.")
             model_server_logger.debug(f"cache task: {task}")
         except Exception as e:
             error_msg = "Unexcepted promblem happend while insert new task to server task queue: {}, {}".format(
                 e, str(traceback.format_exc()))
-            _send_error(error_msg, current_response_sender)
+            self._reject_task(task_id, error_msg, current_response_sender)
+
+    def _get_preprocess_data_processor(self):
+        """
+        获取当前预处理线程的DataProcessor，各线程使用独立的tokenizer，共用tokenize缓存
+        """
+        data_processor = getattr(self.preprocess_local, "data_processor", None)
+        if data_processor is None:
+            from server.data.processor import DataProcessor
+            data_processor = DataProcessor(tokenize_cache=self.tokenize_cache)
+            self.preprocess_local.data_processor = data_processor
+        return data_processor
+
+    def _reject_task(self, task_id, error_msg, current_response_sender):
+        """
+        预处理失败，释放请求占用的req_id并返回错误信息
+        """
+        with self.thread_lock:
+            self.preprocessing_req_ids.discard(task_id)
+            self.preprocess_aborted_req_ids.discard(task_id)
+            self.response_sender.pop(task_id, None)
+        _send_error(error_msg, current_response_sender, req_id=task_id)
+
+    def _abort_task_push_mode(self, req_id, current_response_sender):
+        """
+        接收取消请求，由插入线程停止并回收请求的所有采样，立即返回请求是否存在
+        """
+        with self.thread_lock:
+            exists = req_id in self.response_sender or req_id in self.sample_remaining
+            if req_id in self.preprocessing_req_ids:
+                self.preprocess_aborted_req_ids.add(req_id)
+        if exists:
+            self.abort_req_ids.append(req_id)
+            self.engine.notify_update()
+        model_server_logger.info(f"receive abort request, req_id: {req_id}, exists: {exists}")
+        _send_result({"req_id": req_id, "aborted": exists, "error_msg": "", "error_code": 0},
+                     current_response_sender, 1)
+
+    def _stop_task(self, req_id):
+        """
+        请求匹配到停止字符串，已向客户端返回结束结果，由插入线程停止推理并回收资源
+        """
+        self.stop_req_ids.append(req_id)
+        self.engine.notify_update()
+        model_server_logger.info(f"req_id ({req_id}) matches stop string")
+
+    def _abort_tasks(self):
+        """
+        处理取消请求，在插入线程中执行，与任务插入串行，避免通知推理进程停止的位置已被分配给新任务
+        缓存中的请求直接移除，正在推理的请求在推理进程中停止后由TokenProcessor回收资源，
+        均返回finish_reason为abort的结束结果，经发送线程结束请求
+        """
+        req_ids = set()
+        while self.abort_req_ids:
+            req_ids.add(self.abort_req_ids.popleft())
+        with self.thread_lock:
+            req_ids.update([sample_id for sample_id, parent_id in self.sample_parents.items() if parent_id in req_ids])
+        # 匹配到停止字符串的采样只停止其本身，结束结果已发送，其后的结果由发送线程丢弃
+        while self.stop_req_ids:
+            req_ids.add(self.stop_req_ids.popleft())
+        tasks = self.scheduler.remove(req_ids)
+        for task in list(tasks):
+            tasks.extend(task.pop("forked_tasks", None) or [])
+        self._discard_claimed_kv(tasks)
+        tasks.extend(self.engine.abort_tasks(req_ids))
+        if tasks:
+            self.token_processor.postprocess([_abort_result(task) for task in tasks], True)
+        model_server_logger.info(f"abort req_ids: {req_ids}, finished task num: {len(tasks)}, "
+                                 f"cached_task_num: {len(self.scheduler)}")
+
+    def _check_task_before_insert(self, task):
+        """
+        插入引擎前确认任务依赖的文件仍然可用，避免推理进程加载失败
+
+        Returns:
+            str: 错误信息，没有错误时返回None
+        """
+        if task.get("guided_fsm") and not self.guided_compiler.cache.ensure_saved(task["guided_fsm"]):
+            return f"The guided decoding fsm of req_id ({task['req_id']}) is not found, please retry the request."
+        if task.get("lora_key") and not self.lora_registry.exists(task["adapter_id"]):
+            return f"The adapter {task['adapter_id']} of req_id ({task['req_id']}) is not found."
+        return None
+
+    def _fail_cached_tasks(self, tasks, error_msg):
+        """
+        缓存中的任务无法插入引擎时返回错误结果，经发送线程结束请求，
+        n>1请求随首个采样缓存的其余采样一并结束
+        """
+        for task in list(tasks):
+            tasks.extend(task.pop("forked_tasks", None) or [])
+        self._discard_claimed_kv(tasks)
+        self.token_processor.postprocess([_error_result(task, error_msg) for task in tasks], True)
+        model_server_logger.error(f"req_ids: {[task['req_id'] for task in tasks]} failed before insert: {error_msg}")
+
+    def _discard_claimed_kv(self, tasks):
+        """
+        decode实例已认领KV、但不会插入引擎的任务，删除其KV
+        """
+        for task in tasks:
+            if task.get("kv_token_num") is not None:
+                self.kv_transport.discard(task["kv_transfer_key"], self.cfg.mp_num)
+
+    def _prepare_kv_transfer(self, task):
+        """
+        prefill与decode分离：prefill实例只生成首个token，prefill完成后以请求的req_id发送prompt的KV；
+        decode实例的请求需带上prefill实例的prefill_req_id与生成的prefill_token_ids，
+        等待KV发送完成并认领后，以prompt与首个token作为输入，只计算首个token；
+        KV超时未到达、与prompt不一致或已被清理时，在decode实例上重新计算prompt
+
+        Returns:
+            str: 错误信息，没有错误时返回None
+        """
+        if task.get("n", 1) > 1:
+            return f"The parameter n should be 1 when ENGINE_ROLE is {self.cfg.engine_role}."
+        if self.cfg.engine_role == "prefill":
+            task["kv_transfer_key"] = get_kv_transfer_key(task["req_id"])
+            task["min_dec_len"] = task["max_dec_len"] = 1
+            return None
+
+        if task.get("prefill_req_id") is None or not task.get("prefill_token_ids"):
+            return "The parameters prefill_req_id and prefill_token_ids are required when ENGINE_ROLE is decode."
+        key = get_kv_transfer_key(task["prefill_req_id"])
+        prefill_token_ids = [int(token_id) for token_id in task["prefill_token_ids"]]
+        token_num = self.kv_transport.wait(key, self.cfg.mp_num, self.cfg.kv_transfer_timeout)
+        if token_num is None:
+            model_server_logger.warning(f"timeout waiting for the kv of prefill request "
+                                        f"{task['prefill_req_id']}, recompute the prompt")
+        elif token_num != len(task["input_ids"]):
+            self.kv_transport.discard(key, self.cfg.mp_num)
+            model_server_logger.warning(f"the kv of prefill request {task['prefill_req_id']} has {token_num} "
+                                        f"tokens, but the prompt has {len(task['input_ids'])} tokens, "
+                                        f"recompute the prompt")
+        elif not self.kv_transport.claim(key, self.cfg.mp_num):
+            model_server_logger.warning(f"the kv of prefill request {task['prefill_req_id']} is cleaned up, "
+                                        f"recompute the prompt")
+        else:
+            task["kv_transfer_key"] = key
+            task["kv_token_num"] = token_num
+        task["input_ids"] = list(task["input_ids"]) + prefill_token_ids
+        task["max_dec_len"] = max(task["max_dec_len"] - len(prefill_token_ids), 1)
+        task["min_dec_len"] = max(task["min_dec_len"] - len(prefill_token_ids), 1)
+        if task.get("guided_fsm"):
+            # 约束解码的状态从prefill实例生成的token之后继续
+            task["guided_state"] = self.guided_compiler.get_state(task["guided_fsm"], prefill_token_ids)
+        return None
+
+    def _fork_samples(self, task):
+        """
+        将n>1的请求拆分为n个采样，首个采样沿用请求的req_id，其余采样为{req_id}_{i}，
+        指定了infer_seed时各采样的种子依次加1，避免生成相同的结果
+        """
+        n = task.pop("n", 1)
+        if n == 1:
+            return [task]
+        task["sample_index"] = 0
+        samples = [task]
+        for i in range(1, n):
+            sample = dict(task)
+            sample["req_id"] = f"{task['req_id']}_{i}"
+            sample["sample_index"] = i
+            if task.get("infer_seed") is not None:
+                sample["infer_seed"] = int(task["infer_seed"]) + i
+            samples.append(sample)
+        return samples
+
+    def _finish_sample(self, req_id):
+        """
+        采样结束，返回是否需要结束请求，即请求的所有采样均已结束，需持有thread_lock调用
+        """
+        parent_id = self.sample_parents.pop(req_id, None)
+        if parent_id is None:
+            return 1
+        self.sample_remaining[parent_id] -= 1
+        if self.sample_remaining[parent_id] > 0:
+            return 0
+        del self.sample_remaining[parent_id]
+        return 1
 
     def _insert_task_push_mode(self):
         """
         推push模式下的持续处理缓存task的线程，一旦有资源将缓存task插入到引擎中。
-        1. 所有接收到的请求会先插入到cached_task_deque
+        1. 所有接收到的请求会先插入到scheduler
         2. _insert_task_push_mode线程持续监控引擎
-        3. 一旦有资源可用，从cached_task_deque取出数据，提交给引擎
+        3. 一旦有资源可用，按调度策略从scheduler取出数据，提交给引擎
         """
         try:
             while self.enable_insert_task_push_mode:
                 if not hasattr(self, "engine") or self.engine is None:
                     time.sleep(0.1)
                     continue
-                if self.engine.available_batch() == 0:
-                    time.sleep(0.001)
+                if not self.engine.is_queue_empty():
+                    self.engine.wait_for_queue_consumed(timeout=0.01)
                     continue
-                if len(self.cached_task_deque) == 0:
-                    time.sleep(0.001)
+                if self.abort_req_ids or self.stop_req_ids:
+                    self._abort_tasks()
                     continue
-                if not self.engine.is_queue_empty():
-                    time.sleep(0.001)
+                # 优先下发分块prefill任务的后续分块，每个分块与其他请求的decode在同一步中计算
+                if self.engine.insert_prefill_chunks():
+                    continue
+                # 被抢占的任务重新放入调度队列，先于相同优先级的新请求恢复
+                for task in self.engine.pop_preempted_tasks():
+                    if task.get("guided_fsm"):
+                        # 约束解码的状态从已生成的token之后继续，decode实例还需包括prefill实例生成的token
+                        token_ids = list(task.get("generated_token_ids", []))
+                        if self.cfg.engine_role == "decode":
+                            token_ids = [int(token_id) for token_id in task["prefill_token_ids"]] + token_ids
+                        try:
+                            task["guided_state"] = self.guided_compiler.get_state(task["guided_fsm"], token_ids)
+                        except ValueError as e:
+                            self._fail_cached_tasks([task], str(e))
+                            continue
+                    self.scheduler.requeue(task)
+                # 首个采样已完成prefill的请求，其余采样优先插入，复用前缀缓存中的prompt block
+                for task in self.engine.pop_forked_tasks():
+                    self.scheduler.requeue(task)
+                # 推理进程的解码block不足时暂停插入新请求，并抢占一个任务以释放block
+                if self.cfg.enable_preemption and self.engine.has_block_step():
+                    self.engine.preempt_task()
+                    self.engine.wait_for_update(timeout=0.01)
+                    continue
+                if len(self.scheduler) == 0:
+                    self.engine.wait_for_update(timeout=0.01)
                     continue
 
-                i_bs = 0
+                inserted_num = 0
                 for _ in range(self.cfg.max_prefill_batch):
-                    if len(self.cached_task_deque) == 0:
-                        break
                     if self.engine.available_batch() == 0:
                         break
-                    while i_bs < self.cfg.max_batch_size:
-                        if self.engine.task_is_finished(i_bs):
-                            break
-                        i_bs += 1
-                    if i_bs >= self.cfg.max_batch_size:
-                        break
-                    # 此处无需加锁，execute中插入cached_task_deque的方向与-1的方向不同
-                    input_token_num = len(self.cached_task_deque[-1]["input_ids"])
-                    if not self.engine.is_resource_sufficient(input_token_num):
+                    task = self.scheduler.pop(self.engine.is_resource_sufficient)
+                    if task is None:
                         break
-                    task = self.cached_task_deque.pop()
+                    error_msg = self._check_task_before_insert(task)
+                    if error_msg is not None:
+                        self._fail_cached_tasks([task], error_msg)
+                        continue
                     try:
-                        self.engine.insert_tasks([task])
+                        if not self.engine.insert_tasks([task]):
+                            # 资源在判断后被占用等原因分配失败，放回调度队列等待资源回收后重试
+                            model_server_logger.warning(f"insert req_id ({task['req_id']}) failed, requeue it")
+                            self.scheduler.requeue(task)
+                            break
+                        inserted_num += 1
                     except Exception as e:
+                        inserted_num += 1
                         err_msg = "Error happend while insert task to engine: {}, {}.".format(
                             e, str(traceback.format_exc()))
                         with self.thread_lock:
                             _send_result({"error_msg": err_msg},
                                         self.response_sender[task["req_id"]], 1)
                             del self.response_sender[task["req_id"]]
+                # 缓存的请求资源均不满足时，抢占优先级更低的任务，并等待资源回收
+                if inserted_num == 0:
+                    if self.cfg.enable_preemption:
+                        self.engine.preempt_task(self.scheduler.peek())
+                    self.engine.wait_for_update(timeout=0.01)
             model_server_logger.info("finish insert_task_push_mode thread")
         except Exception as e:
             model_server_logger.error("insert_task_push_mode thread exit "
@@ -415,6 +950,11 @@ class TritonServer(object):
         self.metrics["max_block_num"].set(self.cfg.max_block_num)
         self.metrics["available_resource"].set(block_num * 1.0 /
                                                self.cfg.max_block_num)
+        self.metrics["preempted_num"].set(self.engine.resource_manager.preempted_num)
+        self.metrics["resumed_num"].set(self.engine.resource_manager.resumed_num)
+        with self.metrics_lock:
+            for exporter in self.histogram_exporters:
+                exporter.export()
 
     def _get_current_server_info(self):
         """
@@ -423,6 +963,9 @@ class TritonServer(object):
         available_batch_size = min(self.cfg.max_prefill_batch,
                                    self.engine.available_batch())
         available_block_num = self.engine.available_block_num()
+        # 预处理中的任务由预处理线程池并发增删，需持锁读取
+        with self.thread_lock:
+            waiting_num = self.scheduler.sample_num + len(self.preprocessing_req_ids)
         server_info = {
             "block_size": int(self.cfg.block_size),
             "block_num": int(available_block_num),
@@ -430,6 +973,11 @@ class TritonServer(object):
             "available_resource":
             1.0 * available_block_num / self.cfg.max_block_num,
             "max_batch_size": int(available_batch_size),
+            "engine_role": self.cfg.engine_role,
+            "total_block_num": int(self.cfg.max_block_num),
+            "total_batch_size": int(self.cfg.max_batch_size),
+            "running_num": int(self.cfg.max_batch_size - self.engine.available_batch()),
+            "waiting_num": waiting_num,
         }
         return server_info
 
@@ -453,6 +1001,50 @@ def _send_result(result_dict, sender, end_flag=0):
         return
     sender.send(response, flags=end_flag)
 
+def _get_parent_req_id(result):
+    """
+    结果所属请求的req_id，n>1时除首个采样外，采样的req_id为{req_id}_{index}
+    同一请求的各采样共用通信句柄，需由同一发送线程按顺序发送，保证请求的结束标记在所有采样的结果之后
+    """
+    req_id = str(result["req_id"])
+    index = result.get("index", 0)
+    if index > 0:
+        return req_id[:-len(f"_{index}")]
+    return req_id
+
+
+def _abort_result(task):
+    """
+    未在推理进程中运行的被取消任务的结束结果，被抢占后等待重新调度的任务返回抢占前已生成的token
+    """
+    generated_token_ids = list(task.get("generated_token_ids", []))
+    result = {
+        "req_id": task["req_id"],
+        "is_end": 1,
+        "token_ids": [],
+        "send_idx": len(generated_token_ids),
+        "infer_seed": task.get("infer_seed"),
+        "return_all_tokens": task.get("return_all_tokens", False),
+        "tokens_all_num": len(generated_token_ids) + 1,
+        "tokens_all_ids": generated_token_ids,
+        "input_token_num": task.get("prompt_token_num", len(task["input_ids"])),
+        "output_token_num": len(generated_token_ids),
+        "finish_reason": "abort",
+    }
+    if "sample_index" in task:
+        result["index"] = task["sample_index"]
+    return result
+
+
+def _error_result(task, error_msg, error_code=500):
+    """
+    未在推理进程中运行的任务出错时的结束结果
+    """
+    result = _abort_result(task)
+    result.update({"error_msg": error_msg, "error_code": error_code})
+    return result
+
+
 def _send_error(error_msg, sender, error_code=200, req_id=None):
     """
     向发送方发送错误信息
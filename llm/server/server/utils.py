@@ -12,16 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
 import base64
 import codecs
 import logging
 import os
 import pickle
+import queue
 import re
 import time
+from collections import Counter
 from datetime import datetime
 from enum import Enum
-from logging.handlers import BaseRotatingHandler
+from logging.handlers import BaseRotatingHandler, QueueHandler, QueueListener
 from pathlib import Path
 import subprocess
 
@@ -49,15 +52,14 @@ class DailyRotatingFileHandler(BaseRotatingHandler):
         self.base_filename = self.base_log_path.name
         self.current_filename = self._compute_fn()
         self.current_log_path = self.base_log_path.with_name(self.current_filename)
+        self.rollover_at = self._compute_rollover_at()
         BaseRotatingHandler.__init__(self, filename, "a", encoding, delay)
 
     def shouldRollover(self, record):
         """
-        判断是否该滚动日志，如果当前时间对应的日志文件名与当前打开的日志文件名不一致，则需要滚动日志
+        判断是否该滚动日志，日志时间到达下一个自然日的零点时需要滚动日志，只比较时间戳，不对每条日志格式化时间
         """
-        if self.current_filename != self._compute_fn():
-            return True
-        return False
+        return record.created >= self.rollover_at
 
     def doRollover(self):
         """
@@ -69,6 +71,7 @@ class DailyRotatingFileHandler(BaseRotatingHandler):
 
         self.current_filename = self._compute_fn()
         self.current_log_path = self.base_log_path.with_name(self.current_filename)
+        self.rollover_at = self._compute_rollover_at()
 
         if not self.delay:
             self.stream = self._open()
@@ -81,6 +84,13 @@ class DailyRotatingFileHandler(BaseRotatingHandler):
         """
         return self.base_filename + "." + time.strftime(self.suffix, time.localtime())
 
+    def _compute_rollover_at(self):
+        """
+        计算下一个自然日零点的时间戳
+        """
+        now = time.localtime()
+        return time.mktime((now.tm_year, now.tm_mon, now.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+
     def _open(self):
         """
         打开新的日志文件，同时更新base_filename指向的软链，修改软链不会对日志记录产生任何影响
@@ -133,9 +143,73 @@ class DailyRotatingFileHandler(BaseRotatingHandler):
             os.remove(str(self.base_log_path.with_name(file_name)))
 
 
+# 热点路径日志的标记，如logger.info(msg, extra=HOT_PATH)，开启采样后按调用位置只保留部分日志
+HOT_PATH = {"hot_path": True}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    热点路径日志的采样，每个logger的同一调用位置每interval条只保留1条，WARNING及以上级别的日志全部保留
+    """
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self.counters = Counter()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not getattr(record, "hot_path", False):
+            return True
+        key = (record.pathname, record.lineno)
+        count = self.counters[key]
+        self.counters[key] = count + 1
+        return count % self.interval == 0
+
+
+# 异步写日志的队列handler及其监听线程
+_log_listeners = []
+
+
+def _create_queue_handler(handler):
+    """
+    将handler的文件写入移到后台线程，调用方只把日志记录放入队列，不会阻塞在文件IO上
+    """
+    queue_handler = QueueHandler(queue.SimpleQueue())
+    listener = QueueListener(queue_handler.queue, handler)
+    listener.start()
+    _log_listeners.append((queue_handler, listener))
+    return queue_handler
+
+
+def _stop_log_listeners():
+    """
+    进程退出时写完队列中剩余的日志
+    """
+    for _, listener in _log_listeners:
+        if listener._thread is not None:
+            listener.stop()
+
+
+def _restart_log_listeners():
+    """
+    fork出的子进程中没有监听线程，且队列可能处于加锁状态，需重建队列并重新启动监听线程
+    """
+    for queue_handler, listener in _log_listeners:
+        queue_handler.queue = queue.SimpleQueue()
+        listener.queue = queue_handler.queue
+        listener._thread = None
+        listener.start()
+
+
+atexit.register(_stop_log_listeners)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_log_listeners)
+
+
 def get_logger(name, file_name, without_formater=False):
     """
     获取logger
+    1. FD_LOG_ASYNC开启时（默认开启），由后台线程写日志文件
+    2. FD_LOG_SAMPLE_INTERVAL大于1时，对标记为HOT_PATH的日志按调用位置采样
     """
     log_dir = os.getenv("FD_LOG_DIR", default="log")
     is_debug = int(os.getenv("FD_DEBUG", default=0))
@@ -154,13 +228,20 @@ def get_logger(name, file_name, without_formater=False):
     )
     if not without_formater:
         handler.setFormatter(formatter)
+    if int(os.getenv("FD_LOG_ASYNC", default=1)):
+        handler = _create_queue_handler(handler)
     logger.addHandler(handler)
     handler.propagate = False
+
+    sample_interval = int(os.getenv("FD_LOG_SAMPLE_INTERVAL", default=1))
+    if sample_interval > 1 and not any(isinstance(f, SamplingFilter) for f in logger.filters):
+        logger.addFilter(SamplingFilter(sample_interval))
     return logger
 
 # 实例化单例logger
 model_server_logger = get_logger("model_server", "infer_server.log")
 http_server_logger = get_logger("http_server", "http_server.log")
+router_logger = get_logger("router", "router.log")
 data_processor_logger = get_logger("data_processor", "data_processor.log")
 monitor_logger = get_logger("monitor_logger", "monitor_logger.log", True)
 error_logger = get_logger("error_logger", "error_logger.log", True)
@@ -0,0 +1,23 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import tempfile
+
+# 单元测试只覆盖不依赖GPU与模型的模块，在llm/server目录下执行 python -m pytest tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# server.utils在导入时创建日志文件，写到临时目录，同步写入避免后台线程
+os.environ.setdefault("FD_LOG_DIR", tempfile.mkdtemp(prefix="fd_test_log_"))
+os.environ.setdefault("FD_LOG_ASYNC", "0")
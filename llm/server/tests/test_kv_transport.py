@@ -0,0 +1,69 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+
+import numpy as np
+from server.engine.kv_transport import SharedMemoryKVTransport
+
+
+def expire(transport):
+    """
+    将目录中未被认领的KV的修改时间提前到ttl之前，并允许下一次发送时清理
+    """
+    past = time.time() - 2 * transport.ttl
+    for name in os.listdir(transport.transport_dir):
+        path = os.path.join(transport.transport_dir, name)
+        if os.path.isfile(path):
+            os.utime(path, (past, past))
+    transport.last_cleanup_time = 0.0
+
+
+def test_claimed_kv_is_not_cleaned_up(tmp_path):
+    transport = SharedMemoryKVTransport(str(tmp_path), ttl=10)
+    kv_blocks = np.arange(24, dtype=np.float32).reshape([2, 3, 4])
+    for rank in range(2):
+        transport.send(1, rank, 100, kv_blocks + rank)
+    assert transport.wait(1, 2, timeout=0) == 100
+    assert transport.claim(1, 2)
+
+    # 其他请求发送时清理过期的KV，已认领的KV不受影响
+    expire(transport)
+    transport.send(2, 0, 50, kv_blocks)
+    for rank in range(2):
+        token_num, received = transport.recv(1, rank)
+        assert token_num == 100 and np.array_equal(received, kv_blocks + rank)
+    assert os.listdir(transport.claimed_dir) == []
+
+
+def test_claim_fails_after_cleanup(tmp_path):
+    transport = SharedMemoryKVTransport(str(tmp_path), ttl=10)
+    kv_blocks = np.zeros([2, 1, 4], dtype=np.float32)
+    transport.send(1, 0, 100, kv_blocks)
+    transport.send(1, 1, 100, kv_blocks)
+    assert transport.wait(1, 2, timeout=0) == 100
+    # 等待与认领之间rank 1的KV被清理，整份KV不可用，已认领的部分一并删除
+    os.remove(transport._find(1, 1)[0])
+    assert not transport.claim(1, 2)
+    assert os.listdir(transport.claimed_dir) == []
+    assert transport._find(1, 0) == (None, None)
+
+
+def test_discard_claimed_kv(tmp_path):
+    transport = SharedMemoryKVTransport(str(tmp_path), ttl=10)
+    transport.send(1, 0, 100, np.zeros([2, 1, 4], dtype=np.float32))
+    assert transport.claim(1, 1)
+    transport.discard(1, 1)
+    assert os.listdir(transport.claimed_dir) == []
@@ -0,0 +1,291 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+from types import SimpleNamespace
+
+from server.engine.resource_manager import ResourceManager
+
+
+def make_config(**kwargs):
+    cfg = SimpleNamespace(
+        max_batch_size=8,
+        max_block_num=200,
+        block_size=64,
+        dec_token_num=128,
+        max_seq_len=8192,
+        max_dec_len=1024,
+        max_query_block_num=(8192 + 1024 + 63) // 64,
+        enable_chunked_prefill=False,
+        prefill_chunk_size=256,
+        enable_prefix_cache=False,
+        enable_admission_control=False,
+        enable_lora=False,
+    )
+    cfg.__dict__.update(kwargs)
+    return cfg
+
+
+def make_task(req_id, input_ids, **kwargs):
+    task = {"req_id": req_id, "input_ids": list(input_ids), "eos_token_ids": [2], "max_dec_len": 10, "min_dec_len": 1}
+    task.update(kwargs)
+    return task
+
+
+def finish(rm, task):
+    """
+    与TokenProcessor回收已结束任务的顺序一致
+    """
+    rm.release_slot(task["idx"])
+    rm._recycle_block_tables(task["block_tables"])
+
+
+def assert_all_returned(rm):
+    assert rm.reserved_block_num == 0
+    assert rm.availabel_block_num() == rm.cfg.max_block_num
+    assert rm.available_batch() == rm.cfg.max_batch_size
+    assert rm.real_bsz == 0
+    assert rm.preempting_num == 0
+    if rm.prefix_cache is not None:
+        assert rm.prefix_cache.evictable_block_num() == rm.prefix_cache.cached_block_num()
+
+
+def drive_prefill(rm, tasks):
+    """
+    模拟推理进程依次完成各任务的所有prefill分块，并在prefill完成后提交前缀缓存
+    """
+    pending = list(tasks)
+    while pending:
+        for task in pending:
+            assert task["prefill_end"] - task["prefill_start"] <= rm.cfg.prefill_chunk_size or \
+                not rm.cfg.enable_chunked_prefill
+            if task["prefill_end"] < len(task["input_ids"]):
+                rm.finish_prefill_chunk(task["idx"])
+        pending = rm.allocate_resources_for_next_chunks()
+        for task in pending:
+            assert len(task["block_tables"]) >= rm.get_encoder_block_number(task["prefill_end"])
+    for task in tasks:
+        assert task["reserved_block_num"] == 0
+        rm.commit_prefix_blocks(task["idx"])
+
+
+def test_slot_allocation_keeps_real_bsz_compact():
+    rm = ResourceManager(make_config(max_batch_size=4))
+    tasks = [rm.allocate_resources_for_new_tasks([make_task(str(i), [1] * 100)])[0] for i in range(4)]
+    assert [task["idx"] for task in tasks] == [0, 1, 2, 3]
+    assert rm.available_batch() == 0 and rm.real_bsz == 4
+    assert rm.allocate_resources_for_new_tasks([make_task("x", [1] * 100)]) == []
+
+    finish(rm, tasks[1])
+    assert rm.real_bsz == 4
+    # 优先分配编号最小的空闲位置
+    tasks[1] = rm.allocate_resources_for_new_tasks([make_task("y", [1] * 100)])[0]
+    assert tasks[1]["idx"] == 1
+    finish(rm, tasks[3])
+    assert rm.real_bsz == 3
+    for task in tasks[:3]:
+        finish(rm, task)
+    # 重复释放同一位置不影响计数
+    rm.release_slot(tasks[0]["idx"])
+    assert_all_returned(rm)
+
+
+def test_release_slot_clears_slot_error():
+    rm = ResourceManager(make_config(max_batch_size=2))
+    task = rm.allocate_resources_for_new_tasks([make_task("a", [1] * 100)])[0]
+    # 推理进程插入失败时写入错误码，位置回收后清零，之后分配到该位置的任务不受影响
+    rm.slot_errors[task["idx"]] = 1
+    finish(rm, task)
+    assert rm.slot_errors[task["idx"]] == 0
+    task = rm.allocate_resources_for_new_tasks([make_task("b", [1] * 100)])[0]
+    assert rm.slot_errors[task["idx"]] == 0
+    finish(rm, task)
+    assert_all_returned(rm)
+
+
+def test_random_churn_returns_all_blocks():
+    rng = random.Random(0)
+    rm = ResourceManager(make_config(max_block_num=100))
+    running = list()
+    for i in range(2000):
+        if running and (rm.available_batch() == 0 or rng.random() < 0.5):
+            finish(rm, running.pop(rng.randrange(len(running))))
+        running.extend(rm.allocate_resources_for_new_tasks([make_task(str(i), [1] * rng.randint(1, 1000))]))
+        assert rm.real_bsz == max([task["idx"] for task in running], default=-1) + 1
+        assert rm.available_batch() == rm.cfg.max_batch_size - len(running)
+        used_blocks = [block_id for task in running for block_id in task["block_tables"]]
+        assert len(used_blocks) == len(set(used_blocks))
+        assert rm.availabel_block_num() == rm.cfg.max_block_num - len(used_blocks)
+    for task in running:
+        finish(rm, task)
+    assert_all_returned(rm)
+
+
+def test_allocation_failure_does_not_leak():
+    rm = ResourceManager(make_config(max_block_num=10, enable_prefix_cache=True))
+    assert not rm.is_resource_sufficient(1000)
+    assert rm.allocate_resources_for_new_tasks([make_task("big", [1] * 1000)]) == []
+    assert_all_returned(rm)
+
+
+def test_prefix_cache_reuse_and_eviction():
+    rm = ResourceManager(make_config(max_block_num=20, enable_prefix_cache=True))
+    shared = list(range(3 * 64))
+    first = rm.allocate_resources_for_new_tasks([make_task("a", shared + [1000])])[0]
+    assert first["prefill_start"] == 0
+    drive_prefill(rm, [first])
+    assert rm.prefix_cache.cached_block_num() == 3
+
+    second = rm.allocate_resources_for_new_tasks([make_task("b", shared + [2000, 2001])])[0]
+    assert second["prefill_start"] == 3 * 64
+    assert second["block_tables"][:3] == first["block_tables"][:3]
+    drive_prefill(rm, [second])
+    finish(rm, first)
+    # 仍被second引用的缓存block不可淘汰
+    assert rm.prefix_cache.evictable_block_num() == 0
+    finish(rm, second)
+    assert_all_returned(rm)
+
+    # 空闲block不足时淘汰无引用的缓存block
+    other = rm.allocate_resources_for_new_tasks([make_task("c", list(range(5000, 5000 + 18 * 64)))])[0]
+    assert other["prefill_start"] == 0
+    assert rm.prefix_cache.cached_block_num() < 3
+    finish(rm, other)
+    assert_all_returned(rm)
+
+
+def test_chunked_prefill_reservations_drain():
+    for enable_prefix_cache in (False, True):
+        rng = random.Random(1)
+        rm = ResourceManager(make_config(enable_chunked_prefill=True, enable_prefix_cache=enable_prefix_cache))
+        shared = [7] * 1000
+        running = list()
+        for i in range(6):
+            running.extend(rm.allocate_resources_for_new_tasks([make_task(str(i), shared + [i] * rng.randint(1, 3000))]))
+        assert len(running) > 1
+        assert rm.reserved_block_num == sum(task["reserved_block_num"] for task in running)
+        assert rm._free_block_num() >= rm.reserved_block_num
+        drive_prefill(rm, running)
+        assert rm.reserved_block_num == 0
+        for task in running:
+            finish(rm, task)
+        assert_all_returned(rm)
+
+        # 分块prefill未完成时结束，归还预留的block
+        task = rm.allocate_resources_for_new_tasks([make_task("x", range(3000))])[0]
+        assert rm.reserved_block_num > 0
+        finish(rm, task)
+        assert_all_returned(rm)
+
+
+def test_preempt_requeue_and_resume():
+    rm = ResourceManager(make_config(max_batch_size=4, max_block_num=100))
+    tasks = list()
+    for i, priority in enumerate([1, 0, 0, 2]):
+        task = make_task(str(i), [1] * 100, max_dec_len=50, min_dec_len=5, priority=priority,
+                         arrival_time=float(i))
+        tasks.extend(rm.allocate_resources_for_new_tasks([task]))
+    # 只抢占优先级更低的任务，选择优先级最低、到达最晚的任务
+    assert rm.preempt({"priority": 0}) is None
+    index = rm.preempt({"priority": 5})
+    assert index == 2
+    # 同一时刻只抢占一个任务
+    assert rm.preempt() is None
+
+    victim = rm.tasks_list[index]
+    finish(rm, victim)
+    assert rm.preempting_num == 0
+    rm.requeue_preempted_task(victim, [5, 6, 7])
+    assert rm.pop_preempted_tasks() == [victim]
+    assert victim["input_ids"] == [1] * 100 + [5, 6, 7]
+    assert victim["max_dec_len"] == 47 and victim["min_dec_len"] == 2
+    assert "idx" not in victim and "block_tables" not in victim
+
+    resumed = rm.allocate_resources_for_new_tasks([victim])[0]
+    assert rm.resumed_num == 1
+    tasks[2] = resumed
+    # 再次被抢占时保留原prompt的边界
+    index = rm.preempt()
+    assert rm.tasks_list[index] is resumed
+    finish(rm, resumed)
+    rm.requeue_preempted_task(resumed, [5, 6, 7, 8, 9])
+    assert resumed["input_ids"] == [1] * 100 + [5, 6, 7, 8, 9] and resumed["max_dec_len"] == 45
+    assert rm.pop_preempted_tasks() == [resumed]
+    for task in tasks[:2] + tasks[3:]:
+        finish(rm, task)
+    assert_all_returned(rm)
+
+
+def test_abort_running_and_chunk_waiting_tasks():
+    rm = ResourceManager(make_config(enable_chunked_prefill=True))
+    running = rm.allocate_resources_for_new_tasks([make_task("run", [1] * 100)])[0]
+    chunked = rm.allocate_resources_for_new_tasks([make_task("chunk", [1] * 2000)])[0]
+    rm.finish_prefill_chunk(chunked["idx"])
+    assert rm.reserved_block_num > 0
+
+    stop_slots, finished_tasks = rm.abort({"run", "chunk"})
+    # 正在推理的任务需通知推理进程停止，等待下发下一分块的任务直接回收
+    assert stop_slots == [running["idx"]]
+    assert finished_tasks == [chunked]
+    assert running["aborted"]
+    assert rm.allocate_resources_for_next_chunks() == []
+    # 重复取消不再返回
+    assert rm.abort({"run"}) == ([], [])
+
+    finish(rm, running)
+    assert_all_returned(rm)
+
+
+def test_forked_tasks_released_after_prefill():
+    rm = ResourceManager(make_config(enable_prefix_cache=True))
+    prompt = list(range(300))
+    samples = [make_task("r", prompt, sample_index=0)] + \
+        [make_task(f"r_{i}", prompt, sample_index=i) for i in range(1, 3)]
+    samples[0]["forked_tasks"] = samples[1:]
+    first = rm.allocate_resources_for_new_tasks([samples[0]])[0]
+    assert rm.pop_forked_tasks() == []
+    drive_prefill(rm, [first])
+    rm.release_forked_tasks(first)
+    forked = rm.pop_forked_tasks()
+    assert forked == samples[1:]
+    forked = rm.allocate_resources_for_new_tasks(forked)
+    for task in forked:
+        assert task["prefill_start"] == 256
+        assert task["block_tables"][:4] == first["block_tables"][:4]
+    for task in [first] + forked:
+        finish(rm, task)
+    assert_all_returned(rm)
+
+
+def test_prefix_cache_is_not_shared_across_lora_adapters():
+    rm = ResourceManager(make_config(enable_prefix_cache=True, enable_lora=True, max_loras=2))
+    prompt = list(range(300))
+    base = rm.allocate_resources_for_new_tasks([make_task("base", prompt)])[0]
+    drive_prefill(rm, [base])
+    first = rm.allocate_resources_for_new_tasks([make_task("a1", prompt, lora_key=11)])[0]
+    assert first["prefill_start"] == 0
+    drive_prefill(rm, [first])
+    # 相同adapter的请求复用缓存，不同adapter或不使用adapter的请求不复用
+    second = rm.allocate_resources_for_new_tasks([make_task("a2", prompt, lora_key=11)])[0]
+    assert second["prefill_start"] == 256
+    assert second["block_tables"][:4] == first["block_tables"][:4]
+    other = rm.allocate_resources_for_new_tasks([make_task("b", prompt, lora_key=22)])[0]
+    assert other["prefill_start"] == 0
+    plain = rm.allocate_resources_for_new_tasks([make_task("plain", prompt)])[0]
+    assert plain["prefill_start"] == 256
+    assert plain["block_tables"][:4] == base["block_tables"][:4]
+    for task in (base, first, second, other, plain):
+        finish(rm, task)
+    assert_all_returned(rm)
+    assert rm.lora_slots.active_num() == 0
@@ -0,0 +1,212 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from types import SimpleNamespace
+
+import pytest
+from server.engine import scheduler as scheduler_module
+from server.engine.scheduler import (FIFOScheduler, PriorityScheduler, ShortestPromptFirstScheduler,
+                                     SkipAheadScheduler, create_scheduler)
+
+
+def make_config(**kwargs):
+    cfg = SimpleNamespace(schedule_policy="fifo", schedule_window=8, schedule_max_skip_times=32,
+                          schedule_spf_aging_rate=0)
+    cfg.__dict__.update(kwargs)
+    return cfg
+
+
+def make_task(req_id, prompt_len, **kwargs):
+    task = {"req_id": req_id, "input_ids": [1] * prompt_len, "max_dec_len": 10}
+    task.update(kwargs)
+    return task
+
+
+class FakeEngine(object):
+    """
+    只按剩余token数判断资源是否充足的引擎，插入任务时占用其输入token数
+    """
+    def __init__(self, free_token_num):
+        self.free_token_num = free_token_num
+
+    def is_resource_sufficient(self, input_token_num, max_dec_len=None, lora_key=0):
+        return input_token_num <= self.free_token_num
+
+    def insert(self, task):
+        self.free_token_num -= len(task["input_ids"])
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+def drain(scheduler, engine):
+    """
+    模拟插入线程，按调度策略取出所有资源满足的请求
+    """
+    req_ids = list()
+    while True:
+        task = scheduler.pop(engine.is_resource_sufficient)
+        if task is None:
+            return req_ids
+        engine.insert(task)
+        req_ids.append(task["req_id"])
+
+
+def test_fifo_stops_at_head_of_line():
+    scheduler = FIFOScheduler(make_config())
+    for req_id, prompt_len in [("a", 10), ("b", 100), ("c", 10)]:
+        scheduler.put(make_task(req_id, prompt_len))
+    assert drain(scheduler, FakeEngine(50)) == ["a"]
+    assert scheduler.peek()["req_id"] == "b" and len(scheduler) == 2
+    assert drain(scheduler, FakeEngine(1000)) == ["b", "c"]
+
+
+def test_fifo_requeue_goes_to_head():
+    scheduler = FIFOScheduler(make_config())
+    scheduler.put(make_task("a", 10))
+    scheduler.requeue(make_task("preempted", 10))
+    assert drain(scheduler, FakeEngine(1000)) == ["preempted", "a"]
+
+
+def test_skip_ahead_within_window_and_skip_limit():
+    scheduler = SkipAheadScheduler(make_config(schedule_window=3, schedule_max_skip_times=2))
+    for req_id, prompt_len in [("long", 100), ("s1", 10), ("s2", 10), ("s3", 10), ("s4", 10)]:
+        scheduler.put(make_task(req_id, prompt_len))
+    # 窗口包含队首在内的3个请求，队首最多被跳过2次
+    assert drain(scheduler, FakeEngine(50)) == ["s1", "s2"]
+    assert scheduler.peek()["req_id"] == "long"
+    assert drain(scheduler, FakeEngine(50)) == []
+    assert drain(scheduler, FakeEngine(1000)) == ["long", "s3", "s4"]
+
+
+def test_spf_orders_by_prompt_len_with_fifo_ties():
+    scheduler = ShortestPromptFirstScheduler(make_config())
+    for req_id, prompt_len in [("a", 30), ("b", 10), ("c", 20), ("d", 10), ("e", 30), ("f", 10)]:
+        scheduler.put(make_task(req_id, prompt_len))
+    assert drain(scheduler, FakeEngine(1000)) == ["b", "d", "f", "c", "a", "e"]
+
+
+def test_spf_stops_when_shortest_does_not_fit():
+    scheduler = ShortestPromptFirstScheduler(make_config())
+    for req_id, prompt_len in [("a", 30), ("b", 10)]:
+        scheduler.put(make_task(req_id, prompt_len))
+    assert drain(scheduler, FakeEngine(35)) == ["b"]
+    assert len(scheduler) == 1
+
+
+def test_spf_aging_prevents_starvation(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler_module, "time", clock)
+    scheduler = ShortestPromptFirstScheduler(make_config(schedule_spf_aging_rate=100))
+    scheduler.put(make_task("long", 1000))
+    order = list()
+    # 每秒到达一个短请求并插入一个请求，长请求等待(1000 - 10) / 100秒后排到短请求之前
+    for i in range(20):
+        clock.now += 1
+        scheduler.put(make_task(f"short{i}", 10))
+        order.append(scheduler.pop(FakeEngine(10000).is_resource_sufficient)["req_id"])
+    assert "long" in order
+    assert order.index("long") <= 10
+
+    # 不老化时长请求一直被后到的短请求插队
+    scheduler = ShortestPromptFirstScheduler(make_config(schedule_spf_aging_rate=0))
+    scheduler.put(make_task("long", 1000))
+    for i in range(20):
+        clock.now += 1
+        scheduler.put(make_task(f"short{i}", 10))
+        assert scheduler.pop(FakeEngine(10000).is_resource_sufficient)["req_id"] == f"short{i}"
+
+
+def test_priority_orders_by_priority_with_fifo_ties():
+    scheduler = PriorityScheduler(make_config())
+    for req_id, priority in [("a", 0), ("b", 2), ("c", 1), ("d", 2), ("e", 0), ("f", 1)]:
+        scheduler.put(make_task(req_id, 10, priority=priority))
+    scheduler.put(make_task("default", 10))
+    assert drain(scheduler, FakeEngine(1000)) == ["b", "d", "c", "f", "a", "e", "default"]
+
+
+def test_requeue_precedes_later_tasks_with_same_key():
+    for scheduler_class in (ShortestPromptFirstScheduler, PriorityScheduler):
+        scheduler = scheduler_class(make_config())
+        preempted = make_task("preempted", 10, priority=1)
+        scheduler.put(preempted)
+        assert scheduler.pop(FakeEngine(1000).is_resource_sufficient) is preempted
+        scheduler.put(make_task("later", 10, priority=1))
+        scheduler.requeue(preempted)
+        assert drain(scheduler, FakeEngine(1000)) == ["preempted", "later"]
+
+
+def test_remove():
+    for policy in ("fifo", "skip_ahead", "spf", "priority"):
+        scheduler = create_scheduler(make_config(schedule_policy=policy))
+        for i in range(5):
+            scheduler.put(make_task(str(i), 10 + i, priority=i % 2))
+        removed = scheduler.remove({"1", "3", "unknown"})
+        assert sorted(task["req_id"] for task in removed) == ["1", "3"]
+        assert sorted(drain(scheduler, FakeEngine(1000))) == ["0", "2", "4"]
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        create_scheduler(make_config(schedule_policy="lifo"))
+
+
+def test_requeue_forked_samples_under_heap_policies():
+    for policy in ("spf", "priority"):
+        for aging_rate in (0, 500):
+            scheduler = create_scheduler(make_config(schedule_policy=policy, schedule_spf_aging_rate=aging_rate))
+            # 与_fork_samples一致，各采样是请求的浅拷贝，只有首个采样放入队列
+            parent = make_task("r", 10, priority=1, sample_index=0)
+            samples = [parent] + [dict(parent, req_id=f"r_{i}", sample_index=i) for i in range(1, 3)]
+            parent["forked_tasks"] = samples[1:]
+            scheduler.put(parent)
+            scheduler.put(make_task("later", 10, priority=1))
+            assert scheduler.pop(FakeEngine(1000).is_resource_sufficient) is parent
+            for sample in parent.pop("forked_tasks"):
+                assert sample["schedule_order"] == parent["schedule_order"]
+                scheduler.requeue(sample)
+            # 键与入队顺序均相同的采样按放入队列的顺序取出，且先于之后到达的请求
+            assert drain(scheduler, FakeEngine(1000)) == ["r_1", "r_2", "later"]
+
+
+def test_requeue_tasks_without_schedule_order():
+    for policy in ("spf", "priority"):
+        scheduler = create_scheduler(make_config(schedule_policy=policy))
+        for i in range(3):
+            scheduler.requeue(make_task(str(i), 10))
+        assert drain(scheduler, FakeEngine(1000)) == ["0", "1", "2"]
+
+
+def test_sample_num_counts_forked_samples():
+    for policy in ("fifo", "skip_ahead", "spf", "priority"):
+        scheduler = create_scheduler(make_config(schedule_policy=policy))
+        parent = make_task("r", 10)
+        parent["forked_tasks"] = [dict(parent, req_id=f"r_{i}") for i in range(1, 4)]
+        scheduler.put(parent)
+        scheduler.put(make_task("a", 10))
+        scheduler.put(make_task("b", 10))
+        assert len(scheduler) == 3 and scheduler.sample_num == 6
+        assert [task["req_id"] for task in scheduler.remove({"b"})] == ["b"]
+        assert scheduler.sample_num == 5
+        task = scheduler.pop(FakeEngine(1000).is_resource_sufficient)
+        assert scheduler.sample_num == 5 - 1 - len(task.get("forked_tasks") or [])
+        for sample in task.pop("forked_tasks", None) or []:
+            scheduler.requeue(sample)
+        drain(scheduler, FakeEngine(1000))
+        assert scheduler.sample_num == 0
@@ -0,0 +1,181 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+from server.engine.task_batch import FLOAT_FIELDS, INT_FIELDS, META_NUM, VERSION, TaskBatch
+
+
+def make_task(idx, prompt_len, block_num, **kwargs):
+    task = {
+        "idx": idx,
+        "input_ids": list(range(100 * idx, 100 * idx + prompt_len)),
+        "block_tables": list(range(10 * idx, 10 * idx + block_num)),
+        "eos_token_ids": [2],
+    }
+    task.update(kwargs)
+    return task
+
+
+def round_trip(tasks, real_bsz, stop_slots=None):
+    return TaskBatch.decode(TaskBatch.from_tasks(tasks, real_bsz, stop_slots).encode())
+
+
+def test_all_fields_round_trip():
+    full = make_task(
+        3, 7, 2,
+        eos_token_ids=[2, 5, 9],
+        prefill_start=2,
+        prefill_end=7,
+        min_dec_len=4,
+        max_dec_len=128,
+        infer_seed=2**62 + 1,
+        guided_fsm=2**60 + 7,
+        guided_state=11,
+        lora_key=2**59 + 3,
+        lora_slot=1,
+        kv_transfer_key=2**58 + 5,
+        topp=0.5,
+        temperature=0.25,
+        penalty_score=1.5,
+        frequency_score=0.125,
+        presence_score=-0.5,
+    )
+    default = make_task(0, 5, 1, eos_token_ids=7)
+    batch = round_trip([full, default], real_bsz=4, stop_slots=[6, 1])
+
+    assert len(batch) == 2 and batch.real_bsz == 4
+    expected = {
+        "idx": [3, 0],
+        "token_num": [5, 5],
+        "prefill_start": [2, 0],
+        "block_num": [2, 1],
+        "eos_num": [3, 1],
+        "min_dec_len": [4, 1],
+        "max_dec_len": [128, -1],
+        "infer_seed": [2**62 + 1, 0],
+        "guided_fsm": [2**60 + 7, 0],
+        "guided_state": [11, 0],
+        "lora_key": [2**59 + 3, 0],
+        "lora_slot": [1, -1],
+        "kv_transfer_key": [2**58 + 5, 0],
+        "context_num": [0, 0],
+    }
+    assert set(expected) == set(INT_FIELDS)
+    for name, values in expected.items():
+        assert batch.column(name).tolist() == values, name
+    float_expected = {"topp": 0.5, "temperature": 0.25, "penalty_score": 1.5, "frequency_score": 0.125,
+                      "presence_score": -0.5}
+    for name, default_value in FLOAT_FIELDS:
+        np.testing.assert_allclose(batch.column(name), [float_expected[name], default_value], rtol=1e-6)
+
+    assert batch.get_token_ids(0).tolist() == full["input_ids"][2:7]
+    assert batch.get_token_ids(1).tolist() == default["input_ids"]
+    assert batch.get_block_tables(0).tolist() == full["block_tables"]
+    assert batch.get_block_tables(1).tolist() == default["block_tables"]
+    assert batch.get_eos_token_ids(0).tolist() == [2, 5, 9]
+    assert batch.get_eos_token_ids(1).tolist() == [7]
+    assert batch.stop_slots.tolist() == [6, 1]
+
+
+def test_context_sent_with_first_chunk_only():
+    # 命中前缀缓存的首个分块、后续分块、从头prefill的任务
+    first = make_task(0, 600, 10, prefill_start=128, prefill_end=384, cached_token_num=128)
+    later = make_task(1, 600, 10, prefill_start=384, prefill_end=600, cached_token_num=128)
+    fresh = make_task(2, 5, 1, cached_token_num=0)
+    batch = round_trip([first, later, fresh], real_bsz=3)
+    assert batch.column("context_num").tolist() == [0, 0, 0] and batch.context_token_ids.size == 0
+
+    batch = TaskBatch.decode(TaskBatch.from_tasks([first, later, fresh], 3, with_context=True).encode())
+    assert batch.column("context_num").tolist() == [128, 0, 0]
+    assert batch.get_context_token_ids(0).tolist() == first["input_ids"][:128]
+    assert batch.get_context_token_ids(1).size == 0 and batch.get_context_token_ids(2).size == 0
+    assert batch.get_token_ids(0).tolist() == first["input_ids"][128:384]
+    assert batch.get_token_ids(1).tolist() == later["input_ids"][384:600]
+
+
+def test_seq_len_used_as_max_dec_len():
+    batch = round_trip([make_task(0, 3, 1, seq_len=64)], real_bsz=1)
+    assert batch.column("max_dec_len").tolist() == [64]
+
+
+def test_empty_batch_with_stop_slots():
+    batch = round_trip([], real_bsz=5, stop_slots=[0, 4])
+    assert len(batch) == 0 and batch.real_bsz == 5
+    assert batch.stop_slots.tolist() == [0, 4]
+    assert batch.token_ids.size == 0 and batch.block_tables.size == 0 and batch.eos_token_ids.size == 0
+    assert batch.padded_token_ids(8, 0).shape == (0, 8)
+    assert batch.padded_block_tables(4).shape == (0, 4)
+
+
+def test_empty_batch_without_stop_slots():
+    payload = TaskBatch.from_tasks([], real_bsz=0).encode()
+    assert len(payload) == META_NUM * 8
+    batch = TaskBatch.decode(payload)
+    assert len(batch) == 0 and batch.real_bsz == 0 and batch.stop_slots.size == 0
+
+
+def test_empty_stop_slots():
+    for stop_slots in (None, []):
+        batch = round_trip([make_task(0, 3, 1)], real_bsz=1, stop_slots=stop_slots)
+        assert batch.stop_slots.size == 0
+        assert batch.get_token_ids(0).tolist() == [0, 1, 2]
+
+
+def test_chunked_prefill_middle_chunk_is_clipped():
+    task = make_task(1, 600, 10, prefill_start=256, prefill_end=512, min_dec_len=8, max_dec_len=100,
+                     kv_transfer_key=12345)
+    batch = round_trip([task], real_bsz=2)
+    assert batch.column("token_num").tolist() == [256]
+    assert batch.column("prefill_start").tolist() == [256]
+    assert batch.get_token_ids(0).tolist() == task["input_ids"][256:512]
+    # 中间分块只生成1个token，且不发送KV
+    assert batch.column("min_dec_len").tolist() == [1]
+    assert batch.column("max_dec_len").tolist() == [1]
+    assert batch.column("kv_transfer_key").tolist() == [0]
+
+    task["prefill_start"], task["prefill_end"] = 512, 600
+    batch = round_trip([task], real_bsz=2)
+    assert batch.get_token_ids(0).tolist() == task["input_ids"][512:600]
+    assert batch.column("min_dec_len").tolist() == [8]
+    assert batch.column("max_dec_len").tolist() == [100]
+    assert batch.column("kv_transfer_key").tolist() == [12345]
+
+
+def test_padded_token_ids_and_block_tables():
+    tasks = [make_task(0, 5, 2), make_task(1, 0, 0), make_task(2, 8, 3), make_task(3, 1, 1)]
+    batch = round_trip(tasks, real_bsz=4)
+    token_ids = batch.padded_token_ids(8, -7)
+    block_tables = batch.padded_block_tables(4)
+    assert token_ids.shape == (4, 8) and token_ids.dtype == np.int64
+    assert block_tables.shape == (4, 4) and block_tables.dtype == np.int32
+    for i, task in enumerate(tasks):
+        token_num, block_num = len(task["input_ids"]), len(task["block_tables"])
+        assert token_ids[i, :token_num].tolist() == task["input_ids"]
+        assert (token_ids[i, token_num:] == -7).all()
+        assert block_tables[i, :block_num].tolist() == task["block_tables"]
+        assert (block_tables[i, block_num:] == -1).all()
+
+
+def test_decode_does_not_copy_payload():
+    payload = TaskBatch.from_tasks([make_task(0, 4, 1)], real_bsz=1).encode()
+    batch = TaskBatch.decode(payload)
+    assert not batch.token_ids.flags.owndata and not batch.token_ids.flags.writeable
+
+
+def test_version_mismatch_is_rejected():
+    payload = bytearray(TaskBatch.from_tasks([make_task(0, 4, 1)], real_bsz=1).encode())
+    payload[:8] = np.array([VERSION - 1], dtype=np.int64).tobytes()
+    with pytest.raises(ValueError):
+        TaskBatch.decode(bytes(payload))